@@ -1 +1,6 @@
+from logstapo.config import Config, ConfigError, load_config
+from logstapo.core import follow, run
+
+
 __version__ = '0.0.dev0'
+__all__ = ('Config', 'ConfigError', 'load_config', 'follow', 'run')
@@ -1,17 +1,30 @@
+import base64
 import getpass
+import gzip
+import itertools
 import smtplib
 import socket
-from collections import defaultdict
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+from datetime import datetime
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from importlib.metadata import entry_points
 
-from logstapo.config import ConfigError, current_config
-from logstapo.util import underlined, debug_echo, ensure_collection
+from logstapo.config import ConfigError, bind_config, current_config
+from logstapo.util import underlined, debug_echo, ensure_collection, error_echo
 
 
-def run_actions(results):
-    """Run logstapo actions on the remaining log lines.
+def group_results(results):
+    """Group the results of multiple logs by action.
 
     :param results: Result dict as returned by `process_logs`
+    :return: A dict mapping action names to the data passed to
+             `Action.run`.  Logs without any lines are skipped.
     """
     config = current_config.data
     results_for_actions = defaultdict(dict)
@@ -20,11 +33,78 @@ def run_actions(results):
             continue
         for action in config['logs'][name]['actions']:
             results_for_actions[action][name] = logresults
-    for action, data in results_for_actions.items():
-        config['actions'][action].run(data)
+    return dict(results_for_actions)
+
+
+def run_action(action, data):
+    """Run a single action.
+
+    :param action: The name of the action
+    :param data: The data to pass to `Action.run`
+    :return: ``True`` if the action succeeded, ``False`` otherwise
+    """
+    try:
+        current_config['actions'][action].run(data)
+    except Exception as exc:
+        error_echo("Action '{}' failed: {}".format(action, exc))
+        return False
+    return True
+
+
+def dispatch_actions(jobs):
+    """Run multiple actions concurrently.
+
+    Each action runs in its own thread and is considered failed if it
+    does not finish within its timeout.  Since threads cannot be
+    killed, an action which timed out keeps running in the background
+    until it finishes or the process exits.
+
+    :param jobs: A list of ``(action, data)`` tuples
+    :return: A list containing ``True`` for each action that succeeded
+             and ``False`` for each one that failed or timed out.
+    """
+    results = [False] * len(jobs)
+
+    def _run(i, action, data):
+        results[i] = run_action(action, data)
+
+    start = time.monotonic()
+    threads = []
+    for i, (action, data) in enumerate(jobs):
+        thread = threading.Thread(target=bind_config(_run), args=(i, action, data), daemon=True,
+                                  name='logstapo-action-{}'.format(action))
+        thread.start()
+        threads.append(thread)
+    for thread, (action, __) in zip(threads, jobs):
+        timeout = current_config['actions'][action].timeout
+        thread.join(None if timeout is None else max(0, start + timeout - time.monotonic()))
+        if thread.is_alive():
+            error_echo("Action '{}' timed out after {} seconds".format(action, timeout))
+    return [result and not thread.is_alive() for result, thread in zip(results, threads)]
+
+
+def run_actions(results):
+    """Run logstapo actions on the remaining log lines.
+
+    The actions run concurrently; an action failing or timing out does
+    not prevent other actions from running.
+
+    :param results: Result dict as returned by `process_logs`
+    :return: A set containing the names of all logs for which at
+             least one action failed.
+    """
+    jobs = sorted(group_results(results).items())
+    failed = set()
+    for (action, data), success in zip(jobs, dispatch_actions(jobs)):
+        if not success:
+            failed.update(data)
+    return failed
 
 
 class Action(object):
+    #: Seconds after which the action is considered failed (or ``None``)
+    timeout = None
+
     def __init__(self, data):  # pragma: no cover
         raise NotImplementedError
 
@@ -44,18 +124,120 @@ class Action(object):
         raise NotImplementedError
 
     @staticmethod
-    def from_config(type_, data):
+    def from_config(type_, data, timeout=None):
         """Creates a new Action instance from config data.
 
         :param type_: The type of the action.  Used to lookup the
                       implementation
         :param data: The action-specific config data.
+        :param timeout: Seconds after which the action is considered
+                        failed (or ``None``)
         """
+        action = get_action_type(type_)(data)
+        action.timeout = timeout
+        return action
+
+
+class StreamingAction(Action):
+    """An action which receives the results in batches.
+
+    Instead of implementing `run`, streaming actions implement `open`,
+    `feed` and `close`.  The records are passed to `feed` in batches
+    of up to `batch_size` records, so an action sending them somewhere
+    else does not need to keep all of them in memory.
+
+    Each record is a ``(log_name, line, parsed)`` tuple; `parsed` is
+    the dict containing the data from the regex or ``None`` for lines
+    which could not be parsed.
+
+    Like `run`, these methods MUST honor ``current_config['dry_run']``.
+    """
+
+    #: The maximum number of records passed to `feed` at once
+    batch_size = 1000
+
+    def open(self):
+        """Prepare receiving the results of a run."""
+
+    def feed(self, batch):  # pragma: no cover
+        """Handle some of the results.
+
+        :param batch: A list of records
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Finish handling the results after all batches were fed.
+
+        The action is only considered successful if this method
+        succeeds, so e.g. data which has been buffered should be
+        flushed here.
+        """
+
+    def abort(self):
+        """Clean up after `open` or `feed` failed."""
+
+    def run(self, data):
+        self.open()
         try:
-            action = ACTIONS[type_]
-        except KeyError:
-            raise ConfigError('type does not exist: ' + type_)
-        return action(data)
+            records = iter_records(data)
+            for batch in iter(lambda: list(itertools.islice(records, self.batch_size)), []):
+                self.feed(batch)
+        except Exception:
+            self.abort()
+            raise
+        self.close()
+
+
+def iter_records(data):
+    """Yield the records passed to a `StreamingAction`.
+
+    :param data: A dict mapping log names to the data returned by
+                 `process_log`.
+    :return: An iterator of ``(log_name, line, parsed)`` tuples
+    """
+    for name, (lines, unparsable) in sorted(data.items()):
+        for line in unparsable:
+            yield name, line, None
+        for line, parsed in lines:
+            yield name, line, parsed
+
+
+def _find_entry_point(name):
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return next(iter(eps.select(group='logstapo.actions', name=name)), None)
+    # python < 3.10
+    return next((ep for ep in eps.get('logstapo.actions', ()) if ep.name == name), None)
+
+
+def get_action_type(name):
+    """Get the class implementing an action type.
+
+    Besides the builtin types, action types can be provided by other
+    packages using entry points in the ``logstapo.actions`` group.
+    Their modules are only imported when they are used.
+
+    :param name: The name of the action type
+    :return: A subclass of `Action`
+    :raise ConfigError: If the type does not exist or cannot be loaded
+    """
+    try:
+        return ACTIONS[name]
+    except KeyError:
+        pass
+    entry_point = _find_entry_point(name)
+    if entry_point is None:
+        raise ConfigError('type does not exist: ' + name)
+    debug_echo('loading action type {} from {}', name, entry_point.value)
+    try:
+        action = entry_point.load()
+    except Exception as exc:
+        raise ConfigError('type could not be loaded: {} ({})'.format(name, exc)) from exc
+    if not isinstance(action, type) or not issubclass(action, Action):
+        raise ConfigError('type is not an action: ' + name)
+    ACTIONS[name] = action
+    return action
 
 
 class SMTPAction(Action):
@@ -73,6 +255,13 @@ class SMTPAction(Action):
             raise ConfigError('email recipient (to) missing')
         self.subject = data.get('subject', 'unusual system events')
         self.group_by_source = data.get('group', False)
+        self.max_lines = data.get('max_lines', 5000)
+        self.max_bytes = data.get('max_bytes', 1024 * 1024)
+        self.max_attachment_bytes = data.get('max_attachment_bytes', 5 * 1024 * 1024)
+        for key in ('max_lines', 'max_bytes', 'max_attachment_bytes'):
+            value = getattr(self, key)
+            if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+                raise ConfigError('{} must be a positive integer'.format(key))
         if self.ssl and self.starttls:
             raise ConfigError('ssl and starttls are mutually exclusive')
         if bool(self.username) != bool(self.password):
@@ -85,8 +274,7 @@ class SMTPAction(Action):
     def _get_sender(self):
         return '{}@{}'.format(getpass.getuser(), socket.getfqdn())
 
-    def _build_msg(self, data):
-        msg = []
+    def _iter_report(self, data):
         for i, (logname, (lines, unparsable)) in enumerate(sorted(data.items())):
             if not lines and not unparsable:
                 # This should never happen - run_action filters such entries
@@ -94,33 +282,127 @@ class SMTPAction(Action):
             if self.group_by_source:
                 lines = sorted(lines, key=lambda x: x[1]['source'].lower())
             if i > 0:
-                msg += [''] * 3
-            msg += underlined("Logstapo results for '{}'".format(logname))
-            msg.append('')
+                yield from [''] * 3
+            yield from underlined("Logstapo results for '{}'".format(logname))
+            yield ''
             if unparsable:
-                msg += underlined('Unparsable lines', '~')
-                msg += unparsable
+                yield from underlined('Unparsable lines', '~')
+                yield from unparsable
             if unparsable and lines:
-                msg.append('')
+                yield ''
             if lines:
-                msg += underlined('Unusual lines', '-')
-                msg += [x[0] for x in lines]
-        return '\n'.join(msg)
+                yield from underlined('Unusual lines', '-')
+                for line, parsed in lines:
+                    if 'template' not in parsed:
+                        yield line
+                    else:
+                        yield '{}{}x {}: {}'.format('~' if parsed['error'] else '', parsed['count'], parsed['source'],
+                                                    parsed['template'])
+                        for example in parsed['examples']:
+                            yield '    ' + example
+                    if 'repeat' in parsed:
+                        first_seen = datetime.fromtimestamp(parsed['first_seen']).strftime('%Y-%m-%d %H:%M')
+                        yield '    (repeated, {}x since {})'.format(parsed['repeat'], first_seen)
+
+    def _build_email(self, data):
+        """Build the email containing the report.
+
+        If the report exceeds `max_lines` or `max_bytes`, the email only
+        contains a summary and the beginning of the report, and the
+        full report is attached as a gzip-compressed file.  The report
+        is compressed while it is generated so it never needs to be
+        kept in memory as a whole.  Once the compressed report reaches
+        `max_attachment_bytes`, the remaining lines are only counted
+        and a note about them ends the attached report.
+        """
+        inline = []
+        inline_size = 0
+        line_count = 0
+        size = 0
+        omitted = omitted_size = 0
+        report = None
+        with ExitStack() as stack:
+            for line in self._iter_report(data):
+                encoded = (line + '\n').encode('utf-8')
+                line_count += 1
+                size += len(encoded)
+                if report is None and (line_count > self.max_lines or inline_size + len(encoded) > self.max_bytes):
+                    debug_echo('report too large, attaching it')
+                    report_file = stack.enter_context(tempfile.TemporaryFile())
+                    report = stack.enter_context(gzip.GzipFile('logstapo-report.txt', 'wb', fileobj=report_file))
+                    report.writelines((x + '\n').encode('utf-8') for x in inline)
+                if omitted or (report is not None and report_file.tell() >= self.max_attachment_bytes):
+                    omitted += 1
+                    omitted_size += len(encoded)
+                elif report is not None:
+                    report.write(encoded)
+                else:
+                    inline.append(line)
+                    inline_size += len(encoded)
+            if report is None:
+                return MIMEText('\n'.join(inline))
+            if omitted:
+                debug_echo('attachment too large, truncating it')
+                report.write('[report truncated: {} more lines ({} bytes) not included]\n'
+                             .format(omitted, omitted_size).encode('utf-8'))
+            report.close()
+            report_file.seek(0)
+            attachment = MIMEBase('application', 'gzip')
+            attachment.set_payload(_encode_base64(report_file))
+            attachment['Content-Transfer-Encoding'] = 'base64'
+        attachment.add_header('Content-Disposition', 'attachment', filename='logstapo-report.txt.gz')
+        msg = MIMEMultipart()
+        msg.attach(MIMEText('\n'.join(self._build_summary(data, line_count, size, omitted) + inline + ['[...]'])))
+        msg.attach(attachment)
+        return msg
+
+    def _build_summary(self, data, line_count, size, omitted=0):
+        summary = underlined('Logstapo report truncated')
+        summary += ['',
+                    'The report is too large to be included completely ({} lines, {} bytes).'
+                    .format(line_count, size),
+                    'The full report is attached as logstapo-report.txt.gz.' if not omitted else
+                    'The first {} lines of the report are attached as logstapo-report.txt.gz.'
+                    .format(line_count - omitted),
+                    '']
+        sources = Counter()
+        for lines, __ in data.values():
+            for __, parsed in lines:
+                sources[parsed['source']] += parsed.get('count', 1)
+        unparsable = sum(len(x) for __, x in data.values())
+        summary += underlined('Top sources', '-')
+        summary += ['{:>8}  {}'.format(count, source) for source, count in sources.most_common(10)]
+        if unparsable:
+            summary.append('{:>8}  (unparsable)'.format(unparsable))
+        summary += ['', '']
+        return summary
 
     def run(self, data):
-        msg = MIMEText(self._build_msg(data))
+        msg = self._build_email(data)
         msg['Subject'] = self.subject
         msg['From'] = self.sender
         msg['To'] = ', '.join(sorted(self.recipients))
 
-        cls = smtplib.SMTP_SSL if self.ssl else smtplib.SMTP
-        debug_echo('using {} client'.format(cls.__name__))
+        debug_echo('using {} client', 'SMTP_SSL' if self.ssl else 'SMTP')
         if current_config['dry_run']:
             debug_echo('not sending email due to dry-run')
             return
-        smtp = cls(self.host, self.port)
+        smtp_pool.send(self, msg)
+
+    @property
+    def connection_key(self):
+        """The key used to share SMTP connections between actions."""
+        return self.host, self.port, self.ssl, self.starttls, self.username, self.password
+
+    def connect(self):
+        """Connect and authenticate to the SMTP server.
+
+        :return: A connected `smtplib.SMTP` or `smtplib.SMTP_SSL`
+        """
+        cls = smtplib.SMTP_SSL if self.ssl else smtplib.SMTP
+        smtp = cls(self.host, self.port, timeout=self.timeout)
         smtp.set_debuglevel(current_config['debug'])
-        with smtp:
+        try:
             smtp.ehlo()
             if self.starttls:
                 debug_echo('issuing STARTTLS')
@@ -129,9 +411,103 @@ class SMTPAction(Action):
             if self.username and self.password:
                 debug_echo('logging in as ' + self.username)
                 smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        return smtp
+
+
+class SMTPPool(object):
+    """Share SMTP connections between actions using the same server.
+
+    While the pool is active (i.e. inside a ``with smtp_pool:`` block)
+    all emails sent to the same server with the same credentials use
+    a single authenticated connection which is closed when leaving the
+    block.  Outside such a block a new connection is used for every
+    email.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = 0
+        self._connections = {}
+        self._key_locks = defaultdict(threading.Lock)
+
+    def __enter__(self):
+        with self._lock:
+            self._active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._lock:
+            self._active -= 1
+            if self._active:
+                return
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for smtp in connections:
+            _close_smtp(smtp)
+
+    def send(self, action, msg):
+        """Send an email using a pooled connection.
+
+        If a pooled connection has been closed by the server, a new one
+        is established and sending the email is retried once.
+
+        :param action: The `SMTPAction` sending the email
+        :param msg: The email message
+        """
+        if not self._active:
+            smtp = action.connect()
+            try:
+                debug_echo('sending email')
+                smtp.send_message(msg)
+            finally:
+                _close_smtp(smtp)
+            return
+        key = action.connection_key
+        with self._lock:
+            key_lock = self._key_locks[key]
+        with key_lock:
+            smtp = self._connections.get(key)
+            if smtp is not None:
+                debug_echo('sending email using pooled connection')
+                try:
+                    smtp.send_message(msg)
+                    return
+                except (smtplib.SMTPServerDisconnected, ConnectionError) as exc:
+                    debug_echo('pooled connection failed ({}), reconnecting', exc)
+                    self._connections.pop(key, None)
+                    _close_smtp(smtp)
+            smtp = action.connect()
+            with self._lock:
+                if self._active:
+                    self._connections[key] = smtp
             debug_echo('sending email')
             smtp.send_message(msg)
 
 
-# TODO: use entry points instead of hardcoded list
+def _encode_base64(fileobj):
+    """Encode the contents of a file using base64 chunk by chunk.
+
+    This avoids having the whole file in memory in addition to its
+    encoded form.
+    """
+    # 57 bytes are encoded as one line of 76 characters
+    return ''.join(chunk.decode('ascii') for chunk in iter(lambda: base64.encodebytes(fileobj.read(57 * 1024)), b''))
+
+
+def _close_smtp(smtp):
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp.close()
+
+
+#: The connection pool used by `SMTPAction`
+smtp_pool = SMTPPool()
+
+
+#: The available action types.  Types provided by entry points are
+#: added when they are used for the first time.
 ACTIONS = {'smtp': SMTPAction}
@@ -0,0 +1,287 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # pragma: no cover
+    # python < 3.11
+    import sre_parse
+
+from logstapo.util import warning_echo
+
+
+_REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT}
+#: Characters used to check whether two character sets overlap
+_SAMPLE_CHARS = [chr(i) for i in range(256)]
+_CATEGORIES = {
+    sre_parse.CATEGORY_DIGIT: str.isdigit,
+    sre_parse.CATEGORY_NOT_DIGIT: lambda c: not c.isdigit(),
+    sre_parse.CATEGORY_SPACE: str.isspace,
+    sre_parse.CATEGORY_NOT_SPACE: lambda c: not c.isspace(),
+    sre_parse.CATEGORY_WORD: lambda c: c.isalnum() or c == '_',
+    sre_parse.CATEGORY_NOT_WORD: lambda c: not (c.isalnum() or c == '_'),
+}
+
+
+def find_backtracking_risks(pattern):
+    """Check a regex for constructs prone to catastrophic backtracking.
+
+    This looks for unbounded repetitions of subpatterns which can
+    match the same text in many different ways, i.e. nested
+    quantifiers such as ``(\\w+\\s?)+``, adjacent quantifiers with
+    overlapping characters such as ``(\\d+\\w+)*`` and alternatives
+    starting with the same characters such as ``(\\d+|\\w+)*``.  A
+    mismatch near the end of a long line may then take exponential
+    time.  This is a heuristic; it may miss some problematic regexps.
+
+    :param pattern: The regex string
+    :return: A sorted list of the problems found
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        # invalid regexps are reported when compiling them
+        return []
+    risks = set()
+    _check_items(list(parsed), False, risks)
+    return sorted(risks)
+
+
+def _check_items(items, in_repeat, risks):
+    for op, av in items:
+        if op in _REPEATS:
+            lo, hi, body = av
+            body = list(body)
+            unbounded = hi == sre_parse.MAXREPEAT
+            if unbounded:
+                _check_repeated_body(body, risks)
+            _check_items(body, in_repeat or unbounded, risks)
+        elif op == sre_parse.SUBPATTERN:
+            _check_items(list(av[-1]), in_repeat, risks)
+        elif op == sre_parse.BRANCH:
+            alternatives = [list(x) for x in av[1]]
+            # a common prefix of the alternatives is moved in front of
+            # the branch, so e.g. ``(a|a)`` becomes ``a(?:|)``
+            empty = sum(_min_width(x) == 0 for x in alternatives)
+            if in_repeat and (empty > 1 or _overlapping(*alternatives)):
+                risks.add('ambiguous alternation')
+            for alternative in alternatives:
+                _check_items(alternative, in_repeat, risks)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            _check_items(list(av[1]), in_repeat, risks)
+        elif op == sre_parse.GROUPREF_EXISTS:
+            for branch in av[1:]:
+                if branch is not None:
+                    _check_items(list(branch), in_repeat, risks)
+        # atomic groups and possessive quantifiers never backtrack
+
+
+def _check_repeated_body(body, risks):
+    """Check the body of an unbounded repetition."""
+    body = _flatten(body)
+    variable = [i for i, item in enumerate(body) if _is_variable(item)]
+    for i in variable:
+        if all(_min_width([item]) == 0 for j, item in enumerate(body) if j != i):
+            risks.add('nested quantifier')
+    for i, j in zip(variable, variable[1:]):
+        if j == i + 1 and _overlapping([body[i]], [body[j]]):
+            risks.add('adjacent quantifiers')
+
+
+def _flatten(items):
+    """Inline plain groups so their contents can be checked."""
+    rv = []
+    for op, av in items:
+        if op == sre_parse.SUBPATTERN:
+            rv += _flatten(list(av[-1]))
+        else:
+            rv.append((op, av))
+    return rv
+
+
+def _is_variable(item):
+    op, av = item
+    return op in _REPEATS and av[0] != av[1] and _max_width(list(av[2])) > 0
+
+
+def _min_width(items):
+    width = 0
+    for op, av in items:
+        if op in _REPEATS:
+            width += av[0] * _min_width(list(av[2]))
+        elif op == sre_parse.SUBPATTERN:
+            width += _min_width(list(av[-1]))
+        elif op == sre_parse.BRANCH:
+            width += min(_min_width(list(x)) for x in av[1])
+        elif op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.IN, sre_parse.ANY):
+            width += 1
+    return width
+
+
+def _max_width(items):
+    width = 0
+    for op, av in items:
+        if op in _REPEATS:
+            width += av[1] * _max_width(list(av[2]))
+        elif op == sre_parse.SUBPATTERN:
+            width += _max_width(list(av[-1]))
+        elif op == sre_parse.BRANCH:
+            width += max(_max_width(list(x)) for x in av[1])
+        elif op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.IN, sre_parse.ANY):
+            width += 1
+    return width
+
+
+def _first_chars(items):
+    """Get the sample characters a sequence can start with.
+
+    :return: A set of characters or ``None`` if unknown
+    """
+    if not items:
+        return None
+    op, av = items[0]
+    if op in _REPEATS:
+        return _first_chars(list(av[2]))
+    elif op == sre_parse.SUBPATTERN:
+        return _first_chars(list(av[-1]))
+    elif op == sre_parse.BRANCH:
+        chars = [_first_chars(list(x)) for x in av[1]]
+        return set().union(*chars) if None not in chars else None
+    elif op == sre_parse.LITERAL:
+        return {chr(av)}
+    elif op == sre_parse.NOT_LITERAL:
+        return {c for c in _SAMPLE_CHARS if c != chr(av)}
+    elif op == sre_parse.ANY:
+        return {c for c in _SAMPLE_CHARS if c != '\n'}
+    elif op == sre_parse.IN:
+        return {c for c in _SAMPLE_CHARS if _in_set(av, c)}
+    return None
+
+
+def _in_set(items, char):
+    negate = False
+    found = False
+    for op, av in items:
+        if op == sre_parse.NEGATE:
+            negate = True
+        elif op == sre_parse.LITERAL:
+            found = found or char == chr(av)
+        elif op == sre_parse.RANGE:
+            found = found or av[0] <= ord(char) <= av[1]
+        elif op == sre_parse.CATEGORY:
+            found = found or _CATEGORIES.get(av, lambda c: False)(char)
+    return found != negate
+
+
+def _overlapping(*sequences):
+    seen = set()
+    for sequence in sequences:
+        chars = _first_chars(sequence)
+        if chars is None:
+            continue
+        elif chars & seen:
+            return True
+        seen |= chars
+    return False
+
+
+def guard_regex(regex, name, slow_match):
+    """Check a compiled regex and guard it against slow matches.
+
+    If the regex looks prone to catastrophic backtracking, a warning
+    is shown and - unless `slow_match` is ``None`` - the regex is
+    wrapped in a `GuardedRegex`.  Other regexps are returned as they
+    are so they do not have any overhead.
+
+    :param regex: A compiled regex
+    :param name: The name used to refer to the regex in messages
+    :param slow_match: The number of seconds after which a match is
+                       considered slow
+    """
+    risks = find_backtracking_risks(regex.pattern)
+    if not risks:
+        return regex
+    warning_echo('{} may cause catastrophic backtracking ({})'.format(name, ', '.join(risks)))
+    if slow_match is None:
+        return regex
+    return GuardedRegex(regex, name, slow_match)
+
+
+class GuardedRegex(object):
+    """A regex which is disabled after a slow match.
+
+    Each match is timed, and if one takes longer than `slow_match`
+    seconds, the offending line is reported and the regex does not
+    match anything anymore for the rest of the run.  Since a running
+    match cannot be interrupted, this does not help if a single match
+    takes forever, but it avoids spending the time again on every
+    similar line.
+
+    :param regex: A compiled regex
+    :param name: The name used to refer to the regex in messages
+    :param slow_match: The number of seconds after which a match is
+                       considered slow
+    """
+
+    def __init__(self, regex, name, slow_match):
+        self.regex = regex
+        self.name = name
+        self.slow_match = slow_match
+
+    def __repr__(self):
+        return '<GuardedRegex({!r}{})>'.format(self.regex.pattern, ', quarantined' if self.quarantined else '')
+
+    @property
+    def quarantined(self):
+        return self in _current_quarantine()
+
+    @property
+    def pattern(self):
+        return self.regex.pattern
+
+    @property
+    def groupindex(self):
+        return self.regex.groupindex
+
+    def match(self, string):
+        if self.quarantined:
+            return None
+        start = time.perf_counter()
+        rv = self.regex.match(string)
+        elapsed = time.perf_counter() - start
+        if elapsed >= self.slow_match:
+            _current_quarantine().add(self)
+            warning_echo('{} took {:.1f}s to match a line and is disabled for the rest of the run: {}'.format(
+                self.name, elapsed, string[:200]))
+        return rv
+
+
+@contextmanager
+def quarantine_scope():
+    """Start a run in which no `GuardedRegex` is quarantined.
+
+    The quarantine only lasts until the end of the run, so a regex
+    that was slow on some line is used again by the next run even if
+    the same config is reused.
+    """
+    token = _quarantine.set(set())
+    try:
+        yield
+    finally:
+        _quarantine.reset(token)
+
+
+def reset_quarantine():
+    """Stop quarantining all regexps in the current run."""
+    _current_quarantine().clear()
+
+
+def _current_quarantine():
+    quarantine = _quarantine.get()
+    return quarantine if quarantine is not None else _global_quarantine
+
+
+#: The regexps quarantined outside a `quarantine_scope`
+_global_quarantine = set()
+_quarantine = ContextVar('logstapo_quarantine', default=None)
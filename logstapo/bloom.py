@@ -0,0 +1,118 @@
+import hashlib
+import math
+import os
+import struct
+
+from logstapo.util import debug_echo, warning_echo
+
+
+_MAGIC = b'LSB1'
+#: number of hash functions, number of items
+_HEADER = struct.Struct('<4sQQ')
+#: Number of bit positions checked for each item
+HASH_COUNT = 7
+
+
+class BloomFilter(object):
+    """A fixed-size set of lines which have been read from a logfile.
+
+    The filter only stores a few bits per line, so it may claim that
+    a line has been added although it has not; with `capacity` lines
+    this happens for about 1% of the lines.  Once the filter reaches
+    its capacity, no further lines are added to keep that rate low.
+
+    It is stored next to the offset file so the lines which have
+    already been handled can be recognized when the offset file is
+    lost and the logfile needs to be read from the beginning again.
+
+    :param path: The path of the filter file
+    :param size: The size of the filter in bytes
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.bits = bytearray(size)
+        self.nbits = size * 8
+        #: The number of lines which can be added
+        self.capacity = int(self.nbits * math.log(2) / HASH_COUNT)
+        #: The number of lines which have been added
+        self.count = 0
+        self._dirty = False
+        self._load()
+
+    def __repr__(self):
+        return '<BloomFilter({!r}, count={})>'.format(self.path, self.count)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as exc:
+            warning_echo('Could not read filter {} ({})'.format(self.path, exc))
+            return
+        if len(data) != _HEADER.size + self.size:
+            debug_echo('ignoring filter with a different size ' + self.path)
+            return
+        magic, hash_count, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC or hash_count != HASH_COUNT:
+            debug_echo('ignoring invalid filter ' + self.path)
+            return
+        self.bits[:] = data[_HEADER.size:]
+        self.count = count
+
+    def _positions(self, line):
+        value = int.from_bytes(hashlib.blake2b(line, digest_size=16).digest(), 'little')
+        first = value & 0xffffffffffffffff
+        # a zero step would use the same position for all hashes
+        step = (value >> 64) | 1
+        return [(first + i * step) % self.nbits for i in range(HASH_COUNT)]
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def __contains__(self, line):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(line))
+
+    def add(self, line):
+        """Add a line to the filter.
+
+        :param line: The line as bytes
+        """
+        if self.full:
+            return
+        bits = self.bits
+        for pos in self._positions(line):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+        self._dirty = True
+        if self.full:
+            debug_echo('filter {} is full', self.path)
+
+    def clear(self):
+        """Remove all lines, e.g. because a new logfile is read."""
+        if self.count:
+            debug_echo('clearing filter ' + self.path)
+            self.bits[:] = bytes(self.size)
+            self.count = 0
+            self._dirty = True
+
+    def save(self):
+        """Write the filter to disk if it changed."""
+        if not self._dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                os.fchmod(f.fileno(), 0o600)
+                f.write(_HEADER.pack(_MAGIC, HASH_COUNT, self.count))
+                f.write(self.bits)
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            warning_echo('Could not write filter {} ({})'.format(self.path, exc))
+        else:
+            self._dirty = False
@@ -1,45 +1,118 @@
+import sys
+
 import click
 
 from logstapo import __version__
-from logstapo.core import run
+from logstapo.core import follow, run
 from logstapo.defaults import CONFIG_FILE_PATH
-from logstapo.config import ConfigError, parse_config, process_config
+from logstapo.config import Config, ConfigError, parse_config, process_config, use_config
+from logstapo.replay import build_tasks, format_diff, format_stats, replay_logs
+from logstapo.timestamps import parse_time_arg
 from logstapo.util import error_echo
 
 
-def _config_callback(ctx, param, value):
+def _load_config(ctx, file):
     try:
-        data = parse_config(value)
-        config = process_config(data)
+        return process_config(parse_config(file))
     except ConfigError as exc:
         error_echo('Could not load config file')
         error_echo(str(exc))
         ctx.exit(1)
-    else:
-        config['verbosity'] = ctx.params['verbose']
-        config['debug'] = ctx.params['debug']
-        config['dry_run'] = ctx.params['dry_run']
-        return config
 
 
-@click.command(context_settings={'help_option_names': ('-h', '--help')})
+def _config_callback(ctx, param, value):
+    config = _load_config(ctx, value)
+    return Config.from_dict(dict(config, verbosity=ctx.params['verbose'], debug=ctx.params['debug'],
+                                 dry_run=ctx.params['dry_run'], since=ctx.params['since'], until=ctx.params['until']))
+
+
+def _time_callback(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_time_arg(value)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+
+
+@click.group(context_settings={'help_option_names': ('-h', '--help')}, invoke_without_command=True)
 @click.option('-c', '--config', type=click.File(), callback=_config_callback, default=CONFIG_FILE_PATH,
               help="The path to the application's config file")
 @click.option('-n', '--dry-run', is_flag=True, is_eager=True,
               help="Perform a dry run (not modifying any offset files or executing actions)")
 @click.option('-v', '--verbose', count=True, is_eager=True, type=click.IntRange(min=0, max=2),
               help="Enable more verbose output; can be specified up to 2 times.")
+@click.option('-f', '--follow', 'follow_logs', is_flag=True,
+              help="Keep running and process new log entries as soon as they are written")
 @click.option('-d', '--debug', is_flag=True, is_eager=True,
               help="Enable debug output (very spammy); implies -vv")
+@click.option('--since', callback=_time_callback, is_eager=True, metavar='TIME',
+              help="Ignore the stored offsets and process all entries logged since TIME, e.g. "
+                   "'2017-01-02 03:04', '02:00' or '2h'; the offsets are not updated")
+@click.option('--until', callback=_time_callback, is_eager=True, metavar='TIME',
+              help="Only process entries logged before TIME; the offsets are not updated")
 @click.version_option(__version__, '-V', '--version')
-def main(**kwargs):
+@click.pass_context
+def main(ctx, config, follow_logs, **kwargs):
     """
     Logstapo is a tool that checks new entries in log files and
     performs actions based on them.
     """
-    # kwargs is not used as the config is taken from the click context
-    # to avoid passing it around all the time
-    run()
+    if ctx.invoked_subcommand is not None:
+        return
+    # the other options are already part of the config
+    if follow_logs and (config.since is not None or config.until is not None):
+        raise click.UsageError('--since and --until cannot be used with --follow')
+    if not (follow(config) if follow_logs else run(config)):
+        sys.exit(1)
+
+
+@main.command()
+@click.option('-l', '--log', 'names', multiple=True, metavar='NAME',
+              help="Only replay the specified log; can be specified multiple times")
+@click.option('--compare', type=click.File(), metavar='CONFIG',
+              help="Compare the results with those of another config file")
+@click.option('-j', '--jobs', type=click.IntRange(min=1),
+              help="The number of files processed in parallel (default: number of CPUs)")
+@click.option('--top', type=click.IntRange(min=0), default=10, show_default=True,
+              help="The number of unusual templates shown for each log")
+@click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def replay(ctx, names, compare, jobs, top, files):
+    """Evaluate the rules of the config on existing logfiles.
+
+    The configured logfiles and all their rotated generations are
+    processed, but no offsets are used or updated and no actions are
+    performed.  Instead, statistics about the log entries and the
+    patterns matching them are shown.
+
+    If FILES are given, they are processed instead of the configured
+    files using the rules of the log specified with --log.
+    """
+    config = ctx.parent.params['config']
+    invalid = next((name for name in names if name not in config.logs), None)
+    if invalid is not None:
+        raise click.UsageError('Invalid log: {}'.format(invalid))
+    if files and len(names) != 1:
+        raise click.UsageError('FILES require exactly one --log')
+    names = names or sorted(config.logs)
+    other = _load_config(ctx, compare) if compare is not None else None
+    with use_config(config):
+        tasks = {(name, 0): task for name, task in build_tasks(config, names, files or None).items()}
+        if other is not None:
+            # the other config is applied to the same files
+            for name in names:
+                if name in other['logs']:
+                    tasks[name, 1] = build_tasks(other, [name], tasks[name, 0][2])[name]
+    results = replay_logs(tasks, jobs, config['settings']['max_line_length'])
+    for name in names:
+        if other is None:
+            lines = format_stats(name, results[name, 0], top)
+        elif (name, 1) not in results:
+            lines = ["Log '{}' does not exist in {}".format(name, compare.name)]
+        else:
+            lines = format_diff(name, results[name, 0], results[name, 1], top)
+        click.echo('\n'.join(lines))
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -1,11 +1,18 @@
 import itertools
 import re
 from collections import UserDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from contextvars import ContextVar
 from copy import deepcopy
+from functools import partial, wraps
+from types import MappingProxyType
 
 import click
 import yaml
 
+from logstapo.backtracking import guard_regex
+from logstapo.defaults import DEFAULT_SETTINGS
 from logstapo.util import warning_echo, ensure_collection, combine_placeholders
 
 
@@ -14,16 +21,103 @@ INITIAL_CONFIG = {'verbosity': 0,
                   'dry_run': False,
                   'regexps': {},
                   'logs': {},
-                  'actions': {}}
+                  'actions': {},
+                  'settings': {}}
 
 
 class ConfigError(Exception):
     pass
 
 
+class Config(object):
+    """The processed configuration of logstapo.
+
+    Config objects are immutable; use `replace` to get a copy with
+    different values.  This includes the nested data such as the log
+    definitions, whose dicts and lists become read-only dicts and
+    tuples.  For compatibility with code using the config dict, values
+    can also be accessed using ``config[key]``.
+    """
+
+    __slots__ = ('verbosity', 'debug', 'dry_run', 'since', 'until', 'regexps', 'logs', 'actions', 'settings')
+
+    def __init__(self, *, regexps, logs, actions, settings, verbosity=0, debug=False, dry_run=False, since=None,
+                 until=None):
+        set_ = partial(object.__setattr__, self)
+        set_('verbosity', verbosity)
+        set_('debug', debug)
+        set_('dry_run', dry_run)
+        set_('since', since)
+        set_('until', until)
+        set_('regexps', MappingProxyType(dict(regexps)))
+        set_('logs', MappingProxyType({name: _freeze(data) for name, data in logs.items()}))
+        set_('actions', MappingProxyType(dict(actions)))
+        set_('settings', MappingProxyType({name: _freeze(value) for name, value in settings.items()}))
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a config object from a dict.
+
+        :param data: A dict as returned by `process_config`, optionally
+                     containing `verbosity`, `debug`, `dry_run`, `since`
+                     and `until`
+        """
+        return cls(**data)
+
+    def __repr__(self):
+        return '<Config(logs={}, verbosity={}, debug={}, dry_run={})>'.format(
+            ', '.join(sorted(self.logs)), self.verbosity, self.debug, self.dry_run)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('config objects are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('config objects are immutable')
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def replace(self, **kwargs):
+        """Get a copy of the config with some values replaced."""
+        data = {key: getattr(self, key) for key in self.__slots__}
+        data.update(kwargs)
+        return type(self)(**data)
+
+
+class _FrozenDict(dict):
+    # unlike a MappingProxyType this can be pickled, which is needed to
+    # pass log definitions to the processes used when replaying logs
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('config objects are immutable')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+
+def _freeze(value):
+    if isinstance(value, Mapping):
+        return _FrozenDict((key, _freeze(item)) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    elif isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
 class _Pattern(object):
-    def __init__(self, pattern=None):
+    def __init__(self, pattern=None, slow_match=None):
         self.pattern = pattern
+        self.slow_match = slow_match
         self.negate = False
         self.regex = None
         self.always_match = pattern is None
@@ -42,16 +136,21 @@ class _Pattern(object):
         if pattern[0] == '/' and pattern[-1] == '/':
             # regex
             regex_pattern = pattern[1:-1]
+            self.regex = guard_regex(re.compile('^{}$'.format(regex_pattern)), "pattern '{}'".format(self.pattern),
+                                     self.slow_match)
         else:
             # glob
             regex_pattern = re.escape(pattern).replace(r'\?', '.').replace(r'\*', '.*')
-        self.regex = re.compile('^{}$'.format(regex_pattern))
+            self.regex = re.compile('^{}$'.format(regex_pattern))
 
     def test(self, string):
         if self.always_match:
             return not self.negate
-        found = self.regex.match(string) is not None
-        return found ^ self.negate
+        match = self.regex.match(string)
+        if match is None and getattr(self.regex, 'quarantined', False):
+            # a disabled regex must not make a negated pattern match everything
+            return False
+        return (match is not None) ^ self.negate
 
     def __repr__(self):
         if self.always_match:
@@ -74,7 +173,7 @@ def parse_config(file):
         raise ConfigError('yaml parse error: {}'.format(exc))
 
 
-def _process_regexps(data):
+def _process_regexps(data, slow_match=None):
     placeholders = {name[2:]: regex for name, regex in data.items() if name.startswith('__')}
     regexps = {}
     for name, regex in data.items():
@@ -90,11 +189,116 @@ def _process_regexps(data):
             raise ConfigError('regex could not be compiled: {} ({})\n{}'.format(name, exc, regex))
         if set(compiled.groupindex) < {'source', 'message'}:
             raise ConfigError("regex must contain named groups 'source' and 'message': {}".format(name))
-        regexps[name] = compiled
+        regexps[name] = guard_regex(compiled, "regex '{}'".format(name), slow_match)
     return regexps
 
 
-def _process_actions(data):
+def _process_limit(data, key, allow_none=True):
+    value = data.get(key)
+    if value is None and allow_none:
+        return None
+    elif not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+        raise ConfigError('{} must be a positive integer'.format(key))
+    return value
+
+
+def _process_seconds(data, key, allow_none=False):
+    value = data.get(key)
+    if value is None and allow_none:
+        return None
+    elif not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+        raise ConfigError('{} must be a positive number'.format(key))
+    return value
+
+
+def _process_path(data, key):
+    value = data.get(key)
+    if value is not None and (not isinstance(value, str) or not value):
+        raise ConfigError('{} must be a path'.format(key))
+    return value
+
+
+def _process_summarize(data):
+    value = data.get('summarize')
+    if value is None or value is False:
+        return None
+    elif value is True:
+        return 100
+    return _process_limit(data, 'summarize')
+
+
+def _process_multiline(data):
+    value = data.get('multiline')
+    if value is None or value is False:
+        return None
+    elif isinstance(value, str):
+        value = {'continuation': value}
+    elif not isinstance(value, dict):
+        raise ConfigError('multiline must be a string or a dict')
+    invalid = next((x for x in sorted(value) if x not in {'continuation', 'max_lines', 'max_chars'}), None)
+    if invalid is not None:
+        raise ConfigError('invalid multiline option: {}'.format(invalid))
+    continuation = value.get('continuation')
+    if not isinstance(continuation, str) or not continuation:
+        raise ConfigError('multiline continuation must be indent, unmatched or a regex')
+    elif continuation not in {'indent', 'unmatched'}:
+        try:
+            continuation = re.compile(continuation)
+        except re.error as exc:
+            raise ConfigError('multiline regex could not be compiled: {}'.format(exc))
+    value = dict({'max_lines': 500, 'max_chars': 65536}, **value)
+    return {'continuation': continuation,
+            'max_lines': _process_limit(value, 'max_lines', allow_none=False),
+            'max_chars': _process_limit(value, 'max_chars', allow_none=False)}
+
+
+def _process_bool(data, key):
+    value = data.get(key)
+    if not isinstance(value, bool):
+        raise ConfigError('{} must be a boolean'.format(key))
+    return value
+
+
+def _process_settings(data):
+    if not isinstance(data, dict):
+        raise ConfigError('settings is not a dict: received {}'.format(type(data)))
+    invalid = next((x for x in sorted(data) if x not in DEFAULT_SETTINGS), None)
+    if invalid is not None:
+        raise ConfigError('invalid setting: {}'.format(invalid))
+    settings = dict(DEFAULT_SETTINGS, **data)
+    try:
+        for key, func in _SETTING_PROCESSORS.items():
+            settings[key] = func(settings, key)
+    except ConfigError as exc:
+        raise ConfigError('invalid setting: {}'.format(exc)) from exc
+    return settings
+
+
+_SETTING_PROCESSORS = {
+    'checkpoint_bytes': _process_limit,
+    'spool': _process_path,
+    'spool_attempts': partial(_process_limit, allow_none=False),
+    'spool_backoff': _process_seconds,
+    'spool_max_attempts': _process_limit,
+    'action_timeout': partial(_process_seconds, allow_none=True),
+    'dedup': _process_path,
+    'dedup_window': _process_seconds,
+    'dedup_max_entries': partial(_process_limit, allow_none=False),
+    'flush_lines': partial(_process_limit, allow_none=False),
+    'flush_interval': _process_seconds,
+    'poll_interval': _process_seconds,
+    'io_rate': _process_limit,
+    'drop_cache': _process_bool,
+    'io_idle': _process_bool,
+    'parse_warnings': _process_limit,
+    'index_interval': _process_limit,
+    'max_line_length': _process_limit,
+    'seen_filter': _process_limit,
+    'slow_match': partial(_process_seconds, allow_none=True),
+}
+
+
+def _process_actions(data, default_timeout=None):
     from logstapo.actions import Action
     auto_actions = set()
     actions = {}
@@ -107,7 +311,9 @@ def _process_actions(data):
         if actiondata.pop('auto', True):
             auto_actions.add(name)
         try:
-            actions[name] = Action.from_config(type_, actiondata)
+            timeout = _process_seconds({'timeout': actiondata.pop('timeout', default_timeout)}, 'timeout',
+                                       allow_none=True)
+            actions[name] = Action.from_config(type_, actiondata, timeout)
         except ConfigError as exc:
             raise ConfigError('invalid action definition ({}): {}'.format(name, exc)) from exc
     return actions, auto_actions
@@ -140,27 +346,27 @@ def _process_log_actions(logdata, name, auto_actions, available):
     return actions
 
 
-def _unify_patterns(value):
+def _unify_patterns(value, slow_match=None):
     if not value:
         return []
     elif isinstance(value, str):
-        return [_Pattern(value)]
+        return [_Pattern(value, slow_match)]
     else:
-        return list(map(_Pattern, value))
+        return [_Pattern(x, slow_match) for x in value]
 
 
-def _unify_nested_patterns(value):
+def _unify_nested_patterns(value, slow_match=None):
     if not value:
         return {}
     elif isinstance(value, str):
-        return {_Pattern(): [_Pattern(value)]}
+        return {_Pattern(): [_Pattern(value, slow_match)]}
     elif isinstance(value, dict):
-        return {_Pattern(key): _unify_patterns(value) for key, value in value.items()}
+        return {_Pattern(key, slow_match): _unify_patterns(value, slow_match) for key, value in value.items()}
     else:
-        return {_Pattern(): _unify_patterns(value)}
+        return {_Pattern(): _unify_patterns(value, slow_match)}
 
 
-def _process_logs(data, config_regexps, config_actions, auto_actions):
+def _process_logs(data, config_regexps, config_actions, auto_actions, slow_match=None):
     logs = {}
     for name, logdata in data.items():
         try:
@@ -169,10 +375,19 @@ def _process_logs(data, config_regexps, config_actions, auto_actions):
             # regexps
             regexps = _process_log_regexps(logdata, name, config_regexps)
             # patterns
-            garbage = _unify_patterns(logdata.get('garbage'))
-            ignore = _unify_nested_patterns(logdata.get('ignore'))
+            garbage = _unify_patterns(logdata.get('garbage'), slow_match)
+            ignore = _unify_nested_patterns(logdata.get('ignore'), slow_match)
             # actions
             actions = _process_log_actions(logdata, name, auto_actions, config_actions)
+            # limits
+            max_bytes = _process_limit(logdata, 'max_bytes')
+            max_seconds = _process_seconds(logdata, 'max_seconds', allow_none=True)
+            # schedule
+            interval = _process_seconds(logdata, 'interval', allow_none=True)
+            # summary
+            summarize = _process_summarize(logdata)
+            # multi-line entries
+            multiline = _process_multiline(logdata)
         except ConfigError as exc:
             raise ConfigError('invalid log definition ({}): {}'.format(name, exc)) from exc
         if not actions:
@@ -181,7 +396,12 @@ def _process_logs(data, config_regexps, config_actions, auto_actions):
                       'regexps': regexps,
                       'garbage': garbage,
                       'ignore': ignore,
-                      'actions': tuple(sorted(actions))}
+                      'actions': tuple(sorted(actions)),
+                      'max_bytes': max_bytes,
+                      'max_seconds': max_seconds,
+                      'interval': interval,
+                      'summarize': summarize,
+                      'multiline': multiline}
     return logs
 
 
@@ -200,16 +420,78 @@ def process_config(data):
         regexps = data['regexps']
         logs = data['logs']
         actions = data.get('actions') or {}
+        settings = data.get('settings') or {}
     except KeyError as exc:
         raise ConfigError('required section missing: {}'.format(exc))
     except TypeError:
         raise ConfigError('config is not a dict: received {}'.format(type(data)))
-    config['regexps'] = _process_regexps(regexps)
-    config['actions'], auto_actions = _process_actions(actions)
-    config['logs'] = _process_logs(logs, config['regexps'], config['actions'], auto_actions)
+    config['settings'] = _process_settings(settings)
+    slow_match = config['settings']['slow_match']
+    config['regexps'] = _process_regexps(regexps, slow_match)
+    config['actions'], auto_actions = _process_actions(actions, config['settings']['action_timeout'])
+    config['logs'] = _process_logs(logs, config['regexps'], config['actions'], auto_actions, slow_match)
     return config
 
 
+def load_config(path, *, verbosity=0, debug=False, dry_run=False):
+    """Load a config file.
+
+    :param path: The path of the YAML config file
+    :param verbosity: The verbosity level (0-2)
+    :param debug: Whether to enable debug output
+    :param dry_run: Whether to perform a dry run
+    :return: A `Config` object
+    :raise ConfigError: If the config file is invalid
+    """
+    with open(path) as f:
+        data = parse_config(f)
+    return Config.from_dict(dict(process_config(data), verbosity=verbosity, debug=debug, dry_run=dry_run))
+
+
+@contextmanager
+def use_config(config):
+    """Make a config the current config.
+
+    While the context is active, `current_config` refers to `config`
+    instead of the config stored in the click context.
+
+    :param config: A `Config` object
+    """
+    token = _active_config.set(config)
+    try:
+        yield config
+    finally:
+        _active_config.reset(token)
+
+
+def bind_config(func):
+    """Make the current config available when `func` runs in a thread.
+
+    The config is stored in a context variable or the click context,
+    which are both thread-local, so functions executed in a different
+    thread need to use the config of the thread that started them.
+    """
+    config = _active_config.get()
+    if config is not None:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with use_config(config):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    ctx = click.get_current_context(silent=True)
+    if ctx is None:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with ctx.scope(cleanup=False):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
 class _ConfigDict(UserDict):
     # noinspection PyMissingConstructor
     def __init__(self):
@@ -218,7 +500,11 @@ class _ConfigDict(UserDict):
 
     @property
     def data(self):
+        config = _active_config.get()
+        if config is not None:
+            return config
         return click.get_current_context().params['config']
 
 
+_active_config = ContextVar('logstapo_config', default=None)
 current_config = _ConfigDict()
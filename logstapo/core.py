@@ -1,8 +1,259 @@
-from logstapo.actions import run_actions
-from logstapo.logs import process_logs
+import math
+import signal
+import time
 
+from logstapo.actions import run_actions, smtp_pool
+from logstapo.backtracking import quarantine_scope, reset_quarantine
+from logstapo.config import current_config, use_config
+from logstapo.dedup import DedupCache
+from logstapo.follow import create_watcher
+from logstapo.logs import LogLocks, get_due_logs, process_logs
+from logstapo.logtail import commit_offsets
+from logstapo.spool import Spool, SpoolDelivery, spool_results
+from logstapo.util import buffered_output, debug_echo, flush_output, set_idle_io_priority
 
-def run():
-    """Run logstapo on all configured logs and perform actions"""
-    results = process_logs()
-    run_actions(results)
+
+def run(config=None):
+    """Run logstapo on all configured logs and perform actions
+
+    The offsets of a log are only updated after all its actions
+    succeeded, so lines are not lost if e.g. sending an email fails.
+    Large backlogs are processed in chunks of ``checkpoint_bytes``
+    per file, running the actions and committing the offsets after
+    each chunk.
+
+    If a spool file is configured, the results are stored there and
+    delivered in a background thread while the logs are processed.
+    In this case the offsets are committed as soon as the results
+    have been spooled.
+
+    Emails sent to the same SMTP server share a single connection.
+
+    If a dedup cache is configured, entries which have already been
+    reported recently are not passed to the actions again.
+
+    Logs with an `interval` are skipped unless they are due.  Logs
+    which are currently processed by another instance are skipped as
+    well.
+
+    If the config has a `since` time, the stored offsets are ignored
+    and all logs are read starting with the first entry logged at that
+    time.  If it has an `until` time, reading stops after the last
+    entry logged before that time.  Such a run does not update the
+    stored offsets, so it neither skips entries nor causes them to be
+    read again during the next regular run.
+
+    :param config: The `Config` to use.  If omitted, the config from
+                   the click context is used.
+    :return: ``True`` if all actions succeeded, ``False`` otherwise
+    """
+    if config is None:
+        config = current_config.data
+    with use_config(config), quarantine_scope(), buffered_output(), smtp_pool, LogLocks() as locks:
+        # in a dry run nothing is written, so there is no need to lock
+        return _run(locks if not config['dry_run'] else None)
+
+
+def follow(config=None):
+    """Keep running and process new log entries as they are written.
+
+    The logfiles are watched using inotify (or polled if inotify is
+    not available).  New entries are collected and passed to the
+    actions once ``flush_lines`` entries have been collected or
+    ``flush_interval`` seconds after the first one.  The offsets are
+    committed after each flush, so no entries are lost when restarting.
+    If the actions of a log fail, its entries are read again and
+    retried during the next flush.  The last entry of a log with
+    multi-line entries is kept back for up to ``flush_interval``
+    seconds in case more lines of it are written.  Regexps disabled
+    due to a slow match are enabled again after each flush, and the
+    warnings about unparsable lines are summarized then.
+
+    The process stops after receiving SIGINT or SIGTERM, flushing
+    any collected entries first.  Logs are locked while running, so
+    regular runs skip them.  Logs locked by another instance when
+    starting are checked again whenever a logfile changes.
+
+    :param config: The `Config` to use.  If omitted, the config from
+                   the click context is used.  It cannot have a time
+                   range.
+    :return: ``True`` if all actions succeeded, ``False`` otherwise
+    """
+    if config is None:
+        config = current_config.data
+    if config['since'] is not None or config['until'] is not None:
+        raise ValueError('follow mode does not support a time range')
+    with use_config(config), quarantine_scope(), buffered_output(), smtp_pool, LogLocks() as locks:
+        return _follow(locks if not config['dry_run'] else None)
+
+
+def _start():
+    config = current_config.data
+    settings = config['settings']
+    delivery = None
+    dedup = None
+    if settings['io_idle']:
+        set_idle_io_priority()
+    if settings['spool'] and not config['dry_run']:
+        spool = Spool(settings['spool'], settings['spool_max_attempts'])
+        delivery = SpoolDelivery(spool, settings['spool_attempts'], settings['spool_backoff'])
+        delivery.start()
+    if settings['dedup']:
+        dedup = DedupCache(settings['dedup'], settings['dedup_window'], settings['dedup_max_entries'])
+    return delivery, dedup
+
+
+def _finish(delivery, dedup, success):
+    if dedup is not None and not current_config['dry_run']:
+        dedup.save()
+    if delivery is not None:
+        success = delivery.finish() and success
+    return success
+
+
+def _handle_results(results, pending, delivery, dedup):
+    """Pass results to the actions and commit the offsets.
+
+    :return: A set containing the names of all logs whose actions
+             failed.  Their offsets have not been committed.
+    """
+    config = current_config.data
+    if dedup is not None:
+        results = {name: (dedup.filter(name, lines), invalid) for name, (lines, invalid) in results.items()}
+    if delivery is not None:
+        failed = spool_results(delivery.spool, results)
+        delivery.wake()
+    else:
+        failed = run_actions(results)
+    # a time range may end before (or start after) the stored offsets
+    if not config['dry_run'] and config['since'] is None and config['until'] is None:
+        for name, states in sorted(pending.items()):
+            if name not in failed:
+                commit_offsets(states)
+    if dedup is not None:
+        dedup.commit(set(pending) - failed)
+    return failed
+
+
+def _has_more(pending):
+    return any(state['more'] for states in pending.values() for state in states.values())
+
+
+def _has_read(pending):
+    return any(state['read'] for states in pending.values() for state in states.values())
+
+
+def _has_held(pending):
+    return any(state.get('held') for states in pending.values() for state in states.values())
+
+
+def _reset_more(pending):
+    for states in pending.values():
+        for state in states.values():
+            state['more'] = False
+
+
+def _finish_warnings(warnings):
+    for parse_warnings in warnings.values():
+        parse_warnings.finish()
+    warnings.clear()
+
+
+def _run(locks):
+    delivery, dedup = _start()
+    pending = {}
+    # the unparsable lines are summarized once for all chunks
+    warnings = {}
+    # when reading a time range the intervals do not matter
+    names = get_due_logs() if current_config['since'] is None else sorted(current_config['logs'])
+    success = True
+    while names:
+        _reset_more(pending)
+        results = process_logs(names, pending=pending, locks=locks, warnings=warnings)
+        failed = _handle_results(results, pending, delivery, dedup)
+        for name in failed:
+            # do not commit the offsets of these logs with the next chunk
+            pending.pop(name, None)
+        success = success and not failed
+        names = sorted(name for name, states in pending.items()
+                       if name not in failed and any(state['more'] for state in states.values()))
+    _finish_warnings(warnings)
+    return _finish(delivery, dedup, success)
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _follow(locks):
+    config = current_config.data
+    settings = config['settings']
+    paths = sorted({path for data in config['logs'].values() for path in data['files']})
+    delivery, dedup = _start()
+    watcher = create_watcher(paths, settings['poll_interval'])
+    debug_echo('watching logfiles using {!r}', watcher)
+    prev_handler = signal.signal(signal.SIGTERM, _interrupt)
+    pending = {}
+    warnings = {}
+    batch = {}
+    batch_size = 0
+    deadline = None
+    success = True
+
+    def _flush():
+        if dedup is not None:
+            dedup.now = time.time()
+        _finish_warnings(warnings)
+        failed = _handle_results(batch, pending, delivery, dedup)
+        for name in failed:
+            # read the entries again from the committed offset
+            del pending[name]
+        for states in pending.values():
+            for state in states.values():
+                state['read'] = 0
+                state['elapsed'] = 0
+        if dedup is not None and not config['dry_run']:
+            dedup.save()
+        # regexps disabled due to a slow match get another chance after each flush
+        reset_quarantine()
+        return not failed
+
+    try:
+        while True:
+            _reset_more(pending)
+            results = process_logs(pending=pending, locks=locks, warnings=warnings,
+                                   hold_open=settings['flush_interval'])
+            for name, (lines, invalid) in results.items():
+                if lines or invalid:
+                    batched = batch.setdefault(name, ([], []))
+                    batched[0].extend(lines)
+                    batched[1].extend(invalid)
+                    batch_size += len(lines) + len(invalid)
+            now = time.monotonic()
+            if batch and deadline is None:
+                deadline = now + settings['flush_interval']
+            if batch and (batch_size >= settings['flush_lines'] or now >= deadline):
+                debug_echo('flushing {} entries', batch_size)
+                success = _flush() and success
+                batch = {}
+                batch_size = 0
+                deadline = None
+            elif not batch and _has_read(pending):
+                # nothing to report, but the offsets changed
+                success = _flush() and success
+            if _has_more(pending):
+                continue
+            flush_output()
+            timeout = max(0, deadline - now) if deadline is not None else None
+            if _has_held(pending):
+                # release the entries kept back even if nothing is written anymore
+                timeout = min(timeout if timeout is not None else math.inf, settings['flush_interval'])
+            watcher.wait(timeout)
+    except KeyboardInterrupt:
+        debug_echo('stopping')
+        if batch or _has_read(pending):
+            success = _flush() and success
+    finally:
+        signal.signal(signal.SIGTERM, prev_handler)
+        watcher.close()
+    return _finish(delivery, dedup, success)
@@ -0,0 +1,159 @@
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+from logstapo.logs import make_template
+from logstapo.util import debug_echo, debug_enabled, verbose_echo, warning_echo
+
+
+def fingerprint(name, parsed):
+    """Get the fingerprint identifying similar log entries.
+
+    :param name: The name of the log
+    :param parsed: The dict containing the data from the regex
+    :return: A string which is the same for all entries from the same
+             source whose messages only differ in variable parts.
+    """
+    template = parsed.get('template') or make_template(parsed['message'])
+    key = '\0'.join((name, parsed['source'], template))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+
+class DedupCache(object):
+    """A persistent cache of log entries which have been reported.
+
+    Entries which have already been reported within the last `window`
+    seconds are suppressed; once the window has passed they are
+    reported again along with the number of occurrences since they
+    have first been seen.
+
+    Like the offsets, changes are staged per log and only kept for
+    the logs passed to `commit`, so lines whose actions failed are
+    not suppressed when they are read again.
+
+    :param path: The path of the cache file
+    :param window: The number of seconds during which repeated entries
+                   are suppressed
+    :param max_entries: The maximum number of entries to keep.  If
+                        there are more, the entries which have not been
+                        seen for the longest time are removed.
+    """
+
+    def __init__(self, path, window, max_entries):
+        self.path = path
+        self.window = window
+        self.max_entries = max_entries
+        self.now = time.time()
+        self._entries = self._load()
+        self._pending = {}
+
+    def __repr__(self):
+        return '<DedupCache({!r})>'.format(self.path)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            warning_echo('Could not read dedup cache {} ({})'.format(self.path, exc))
+            return {}
+        if not isinstance(entries, dict):
+            warning_echo('Ignoring invalid dedup cache {}'.format(self.path))
+            return {}
+        return entries
+
+    def filter(self, name, lines):
+        """Remove log entries which have already been reported.
+
+        Entries which are reported again after the window has passed
+        get the additional keys `repeat` (the number of occurrences
+        since the entry has been seen first) and `first_seen` (a unix
+        timestamp).
+
+        :param name: The name of the log
+        :param lines: A list of ``(line, data)`` tuples as returned by
+                      `process_log`
+        :return: A list containing the entries from `lines` which
+                 should be reported
+        """
+        staged = self._pending.setdefault(name, {})
+        rv = []
+        debug = debug_enabled()
+        for line, parsed in lines:
+            key = fingerprint(name, parsed)
+            count = parsed.get('count', 1)
+            entry = staged.get(key) or self._entries.get(key)
+            if entry is None:
+                staged[key] = {'first_seen': self.now, 'reported': self.now, 'seen': self.now, 'count': count}
+                rv.append((line, parsed))
+                continue
+            entry = dict(entry, seen=self.now, count=entry['count'] + count)
+            staged[key] = entry
+            if self.now - entry['reported'] < self.window:
+                if debug:
+                    debug_echo('repeated: ' + line)
+                continue
+            entry['reported'] = self.now
+            rv.append((line, dict(parsed, repeat=entry['count'], first_seen=entry['first_seen'])))
+        verbose_echo(1, 'Suppressed {} repeated entries', len(lines) - len(rv))
+        return rv
+
+    def commit(self, names):
+        """Keep the changes for the specified logs.
+
+        Changes staged for any other logs are discarded.
+
+        :param names: The names of the logs whose results have been
+                      handled successfully
+        """
+        for name, staged in self._pending.items():
+            if name in names:
+                self._entries.update(staged)
+        self._pending.clear()
+
+    def save(self):
+        """Write the cache to disk, removing expired entries.
+
+        Other instances running at the same time may have written the
+        cache since it has been loaded, so their entries are merged
+        with ours while holding a lock on the cache.
+        """
+        try:
+            with open(self.path + '.lock', 'a') as lockfile:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+                self._entries = _merge_entries(self._load(), self._entries)
+                entries = sorted(((key, entry) for key, entry in self._entries.items()
+                                  if self.now - entry['seen'] < self.window),
+                                 key=lambda x: x[1]['seen'], reverse=True)
+                self._entries = dict(entries[:self.max_entries])
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(self._entries, f, separators=(',', ':'))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+        except OSError as exc:
+            warning_echo('Could not write dedup cache {} ({})'.format(self.path, exc))
+
+
+def _merge_entries(stored, entries):
+    """Merge the entries of two instances of the cache.
+
+    For entries known to both, the one seen last is kept, but the
+    latest report time of both is used so an entry reported by either
+    instance is not reported again before the window has passed.
+    """
+    merged = dict(stored)
+    for key, entry in entries.items():
+        other = merged.get(key)
+        if other is None:
+            merged[key] = entry
+            continue
+        if entry['seen'] < other['seen']:
+            entry, other = other, entry
+        merged[key] = dict(entry, reported=max(entry['reported'], other['reported']))
+    return merged
@@ -1 +1,57 @@
 CONFIG_FILE_PATH = '/etc/logstapo.yml'
+
+#: Default values for the optional `settings` section of the config file
+DEFAULT_SETTINGS = {
+    # read large backlogs in chunks of this size per file, performing
+    # actions and committing the offsets after each chunk
+    'checkpoint_bytes': 64 * 1024 * 1024,
+    # store action results in this file and deliver them in the
+    # background so failed deliveries can be retried later
+    'spool': None,
+    # how often to try delivering a spooled result during a run
+    'spool_attempts': 3,
+    # seconds to wait before the first retry; doubled for each retry
+    'spool_backoff': 5,
+    # move spooled results to `<spool>.parked` after this many failed
+    # delivery attempts across all runs
+    'spool_max_attempts': 100,
+    # seconds after which an action is considered failed unless it
+    # specifies its own timeout
+    'action_timeout': 300,
+    # remember reported entries in this file and do not report them
+    # again within `dedup_window` seconds
+    'dedup': None,
+    'dedup_window': 24 * 3600,
+    # the maximum number of entries kept in the dedup cache
+    'dedup_max_entries': 10000,
+    # in follow mode, perform actions after collecting this many
+    # entries or this many seconds after the first one
+    'flush_lines': 1000,
+    'flush_interval': 10,
+    # in follow mode, seconds between checking the logfiles for changes
+    # in case inotify is not available
+    'poll_interval': 1,
+    # the maximum number of bytes per second read from logfiles
+    'io_rate': None,
+    # drop data from the page cache after reading it
+    'drop_cache': True,
+    # use the idle I/O scheduling class
+    'io_idle': False,
+    # the number of unparsable lines per log shown in full; any further
+    # ones are only summarized
+    'parse_warnings': 10,
+    # add an entry to the sparse index of a logfile about every this
+    # many bytes; the index is used to locate entries by time
+    'index_interval': 16 * 1024 * 1024,
+    # lines longer than this many bytes are truncated when reading them
+    'max_line_length': 65536,
+    # the size in bytes of the filter remembering which lines have been
+    # read from each logfile in case its offset file gets lost.  it is
+    # disabled by default since hashing every line slows down reading
+    'seen_filter': None,
+    # seconds after which matching a line against a regex or pattern
+    # which looks prone to catastrophic backtracking is considered too
+    # slow; such a regex is then disabled for the rest of the run.
+    # null only shows the warnings about such regexps
+    'slow_match': 1,
+}
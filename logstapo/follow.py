@@ -0,0 +1,150 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from logstapo.util import debug_echo, warning_echo
+
+
+# inotify event flags (see <sys/inotify.h>)
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+
+_INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def create_watcher(paths, poll_interval):
+    """Create a watcher for the given logfiles.
+
+    inotify is used if available; otherwise the files are polled.
+
+    :param paths: A list of logfile paths
+    :param poll_interval: The number of seconds between two checks if
+                          the files need to be polled
+    """
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError) as exc:
+        debug_echo('inotify not available, polling files ({})', exc)
+        return PollingWatcher(paths, poll_interval)
+
+
+class InotifyWatcher(object):
+    """Wait for changes of logfiles using inotify.
+
+    The directories containing the files are watched instead of the
+    files themselves so a logfile being rotated or recreated is noticed
+    as well.  Only events affecting the logfiles are relevant; e.g.
+    offset files written to the same directory are ignored.
+    """
+
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._names = {}
+        for path in paths:
+            directory, name = os.path.split(os.path.abspath(path))
+            self._names.setdefault(directory, set()).add(os.fsencode(name))
+        self._watches = {}
+        for directory in sorted(self._names):
+            wd = libc.inotify_add_watch(self._fd, os.fsencode(directory), _INOTIFY_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                warning_echo('Could not watch {} ({})'.format(directory, os.strerror(errno)))
+                continue
+            self._watches[wd] = directory
+        if not self._watches:
+            os.close(self._fd)
+            raise OSError('no directory could be watched')
+
+    def __repr__(self):
+        return '<InotifyWatcher({})>'.format(', '.join(sorted(self._watches.values())))
+
+    def close(self):
+        os.close(self._fd)
+
+    def wait(self, timeout=None):
+        """Wait until a logfile changed.
+
+        :param timeout: The maximum number of seconds to wait
+        :return: ``True`` if a logfile changed, ``False`` if the
+                 timeout elapsed
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            remaining = max(0, deadline - time.monotonic()) if deadline is not None else None
+            if not select.select([self._fd], [], [], remaining)[0]:
+                return False
+            if self._read_events():
+                return True
+
+    def _read_events(self):
+        relevant = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return relevant
+            pos = 0
+            while pos < len(data):
+                wd, mask, __, size = _EVENT_HEADER.unpack_from(data, pos)
+                name = data[pos + _EVENT_HEADER.size:pos + _EVENT_HEADER.size + size].rstrip(b'\0')
+                pos += _EVENT_HEADER.size + size
+                if mask & IN_Q_OVERFLOW or name in self._names.get(self._watches.get(wd), ()):
+                    relevant = True
+
+
+class PollingWatcher(object):
+    """Wait for changes of logfiles by checking them periodically."""
+
+    def __init__(self, paths, interval):
+        self.paths = paths
+        self.interval = interval
+        self._snapshot = self._stat()
+
+    def __repr__(self):
+        return '<PollingWatcher(interval={})>'.format(self.interval)
+
+    def close(self):
+        pass
+
+    def _stat(self):
+        snapshot = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                snapshot.append(None)
+            else:
+                snapshot.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return snapshot
+
+    def wait(self, timeout=None):
+        """Wait until a logfile changed.
+
+        :param timeout: The maximum number of seconds to wait
+        :return: ``True`` if a logfile changed, ``False`` if the
+                 timeout elapsed
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            remaining = deadline - time.monotonic() if deadline is not None else self.interval
+            time.sleep(max(0, min(self.interval, remaining)))
+            snapshot = self._stat()
+            if snapshot != self._snapshot:
+                self._snapshot = snapshot
+                return True
+            elif deadline is not None and time.monotonic() >= deadline:
+                return False
@@ -0,0 +1,190 @@
+import bisect
+import math
+import os
+import struct
+from array import array
+
+from logstapo.util import debug_echo, warning_echo
+
+
+_MAGIC = b'LSI1'
+#: inode, size and digest of the head fingerprint, end offset, end line
+_HEADER = struct.Struct('<4sQQ40sQQ')
+#: offset, line number, timestamp
+_ENTRY = struct.Struct('<QQd')
+
+
+class LogIndex(object):
+    """A sparse index of the lines and timestamps in a logfile.
+
+    While a logfile is read, an entry is added about every `interval`
+    bytes containing the position of a line, its line number and the
+    first timestamp at or after it.  This allows finding positions by
+    time or line number without reading the file.
+
+    The index also remembers up to where the file has been read, so
+    it can be extended whenever new data is read from that position.
+    It is stored next to the offset file and identified by the inode
+    and a fingerprint of the beginning of the file, so it is discarded
+    when the file is rotated or truncated.
+
+    :param path: The path of the index file
+    :param interval: The number of bytes between two entries
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.inode = None
+        self.head = None
+        #: The position up to which the file has been indexed
+        self.end = 0
+        #: The number of lines before `end`
+        self.end_line = 0
+        self.offsets = array('Q')
+        self.lines = array('Q')
+        self.times = array('d')
+        self._dirty = False
+        self._load()
+
+    def __repr__(self):
+        return '<LogIndex({!r}, entries={}, end={})>'.format(self.path, len(self.offsets), self.end)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as exc:
+            warning_echo('Could not read index {} ({})'.format(self.path, exc))
+            return
+        if len(data) < _HEADER.size or (len(data) - _HEADER.size) % _ENTRY.size:
+            debug_echo('ignoring invalid index ' + self.path)
+            return
+        magic, inode, head_size, head_digest, end, end_line = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            debug_echo('ignoring invalid index ' + self.path)
+            return
+        self.inode = inode
+        self.head = (head_size, head_digest.decode('ascii'))
+        self.end = end
+        self.end_line = end_line
+        for offset, line, timestamp in _ENTRY.iter_unpack(data[_HEADER.size:]):
+            self.offsets.append(offset)
+            self.lines.append(line)
+            self.times.append(timestamp)
+
+    def reset(self, inode, head):
+        """Discard the index, e.g. because the file has been replaced.
+
+        :param inode: The inode of the file
+        :param head: The fingerprint of the beginning of the file
+        """
+        debug_echo('resetting index ' + self.path)
+        self.inode = inode
+        self.head = head
+        self.end = 0
+        self.end_line = 0
+        del self.offsets[:]
+        del self.lines[:]
+        del self.times[:]
+        self._dirty = True
+
+    def matches(self, inode, head):
+        """Check whether the index belongs to a file.
+
+        :param inode: The inode of the file
+        :param head: The fingerprint of the beginning of the file,
+                     using the size stored in the index
+        """
+        return self.inode == inode and self.head == head
+
+    def update_head(self, head):
+        """Update the fingerprint after the beginning of the file grew.
+
+        :param head: The fingerprint of the beginning of the file
+        """
+        if head != self.head:
+            self.head = head
+            self._dirty = True
+
+    @property
+    def next_offset(self):
+        """The position after which the next entry is added."""
+        return self.offsets[-1] + self.interval if self.offsets else 0
+
+    def add(self, offset, line, timestamp=None):
+        """Add an entry to the index.
+
+        :param offset: The position of a line
+        :param line: The line number of the line
+        :param timestamp: The unix timestamp of the first entry at or
+                          after `offset` or ``None`` if not known yet
+        """
+        self.offsets.append(offset)
+        self.lines.append(line)
+        self.times.append(timestamp if timestamp is not None else math.nan)
+        self._dirty = True
+
+    def set_time(self, timestamp):
+        """Set the timestamp of the last entry."""
+        self.times[-1] = timestamp
+        self._dirty = True
+
+    def advance(self, end, end_line):
+        """Update the position up to which the file has been indexed."""
+        if end != self.end:
+            self.end = end
+            self.end_line = end_line
+            self._dirty = True
+
+    def find_time(self, timestamp):
+        """Get the range containing the first entry logged at a time.
+
+        :param timestamp: A unix timestamp
+        :return: A ``(start, end)`` tuple of positions.  `end` is
+                 ``None`` if the entry was logged after the last
+                 indexed position.
+        """
+        start = 0
+        end = None
+        for offset, entry_time in zip(self.offsets, self.times):
+            if math.isnan(entry_time):
+                continue
+            elif entry_time < timestamp:
+                start = offset
+            else:
+                end = offset
+                break
+        return start, end
+
+    def find_line(self, line):
+        """Get the position of the last entry before a line.
+
+        :param line: A line number (starting at 0)
+        :return: A ``(offset, line)`` tuple from which the line can
+                 be reached by reading ``line - offset_line`` lines.
+        """
+        i = bisect.bisect_right(self.lines, line) - 1
+        if i < 0:
+            return 0, 0
+        return self.offsets[i], self.lines[i]
+
+    def save(self):
+        """Write the index to disk if it changed."""
+        if not self._dirty or self.inode is None:
+            return
+        header = _HEADER.pack(_MAGIC, self.inode, self.head[0], self.head[1].encode('ascii'), self.end,
+                              self.end_line)
+        entries = b''.join(_ENTRY.pack(*entry) for entry in zip(self.offsets, self.lines, self.times))
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                os.fchmod(f.fileno(), 0o600)
+                f.write(header + entries)
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            warning_echo('Could not write index {} ({})'.format(self.path, exc))
+        else:
+            self._dirty = False
@@ -1,26 +1,153 @@
+import fcntl
 import itertools
+import os
+import re
+import time
+from collections import Counter
 
 from logstapo.config import current_config
-from logstapo.logtail import logtail
-from logstapo.util import try_match, debug_echo, verbose_echo, warning_echo
+from logstapo.logtail import Throttle, load_state, logtail
+from logstapo.timestamps import parse_timestamp
+from logstapo.util import try_match, debug_echo, debug_enabled, verbose_echo, verbose_enabled, warning_echo
 
 
-def process_logs(names=None):
+def process_logs(names=None, pending=None, locks=None, warnings=None, hold_open=None):
     """Let logstapo loose on logs.
 
     :param names: A list of log names to process.  If omitted all
                   configured logs are processed
+    :param pending: A dict in which the new offsets are staged for
+                    each log instead of writing them immediately.
+                    See `process_log` for details.
+    :param locks: A `LogLocks` instance.  If specified, logs which are
+                  locked by another process are skipped.  The locks
+                  are kept until they are released by the caller.
+    :param warnings: A dict in which the `ParseWarnings` of each log
+                     are kept.  See `process_log` for details.
+    :param hold_open: See `process_log`
     :return: A dict of `process_log` results
     """
     if names is None:
         names = sorted(current_config['logs'])
-    return {name: process_log(name) for name in names}
+    if locks is not None:
+        names = [name for name in names if locks.acquire(name)]
+    kwargs = {'warnings': warnings} if warnings is not None else {}
+    if hold_open is not None:
+        kwargs['hold_open'] = hold_open
+    if pending is None:
+        return {name: process_log(name, **kwargs) for name in names}
+    return {name: process_log(name, pending=pending.setdefault(name, {}), **kwargs) for name in names}
 
 
-def process_log(name):
+class LogLocks(object):
+    """Advisory locks to avoid processing a log in multiple processes.
+
+    A log is locked by locking a ``<file>.offset.lock`` file for each
+    of its files, so logs sharing files with a log locked by another
+    process are skipped as well.  Locks are released when leaving the
+    context.
+    """
+
+    def __init__(self):
+        self._names = set()
+        self._lockfiles = {}
+
+    def __repr__(self):
+        return '<LogLocks({})>'.format(', '.join(sorted(self._names)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def acquire(self, name):
+        """Lock a log unless it is already locked.
+
+        :param name: The name of the log
+        :return: ``True`` if the log is locked by this instance,
+                 ``False`` if another process holds the lock
+        """
+        if name in self._names:
+            return True
+        acquired = {}
+        for path in sorted(current_config['logs'][name]['files']):
+            lock_path = path + '.offset.lock'
+            if lock_path in self._lockfiles:
+                continue
+            try:
+                lockfile = open(lock_path, 'a')
+            except OSError as exc:
+                warning_echo('Could not create lock file: {} ({})'.format(lock_path, exc))
+                continue
+            try:
+                os.fchmod(lockfile.fileno(), 0o600)
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lockfile.close()
+                for lockfile in acquired.values():
+                    lockfile.close()
+                verbose_echo(1, "Skipping log '{}' which is being processed by another instance", name)
+                return False
+            acquired[lock_path] = lockfile
+        debug_echo("locked log '{}'", name)
+        self._lockfiles.update(acquired)
+        self._names.add(name)
+        return True
+
+    def release(self):
+        """Release all locks."""
+        for lockfile in self._lockfiles.values():
+            lockfile.close()
+        self._lockfiles.clear()
+        self._names.clear()
+
+
+def get_due_logs():
+    """Get the logs which need to be processed.
+
+    Logs with an `interval` are only due if they have not been checked
+    completely during the last `interval` seconds, i.e. logs where
+    data was left unread due to `max_bytes` or `max_seconds` are also
+    due.
+
+    :return: A list of log names
+    """
+    now = time.time()
+    return [name for name, data in sorted(current_config['logs'].items()) if _is_due(data, now)]
+
+
+def _is_due(data, now):
+    if data['interval'] is None:
+        return True
+    states = [state for state in map(load_state, data['files']) if state is not None]
+    if not states or any(state['checked'] is None for state in states):
+        return True
+    return min(state['checked'] for state in states) + data['interval'] <= now
+
+
+def process_log(name, pending=None, warnings=None, hold_open=None):
     """Let logstapo loose on a specifig log.
 
     :param name: The name of the log to process
+    :param pending: A dict in which the new offsets are staged instead
+                    of writing them to the offset files.  They need to
+                    be written using `commit_offsets` once the lines
+                    have been handled.  In this case large backlogs
+                    are read in chunks of the configured
+                    ``checkpoint_bytes``, and the time of the check is
+                    stored for logs with an `interval`.
+    :param warnings: A dict mapping log names to the `ParseWarnings`
+                     used for them.  This allows processing a log
+                     multiple times (e.g. in chunks or in follow mode)
+                     without showing the first unparsable lines again
+                     each time.  The caller needs to `finish` them.
+    :param hold_open: The number of seconds for which the last entry of
+                      a log with multi-line entries is kept back at the
+                      end of a logfile since more lines of it may still
+                      be written.  Requires `pending`.  Regardless of
+                      this, an entry is never split when reading stops
+                      due to a limit.
     :return: A ``(lines, failed)`` tuple. `lines` is a list of
             ``(line, data)`` tuples and `failed` is a list of raw
             lines that could not be parsed.
@@ -46,32 +173,243 @@ def process_log(name):
                     verbose_echo(1, '    - Source: {}'.format(source.pattern))
                 for pattern in patterns:
                     verbose_echo(1, '      - {}'.format(pattern.pattern))
-    lines = itertools.chain.from_iterable(_iter_log_lines(f, config['dry_run']) for f in data['files'])
+    checked = time.time()
+    start = time.monotonic()
+    throttle = Throttle(config['settings']['io_rate'], config['settings']['drop_cache'])
+    tail_stats = Counter()
+    tail_kwargs = {'dry_run': config['dry_run'], 'max_bytes': data['max_bytes'], 'max_seconds': data['max_seconds'],
+                   'throttle': throttle, 'index_interval': config['settings']['index_interval'],
+                   'max_line_length': config['settings']['max_line_length'], 'stats': tail_stats,
+                   'seen_filter_size': config['settings']['seen_filter']}
+    if pending is not None:
+        tail_kwargs.update(chunk_bytes=config['settings']['checkpoint_bytes'], pending=pending)
+    get_time = make_time_getter(regexps)
+    if get_time is not None:
+        tail_kwargs['get_time'] = get_time
+    if config['since'] is not None or config['until'] is not None:
+        if get_time is None:
+            warning_echo("[{}] Ignoring time range since the regex has no 'timestamp' group".format(name))
+        else:
+            tail_kwargs.update(since=config['since'], until=config['until'])
+    multiline = data['multiline']
+    if multiline is not None:
+        tail_kwargs['continuation'] = _make_continuation_check(regexps, multiline['continuation'])
+        if pending is not None:
+            tail_kwargs['hold_open'] = hold_open
     invalid = []
     other = []
+    summary = SpaceSaving(data['summarize']) if data['summarize'] else None
     garbage_count = 0
     ignored_count = 0
-    for line in lines:
-        if garbage and any(x.test(line) for x in garbage):
+    if warnings is None:
+        parse_warnings = ParseWarnings(name, config['settings']['parse_warnings'])
+    elif name in warnings:
+        parse_warnings = warnings[name]
+    else:
+        parse_warnings = warnings[name] = ParseWarnings(name, config['settings']['parse_warnings'])
+    # avoid building messages which are not displayed anyway
+    debug = debug_enabled()
+    verbose = verbose_enabled(2)
+    if multiline is not None:
+        # an entry cannot continue in a different file
+        records = itertools.chain.from_iterable(assemble_records(logtail(f, **tail_kwargs), regexps, **multiline)
+                                                for f in data['files'])
+    else:
+        lines = itertools.chain.from_iterable(logtail(f, **tail_kwargs) for f in data['files'])
+        records = ((line.strip(), None, None) for line in lines)
+    for head, match, continued in records:
+        line = head if not continued else '\n'.join([head] + continued)
+        if garbage and any(x.test(head) for x in garbage):
             garbage_count += 1
-            debug_echo('garbage: ' + line)
+            if debug:
+                debug_echo('garbage: ' + line)
             continue
-        parsed = _parse_line(line, regexps)
+        parsed = match.groupdict() if match is not None else _parse_line(head, regexps)
         if parsed is None:
-            warning_echo('[{}] Could not parse: {}'.format(name, line))
+            parse_warnings.add(head)
             invalid.append(line)
             continue
         if _check_ignored(parsed, ignore):
             ignored_count += 1
-            debug_echo('ignored: ' + line)
+            if debug:
+                debug_echo('ignored: ' + line)
             continue
-        verbose_echo(2, line)
-        other.append((line, parsed))
-    verbose_echo(1, 'Stats: {} garbage / {} invalid / {} ignored / {} other'.format(garbage_count, len(invalid),
-                                                                                    ignored_count, len(other)))
+        if continued:
+            parsed['message'] = '\n'.join([parsed['message']] + continued)
+        if verbose:
+            verbose_echo(2, line)
+        if summary is not None:
+            summary.add(line, parsed)
+        else:
+            other.append((line, parsed))
+    if warnings is None:
+        parse_warnings.finish()
+    if pending is not None and data['interval'] is not None:
+        for state in pending.values():
+            if not state['backlog']:
+                state['checked'] = checked
+    if summary is not None:
+        other = summary.results()
+        verbose_echo(1, 'Summarized {} lines as {} templates', summary.total, len(other))
+    verbose_echo(1, 'Stats: {} garbage / {} invalid / {} ignored / {} other / {} truncated',
+                 garbage_count, len(invalid), ignored_count, summary.total if summary is not None else len(other),
+                 tail_stats['truncated'])
+    elapsed = time.monotonic() - start
+    mib_read = throttle.bytes_read / 2**20
+    verbose_echo(1, 'I/O: {:.1f} MiB in {:.1f}s ({:.1f} MiB/s), {:.1f}s throttled, {:.1f} MiB dropped from cache',
+                 mib_read, elapsed, mib_read / elapsed if elapsed else 0, throttle.throttled,
+                 throttle.bytes_dropped / 2**20)
     return other, invalid
 
 
+class ParseWarnings(object):
+    """Warn about lines which could not be parsed.
+
+    The first `limit` lines are shown in full.  Any further lines are
+    only counted and summarized every `summary_interval` lines and
+    when calling `finish`, so a log whose format changed does not
+    result in millions of warnings.
+
+    :param name: The name of the log
+    :param limit: The number of lines to show in full or ``None`` to
+                  show all of them
+    """
+
+    #: The number of suppressed lines after which a summary is shown
+    summary_interval = 100000
+    #: The maximum number of distinct shapes to count
+    max_shapes = 1000
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.count = 0
+        self._suppressed = 0
+        self._shapes = set()
+
+    def add(self, line):
+        """Warn about an unparsable line.
+
+        :param line: The line that could not be parsed
+        """
+        self.count += 1
+        if self.limit is None or self.count <= self.limit:
+            warning_echo('[{}] Could not parse: {}'.format(self.name, line))
+            return
+        self._suppressed += 1
+        if len(self._shapes) < self.max_shapes:
+            self._shapes.add(make_template(line))
+        if self._suppressed >= self.summary_interval:
+            self._summarize()
+
+    def finish(self):
+        """Show a summary of the lines which have not been shown yet."""
+        if self._suppressed:
+            self._summarize()
+
+    def _summarize(self):
+        shapes = len(self._shapes)
+        warning_echo('[{}] {} more unparsable lines ({}{} distinct shapes)'.format(
+            self.name, self._suppressed, shapes, '+' if shapes >= self.max_shapes else ''))
+        self._suppressed = 0
+        self._shapes.clear()
+
+
+def assemble_records(lines, regexps, continuation, max_lines, max_chars):
+    """Join the lines of multi-line log entries.
+
+    Continuation lines are appended to the preceding line so e.g. a
+    stack trace is handled as part of the entry it belongs to.  Once
+    an entry has `max_lines` continuation lines or `max_chars`
+    characters, any further continuation lines are dropped and a note
+    about them is added instead.  Continuation lines at the beginning
+    of the data are treated as separate entries.
+
+    The lines are checked before stripping them so indented lines can
+    be detected.  The first line of each entry is stripped while
+    continuation lines keep their indentation.
+
+    :param lines: An iterable yielding log lines
+    :param regexps: The regexps used to parse the log lines
+    :param continuation: ``'indent'`` if lines starting with whitespace
+                         are continuation lines, ``'unmatched'`` if
+                         lines not matching any of `regexps` are, or a
+                         compiled regex matching continuation lines
+    :param max_lines: The maximum number of continuation lines per entry
+    :param max_chars: The maximum size of an entry
+    :return: An iterator yielding ``(head, match, continued)`` tuples.
+             `head` is the first line of the entry, `match` is the
+             regex match of it if it has already been determined and
+             `continued` is a list of continuation lines.
+    """
+    head = match = None
+    continued = []
+    size = dropped = 0
+    for line in lines:
+        line_match = None
+        if continuation == 'indent':
+            is_continuation = line[:1].isspace()
+        elif continuation == 'unmatched':
+            line_match = try_match(regexps, line.strip())
+            is_continuation = line_match is None
+        else:
+            is_continuation = continuation.match(line) is not None
+        if is_continuation and head is not None:
+            line = line.rstrip()
+            size += len(line) + 1
+            if len(continued) < max_lines and size <= max_chars:
+                continued.append(line)
+            else:
+                dropped += 1
+            continue
+        if head is not None:
+            if dropped:
+                continued.append('[{} more lines dropped]'.format(dropped))
+            yield head, match, continued
+        head = line.strip()
+        match = line_match
+        continued = []
+        size = len(head)
+        dropped = 0
+    if head is not None:
+        if dropped:
+            continued.append('[{} more lines dropped]'.format(dropped))
+        yield head, match, continued
+
+
+def _make_continuation_check(regexps, continuation):
+    # the same check as in `assemble_records`, for `logtail`
+    if continuation == 'indent':
+        return lambda line: line[:1].isspace()
+    elif continuation == 'unmatched':
+        return lambda line: try_match(regexps, line.strip()) is None
+    return lambda line: continuation.match(line) is not None
+
+
+def make_time_getter(regexps):
+    """Create a function which gets the time of a log line.
+
+    :param regexps: The regexps used to parse the log lines.  Only
+                    those containing a group named ``timestamp`` are
+                    used.
+    :return: A function returning the unix timestamp of a line or
+             ``None`` if the line has no (valid) timestamp, or ``None``
+             if none of the regexps contains a timestamp.
+    """
+    regexps = [regex for regex in regexps if 'timestamp' in regex.groupindex]
+    if not regexps:
+        return None
+    now = time.time()
+
+    def get_time(line):
+        match = try_match(regexps, line)
+        if match is None or match.group('timestamp') is None:
+            return None
+        return parse_timestamp(match.group('timestamp'), now)
+
+    return get_time
+
+
 def _parse_line(line, regexps):
     match = try_match(regexps, line)
     return match.groupdict() if match is not None else None
@@ -86,5 +424,105 @@ def _check_ignored(parsed, ignore):
     return False
 
 
-def _iter_log_lines(file, dry_run):
-    yield from logtail(file, dry_run=dry_run)
+_MASK_RE = re.compile(r'''
+    (?P<UUID>\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b) |
+    (?P<PATH>(?<![\w/.~-])(?:/[^\s/'"()\[\]<>,;]+)+/?) |
+    (?P<MAC>\b(?:[0-9a-f]{2}:){5}[0-9a-f]{2}\b) |
+    (?P<IP>\b\d{1,3}(?:\.\d{1,3}){3}\b |
+           (?<![\w:])(?:[0-9a-f]{1,4}(?::[0-9a-f]{1,4}){7} |
+                       (?:[0-9a-f]{1,4}(?::[0-9a-f]{1,4})*)?::(?:[0-9a-f]{1,4}(?::[0-9a-f]{1,4})*)?)(?![\w:])) |
+    (?P<HEX>\b0x[0-9a-f]+\b | \b(?=[0-9a-f]*\d)(?=[0-9a-f]*[a-f])[0-9a-f]{8,}\b) |
+    (?P<NUM>(?<![\w.])[-+]?\d+(?:\.\d+)?(?!\.?\d))
+''', re.IGNORECASE | re.VERBOSE)
+
+
+def make_template(message):
+    """Turn a log message into a template.
+
+    Variable parts such as numbers, IP addresses, hex IDs and paths
+    are replaced with placeholders like ``<NUM>`` so similar messages
+    result in the same template.
+
+    :param message: The message of a log entry
+    :return: The message with all variable parts masked
+    """
+    return _MASK_RE.sub(lambda m: '<{}>'.format(m.lastgroup), message)
+
+
+class SpaceSaving(object):
+    """Summarize log entries by the templates of their messages.
+
+    This uses the Space-Saving algorithm to track the most frequent
+    ``(source, template)`` pairs in a fixed amount of memory:  Once
+    `capacity` pairs are tracked, a new pair replaces the one with
+    the lowest count and inherits its count.  The counts of frequent
+    pairs are thus overestimated by at most `error` - which stays low
+    as long as there are not too many different messages.
+
+    Like the stream-summary structure from the paper describing the
+    algorithm, the pairs are grouped by their counts so a pair with
+    the lowest count can be found in constant time.
+    """
+
+    #: The number of example lines kept for each template
+    max_examples = 3
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        self._counters = {}
+        #: The keys of the tracked pairs grouped by their counts, each
+        #: group ordered by the time the pairs reached that count
+        self._buckets = {}
+        self._min_count = 0
+
+    def _increment(self, key, counter):
+        count = counter['count']
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+            if count == self._min_count:
+                self._min_count = count + 1
+        counter['count'] = count + 1
+        self._buckets.setdefault(count + 1, {})[key] = None
+
+    def add(self, line, parsed):
+        """Count a parsed log line.
+
+        :param line: The raw log line
+        :param parsed: The dict containing the data from the regex
+        """
+        self.total += 1
+        key = (parsed['source'], make_template(parsed['message']))
+        counter = self._counters.get(key)
+        if counter is None:
+            error = 0
+            if len(self._counters) >= self.capacity:
+                error = self._min_count
+                bucket = self._buckets[error]
+                victim = next(iter(bucket))
+                del bucket[victim]
+                del self._counters[victim]
+            counter = self._counters[key] = {'count': error, 'error': error, 'examples': [], 'parsed': parsed}
+            self._buckets.setdefault(error, {})[key] = None
+            self._min_count = error
+        self._increment(key, counter)
+        if len(counter['examples']) < self.max_examples:
+            counter['examples'].append(line)
+
+    def results(self):
+        """Get the summarized log entries.
+
+        :return: A list of ``(line, data)`` tuples just like the one
+                 returned by `process_log`, ordered by the number of
+                 occurrences.  `line` is the first example and `data`
+                 contains the parsed data of that line as well as
+                 `template`, `count`, `error` and `examples`.
+        """
+        results = []
+        for (source, template), counter in sorted(self._counters.items(), key=lambda x: -x[1]['count']):
+            parsed = dict(counter['parsed'], template=template, count=counter['count'], error=counter['error'],
+                          examples=counter['examples'])
+            results.append((counter['examples'][0], parsed))
+        return results
@@ -1,96 +1,865 @@
-import itertools
+import bz2
+import gzip
+import hashlib
+import io
+import lzma
+import math
 import os
+import re
+import time
 from contextlib import ExitStack
-from glob import glob
+from functools import partial
+from glob import escape as glob_escape, glob
 
+from logstapo.bloom import BloomFilter
+from logstapo.index import LogIndex
 from logstapo.util import debug_echo, warning_echo
 
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
 
-def logtail(path, offset_path=None, *, dry_run=False):
+
+#: Number of bytes at the beginning of a file used to fingerprint it
+FINGERPRINT_SIZE = 1024
+#: Chunk size used when skipping data in compressed files
+_SKIP_CHUNK_SIZE = 65536
+#: Number of bytes read before a `Throttle` is updated
+THROTTLE_CHUNK_SIZE = 65536
+#: Number of lines checked for a timestamp when searching a position
+#: in a logfile
+PROBE_LINES = 10
+#: Size of the range below which a time-based search stops and the
+#: remaining lines are checked one by one
+_TIME_SEARCH_SIZE = 65536
+
+
+def _open_zstd(path, mode):
+    if zstandard is None:  # pragma: no cover
+        raise OSError('zstandard is not installed')
+    return io.BufferedReader(zstandard.open(path, mode))
+
+
+COMPRESSED_OPENERS = {'.gz': gzip.open,
+                      '.bz2': bz2.open,
+                      '.xz': lzma.open,
+                      '.zst': _open_zstd}
+
+
+class Throttle(object):
+    """Limit the rate at which logfiles are read.
+
+    This uses a token bucket allowing bursts of up to one second worth
+    of data.  It also tells the kernel that files are read sequentially
+    and, if `drop_cache` is enabled, that data which has been read is
+    not needed anymore so it does not push other data out of the page
+    cache.  Compressed files are rate-limited based on their
+    decompressed size and do not use the page cache hints.
+
+    :param rate: The maximum number of bytes per second or ``None``
+    :param drop_cache: Whether to drop data which has been read from
+                       the page cache.
+    """
+
+    def __init__(self, rate=None, drop_cache=False):
+        self.rate = rate
+        self.drop_cache = drop_cache
+        #: The number of bytes read
+        self.bytes_read = 0
+        #: The number of bytes dropped from the page cache
+        self.bytes_dropped = 0
+        #: The number of seconds spent waiting due to the rate limit
+        self.throttled = 0
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._released = {}
+
+    def __repr__(self):
+        return '<Throttle(rate={}, drop_cache={})>'.format(self.rate, self.drop_cache)
+
+    def start(self, fd, pos):
+        """Prepare reading a file.
+
+        :param fd: The file descriptor of the file
+        :param pos: The position from which the file is read
+        """
+        self._released[fd] = pos
+        _fadvise(fd, pos, 0, 'POSIX_FADV_SEQUENTIAL')
+
+    def consume(self, fd, pos, nbytes):
+        """Account for data that has been read and processed.
+
+        This waits if the rate limit has been exceeded.
+
+        :param fd: The file descriptor of the file or ``None`` if the
+                   data does not come directly from a file
+        :param pos: The position up to which the file has been read
+        :param nbytes: The number of bytes read since the last call
+        """
+        self.bytes_read += nbytes
+        if fd is not None and self.drop_cache and pos > self._released[fd]:
+            if _fadvise(fd, self._released[fd], pos - self._released[fd], 'POSIX_FADV_DONTNEED'):
+                self.bytes_dropped += pos - self._released[fd]
+            self._released[fd] = pos
+        if self.rate is None or not nbytes:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate) - nbytes
+        self._last = now
+        if self._tokens < 0:
+            delay = -self._tokens / self.rate
+            time.sleep(delay)
+            self.throttled += delay
+
+
+def _fadvise(fd, offset, length, advice):
+    if not hasattr(os, 'posix_fadvise'):  # pragma: no cover
+        return False
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except OSError as exc:
+        debug_echo('posix_fadvise failed: {}', exc)
+        return False
+    return True
+
+
+def logtail(path, offset_path=None, *, dry_run=False, max_bytes=None, max_seconds=None, chunk_bytes=None,
+            pending=None, throttle=None, since=None, until=None, get_time=None, index_interval=None,
+            max_line_length=None, stats=None, seen_filter_size=None, continuation=None, hold_open=None):
     """Yield new lines from a logfile.
 
+    The lines are yielded without their line break, but any other
+    whitespace is kept.
+
+    Rotated files (``<file>.N`` or ``<file>-YYYYMMDD``) are checked
+    for unread lines when the logfile has been rotated since the last
+    run.  If more than one rotation happened since then, all rotated
+    generations starting with the one that was read last are read
+    in order before reading the current logfile.  Rotated files may
+    also be compressed using gzip, bzip2, xz or zstd, in which case
+    they are identified using a fingerprint of their first bytes
+    since compressing a file changes its inode.
+
+    Before resuming at the stored offset, fingerprints of the first
+    bytes of the file and of the bytes before the offset are checked.
+    If they do not match although the inode is the same, the file was
+    truncated (``copytruncate``) or replaced by a new file reusing the
+    inode, and it is read from the beginning after reading the unread
+    part of the old file in case a copy of it can be found.
+
     :param path: The path to the file to read from
     :param offset_path: The path to the file where offset/inode
                         information will be stored.  If not set,
                         ``<file>.offset`` will be used.
     :param dry_run: If ``True``, the offset file will not be modified
                     or created.
+    :param max_bytes: The maximum number of bytes to read.  If more
+                      data is available, reading stops at the first
+                      line boundary after the limit and the offset file
+                      points to that position so the remaining data is
+                      read during the next run.
+    :param max_seconds: The maximum number of seconds to spend on the
+                        file, including the time the caller needs to
+                        process the lines.  Once exceeded, reading stops
+                        just like when `max_bytes` is reached.
+    :param chunk_bytes: Like `max_bytes`, but only for this call.  When
+                        used together with `pending` this allows reading
+                        a large backlog in multiple chunks and committing
+                        the offset after each of them.  A chunk does not
+                        end inside a compressed rotated file since the
+                        next one would have to decompress it from the
+                        beginning again.
+    :param pending: A dict used to stage the new offset instead of
+                    writing it to the offset file immediately.  It maps
+                    offset file paths to the state that will be written
+                    by `commit_offsets`.  A state staged by a previous
+                    call is used instead of the one in the offset file.
+                    The ``more`` item of the staged state indicates
+                    whether `chunk_bytes` stopped reading before all
+                    available data has been read, and ``backlog``
+                    whether any data is left at all.  A state is staged
+                    even if there was nothing to read.
+    :param throttle: A `Throttle` used to limit the read rate and to
+                     drop data which has been read from the page cache.
+    :param since: A unix timestamp.  If set, the stored offset is
+                  ignored and reading starts at the first entry logged
+                  at or after this time, which is located using a binary
+                  search in the logfile or the rotated file containing
+                  it.  When continuing with a state staged in `pending`,
+                  the staged offset is used instead.
+    :param until: A unix timestamp.  If set, reading stops before the
+                  first entry logged after this time.
+    :param get_time: A function returning the unix timestamp of a line
+                     or ``None`` if it has none.  Required when using
+                     `since` or `until`.
+    :param index_interval: If set, a sparse `LogIndex` of the logfile
+                           with an entry about every `index_interval`
+                           bytes is updated while reading it and used
+                           to narrow down the search for `since`.  It
+                           is stored in ``<offset_path>.index``.
+    :param max_line_length: The maximum number of bytes of a line.  Only
+                            the beginning of longer lines is kept along
+                            with a note how many bytes were removed.
+                            The rest of such a line is skipped without
+                            keeping it in memory.
+    :param stats: A `Counter` in which the number of lines truncated
+                  due to `max_line_length` is counted as ``truncated``.
+    :param seen_filter_size: If set, a `BloomFilter` of this many bytes
+                             containing the lines read from the logfile
+                             is stored in ``<offset_path>.seen``.  When
+                             the offset file is lost, the lines at the
+                             beginning of the logfile which are in the
+                             filter are skipped instead of handling
+                             them again.  With `pending`, the filter is
+                             staged as ``seen`` and written by
+                             `commit_offsets`.
+    :param continuation: A function returning whether a line continues
+                         the multi-line entry started by a previous
+                         line.  If set, the lines of the last entry of
+                         the logfile are not yielded when reading stops
+                         due to a limit, and the offset points to the
+                         beginning of that entry so it is read in full
+                         next time.
+    :param hold_open: If set together with `continuation`, the last
+                      entry is also kept back at the end of the logfile
+                      since more lines of it may still be written, but
+                      only for up to this many seconds.  This requires
+                      `pending`, in which the staged ``held`` item
+                      remembers since when the entry is kept back.
     """
     if offset_path is None:
         offset_path = path + '.offset'
 
     try:
-        logfile = open(path, encoding='utf-8', errors='replace')
+        logfile = open(path, 'rb')
     except OSError as exc:
         warning_echo('Could not read: {} ({})'.format(path, exc))
         return
 
-    closer = ExitStack()
-    closer.enter_context(logfile)
-    with closer:
-        line_iter = iter([])
+    with ExitStack() as closer:
+        closer.enter_context(logfile)
+        segments = None
         stat = os.stat(logfile.fileno())
-        debug_echo('logfile inode={}, size={}'.format(stat.st_ino, stat.st_size))
-        inode, offset = _parse_offset_file(offset_path)
-        if inode is not None:
-            if stat.st_ino == inode:
-                debug_echo('inodes are the same')
+        debug_echo('logfile inode={}, size={}', stat.st_ino, stat.st_size)
+        staged = pending.get(offset_path) if pending is not None else None
+        state = staged if staged is not None else _parse_offset_file(offset_path)
+        prior = staged['read'] if staged is not None else 0
+        prior_elapsed = staged['elapsed'] if staged is not None else 0
+        limit = chunk_bytes
+        # unlike a chunk, the limit for the run may end inside a compressed file
+        run_limit = max_bytes - prior if max_bytes is not None else math.inf
+        if max_bytes is not None:
+            limit = run_limit if limit is None else min(limit, run_limit)
+        if limit is not None and limit <= 0:
+            debug_echo('byte limit for this run already reached')
+            return
+        start = time.monotonic()
+        deadline = start + max_seconds - prior_elapsed if max_seconds is not None else None
+        if deadline is not None and deadline <= start:
+            debug_echo('time limit for this run already reached')
+            return
+        offset = 0
+        index = None
+        if index_interval is not None:
+            index = _load_index(offset_path + '.index', index_interval, logfile.fileno(), stat)
+        seen = None
+        if seen_filter_size is not None:
+            seen = staged.get('seen') if staged is not None else None
+            if seen is None:
+                seen = BloomFilter(offset_path + '.seen', seen_filter_size)
+        skipping = since is not None and staged is None
+        # without an offset, skip the lines which have already been read
+        recovering = seen is not None and seen.count > 0 and state is None and not skipping
+        recovered = 0
+        if skipping:
+            segments, offset = _open_since(path, logfile, since, get_time, closer, index)
+        elif state is not None:
+            if stat.st_ino == state['inode'] and _check_content(logfile.fileno(), state):
+                debug_echo('inodes are the same and content matches')
+                offset = state['offset']
                 if offset == stat.st_size:
                     debug_echo('offset points to eof')
+                    if pending is not None and staged is None:
+                        pending[offset_path] = dict(state, read=0, elapsed=0, more=False, backlog=False)
                     return
-                elif offset > stat.st_size:
-                    warning_echo('File shrunk since last read: {} ({} < {})'.format(path, stat.st_size, offset))
-                    offset = 0
+            elif stat.st_ino == state['inode']:
+                # copytruncate or a new file that got the inode of the old one
+                debug_echo('content changed, checking for a copy of the old file')
+                segments = _open_rotated_files(path, state, closer, by_content=True)
+                if segments is None:
+                    warning_echo('File truncated or replaced since last read: {}'.format(path))
             else:
-                debug_echo('inode changed, checking for rotated file')
-                rotated_path = _check_rotated_file(path, inode)
-                if rotated_path is not None:
-                    try:
-                        rotated_file = open(rotated_path, encoding='utf-8', errors='replace')
-                    except OSError as exc:
-                        warning_echo('Could not read rotated file: {} ({})'.format(rotated_path, exc))
-                    else:
-                        closer.enter_context(rotated_file)
-                        rotated_file.seek(offset)
-                        line_iter = itertools.chain(line_iter, iter(rotated_file))
-                offset = 0
+                debug_echo('inode changed, checking for rotated files')
+                segments = _open_rotated_files(path, state, closer)
+                if segments is None:
+                    warning_echo('Could not find rotated file with unread data: {}'.format(path))
         logfile.seek(offset)
-        line_iter = itertools.chain(line_iter, iter(logfile))
-        for line in line_iter:
-            line = line.strip()
-            yield line
-        pos = logfile.tell()
-        debug_echo('reached end of logfile at {}'.format(pos))
-        if not dry_run:
+        segments = (segments or []) + [(path, logfile, offset)]
+        total = 0
+        stopped = False
+        past_until = False
+        max_length = max_line_length or math.inf
+        read_limit = max_line_length + 1 if max_line_length is not None else -1
+        held_state = None
+        for segment_path, fileobj, pos in segments:
+            start_pos = pos
+            # the lines of the current entry when using `continuation`
+            held = []
+            held_pos = held_size = 0
+            compressed = _is_compressed(segment_path)
+            # resuming inside a compressed file means decompressing everything before the offset again,
+            # so the next chunk starts after it
+            segment_limit = run_limit if compressed else limit
+            fd = fileobj.fileno() if throttle is not None and not compressed else None
+            if fd is not None:
+                throttle.start(fd, pos)
+            unthrottled = 0
+            # lines can only be counted when starting where the index ends or before
+            indexer = _IndexUpdater(index, pos, get_time) if index is not None and fileobj is logfile else None
+            index_next = indexer.next if indexer is not None else math.inf
+            line_count = 0
+            tracked = seen if fileobj is logfile else None
+            if tracked is not None and pos == 0 and not recovering:
+                tracked.clear()
+            for line in iter(partial(fileobj.readline, read_limit), b''):
+                size = len(line)
+                if size > max_length and line[-1:] != b'\n':
+                    line, size = _truncate_line(fileobj, line, max_line_length)
+                    if stats is not None:
+                        stats['truncated'] += 1
+                # leading whitespace may indicate a continuation line, so only strip the line break
+                decoded = line.decode('utf-8', 'replace').rstrip('\r\n')
+                line_time = get_time(decoded) if skipping or until is not None else None
+                if until is not None and line_time is not None and line_time > until:
+                    debug_echo('reached the end of the time range')
+                    stopped = past_until = True
+                    break
+                if pos >= index_next:
+                    index_next = indexer.update(pos, line_count, decoded, line_time)
+                line_count += 1
+                pos += size
+                if throttle is not None:
+                    unthrottled += size
+                    if unthrottled >= THROTTLE_CHUNK_SIZE:
+                        throttle.consume(fd, pos, unthrottled)
+                        unthrottled = 0
+                if skipping:
+                    if line_time is None or line_time < since:
+                        continue
+                    skipping = False
+                if recovering:
+                    if line in seen:
+                        recovered += 1
+                        continue
+                    recovering = False
+                total += size
+                if continuation is not None:
+                    if held and continuation(decoded):
+                        held.append((line, decoded))
+                        held_size += size
+                    else:
+                        for held_line, held_decoded in held:
+                            if tracked is not None:
+                                tracked.add(held_line)
+                            yield held_decoded
+                        held = [(line, decoded)]
+                        held_pos = pos - size
+                        held_size = size
+                else:
+                    if tracked is not None:
+                        tracked.add(line)
+                    yield decoded
+                if ((segment_limit is not None and total >= segment_limit) or
+                        (deadline is not None and time.monotonic() >= deadline)):
+                    stopped = True
+                    break
+            if throttle is not None:
+                throttle.consume(fd, pos, unthrottled)
+            if indexer is not None:
+                indexer.finish(pos, line_count)
+            hold = False
+            if held and fileobj is logfile and not past_until:
+                if stopped:
+                    # the entry may continue right after the limit, but it must not stop us from making progress
+                    hold = held_pos > start_pos or fileobj is not segments[0][1]
+                elif hold_open is not None:
+                    prev_held = state.get('held') if state is not None else None
+                    now = time.monotonic()
+                    held_since = prev_held[1] if prev_held is not None and prev_held[0] == held_pos else now
+                    hold = now - held_since < hold_open
+                    if hold:
+                        held_state = (held_pos, held_since)
+            if hold:
+                debug_echo('keeping back the entry at {}', held_pos)
+                pos = held_pos
+                total -= held_size
+            else:
+                for held_line, held_decoded in held:
+                    if tracked is not None:
+                        tracked.add(held_line)
+                    yield held_decoded
+            if stopped:
+                break
+        debug_echo('stopped reading {} at {} after {} bytes', segment_path, pos, total)
+        if recovered:
+            warning_echo('Offset lost, skipped {} lines which have already been read: {}'.format(recovered, path))
+        if fileobj is not logfile:
+            debug_echo('byte limit reached before the current logfile')
+        new_state = _make_state(segment_path, fileobj, pos)
+        new_state['read'] = prior + total
+        new_state['elapsed'] = prior_elapsed + time.monotonic() - start
+        if state is not None and state.get('checked') is not None:
+            new_state['checked'] = state['checked']
+        new_state['backlog'] = fileobj is not logfile or pos < os.fstat(logfile.fileno()).st_size
+        new_state['more'] = (new_state['backlog'] and not past_until and held_state is None and
+                             (max_bytes is None or new_state['read'] < max_bytes) and
+                             (max_seconds is None or new_state['elapsed'] < max_seconds))
+        if held_state is not None:
+            new_state['held'] = held_state
+        if index is not None and not dry_run:
+            # the index only describes the file, so it does not need to wait for the actions
+            index.save()
+        if seen is not None:
+            new_state['seen'] = seen
+        if pending is not None:
+            debug_echo('staging new offset')
+            pending[offset_path] = new_state
+        elif not dry_run:
             debug_echo('writing offset file: ' + offset_path)
-            _write_offset_file(offset_path, stat.st_ino, pos)
+            _write_offset_file(offset_path, new_state)
+            if seen is not None:
+                seen.save()
         else:
             debug_echo('dry run - not writing offset file')
 
 
-def _check_rotated_file(path, inode):
-    for func in (_check_rotated_numext, _check_rotated_dateext):
-        rotated_path = func(path)
-        if rotated_path is None:
-            debug_echo('no rotated file found using ' + func.__name__)
+def commit_offsets(pending):
+    """Write offsets staged by `logtail`.
+
+    :param pending: The dict passed to `logtail` as `pending`
+    """
+    for offset_path, state in sorted(pending.items()):
+        debug_echo('writing offset file: ' + offset_path)
+        _write_offset_file(offset_path, state)
+        if state.get('seen') is not None:
+            state['seen'].save()
+
+
+def load_state(path, offset_path=None):
+    """Load the state stored in the offset file of a logfile.
+
+    :param path: The path of the logfile
+    :param offset_path: The path of the offset file.  If not set,
+                        ``<file>.offset`` will be used.
+    :return: A dict containing the state or ``None`` if there is no
+             valid offset file.
+    """
+    return _parse_offset_file(offset_path if offset_path is not None else path + '.offset')
+
+
+class _IndexUpdater(object):
+    """Add entries to a `LogIndex` while reading a logfile.
+
+    To keep the overhead for each line low, `update` only needs to be
+    called for lines starting at or after the position returned by
+    the previous call (or `next`).
+    """
+
+    def __init__(self, index, pos, get_time):
+        self.index = index
+        self.get_time = get_time
+        self.probes = 0
+        # the number of lines before the current position
+        self.base = index.end_line if pos == index.end else None
+        if pos > index.end:
+            debug_echo('not updating index since it ends before the current position')
+            self.next = math.inf
+        else:
+            self.next = index.end if self.base is None else max(index.next_offset, index.end)
+
+    def update(self, pos, count, line, line_time):
+        """Handle a line.
+
+        :param pos: The position of the line
+        :param count: The number of lines read before it
+        :param line: The line
+        :param line_time: The timestamp of the line if already known
+        :return: The position of the next line that needs to be passed
+        """
+        index = self.index
+        if self.base is None:
+            if pos != index.end:
+                debug_echo('not updating index since it does not end at a line boundary')
+                return math.inf
+            self.base = index.end_line - count
+        if pos >= index.next_offset and pos >= index.end:
+            index.add(pos, self.base + count)
+            self.probes = PROBE_LINES if self.get_time is not None else 0
+        if self.probes:
+            self.probes -= 1
+            if line_time is None:
+                line_time = self.get_time(line)
+            if line_time is not None:
+                index.set_time(line_time)
+                self.probes = 0
+        # while looking for a timestamp, we need to see the next line
+        return pos + 1 if self.probes else max(index.next_offset, index.end)
+
+    def finish(self, pos, count):
+        """Update the end of the index after reading stopped."""
+        if self.base is not None:
+            self.index.advance(pos, self.base + count)
+
+
+def _load_index(path, interval, fd, stat):
+    index = LogIndex(path, interval)
+    head = _fingerprint(os.pread(fd, FINGERPRINT_SIZE, 0))
+    if (index.head is None or index.end > stat.st_size or
+            not index.matches(stat.st_ino, _fingerprint(os.pread(fd, index.head[0], 0)))):
+        index.reset(stat.st_ino, head)
+    else:
+        index.update_head(head)
+    return index
+
+
+def find_time_offset(fileobj, since, get_time, index=None):
+    """Find the position of the first entry logged at or after a time.
+
+    This performs a binary search in the file, which requires the
+    entries to be in chronological order.  For each probe only a few
+    lines after the probed position are read until one containing a
+    timestamp is found.  Once the remaining range is small, the search
+    stops, so the returned position may be up to a few KiB before the
+    entry; the lines before it need to be skipped by the caller.
+
+    :param fileobj: An uncompressed logfile opened in binary mode
+    :param since: A unix timestamp
+    :param get_time: A function returning the unix timestamp of a line
+                     or ``None`` if it has none
+    :param index: A `LogIndex` of the file used to narrow down the
+                  range which needs to be searched
+    :return: The position of a line boundary before the first entry
+             logged at or after `since`
+    """
+    lo = 0
+    hi = os.fstat(fileobj.fileno()).st_size
+    if index is not None:
+        lo, end = index.find_time(since)
+        if end is not None:
+            hi = min(hi, end)
+        debug_echo('index narrowed the search to {}-{}', lo, hi)
+    probes = 0
+    while hi - lo > _TIME_SEARCH_SIZE:
+        mid = (lo + hi) // 2
+        pos, end, line_time = _probe_time(fileobj, mid, hi, get_time)
+        probes += 1
+        if line_time is None:
+            hi = mid
+        elif line_time < since:
+            lo = end
+        else:
+            hi = pos
+    debug_echo('found time offset {} after {} probes', lo, probes)
+    return lo
+
+
+def _probe_time(fileobj, pos, end, get_time):
+    """Get the first timestamp after a position in a file.
+
+    :return: A ``(start, end, time)`` tuple containing the positions of
+             the first line starting at or after `pos` which contains
+             a timestamp and the timestamp, or ``(None, None, None)``
+             if no such line was found within `PROBE_LINES` lines.
+    """
+    if pos:
+        # align to the beginning of the next line
+        fileobj.seek(pos - 1)
+        pos += _read_line(fileobj, _SKIP_CHUNK_SIZE)[1] - 1
+    else:
+        fileobj.seek(0)
+    for __ in range(PROBE_LINES):
+        if pos >= end:
+            break
+        line, size = _read_line(fileobj, _SKIP_CHUNK_SIZE)
+        if not line:
+            break
+        line_time = get_time(line.decode('utf-8', 'replace').strip())
+        if line_time is not None:
+            return pos, pos + size, line_time
+        pos += size
+    return None, None, None
+
+
+def _first_time(fileobj, get_time):
+    for __ in range(PROBE_LINES):
+        line = _read_line(fileobj, _SKIP_CHUNK_SIZE)[0]
+        if not line:
+            break
+        line_time = get_time(line.decode('utf-8', 'replace').strip())
+        if line_time is not None:
+            return line_time
+    return None
+
+
+def _open_since(path, logfile, since, get_time, closer, index=None):
+    """Open the files containing the entries logged since a time.
+
+    The rotated generations of the logfile are checked starting with
+    the newest one until one which starts before `since` is found.
+
+    :return: A ``(segments, offset)`` tuple.  `segments` is a list of
+             ``(path, fileobj, offset)`` tuples of rotated files with
+             the oldest one first, and `offset` the position in the
+             logfile from which it needs to be read.
+    """
+    generations = [(path, logfile)]
+    first = _first_time(logfile, get_time)
+    if first is None or first >= since:
+        for rotated_path in find_rotated_files(path):
+            try:
+                with _open_logfile(rotated_path) as f:
+                    first = _first_time(f, get_time)
+                # compressed files cannot be rewound cheaply, so we open them again
+                rotated_file = closer.enter_context(_open_logfile(rotated_path))
+            except (OSError, EOFError) as exc:
+                warning_echo('Could not read rotated file: {} ({})'.format(rotated_path, exc))
+                break
+            generations.append((rotated_path, rotated_file))
+            if first is not None and first < since:
+                break
+    generations.reverse()
+    debug_echo('reading entries since {} from {}', since, ', '.join(p for p, __ in generations))
+    segments = []
+    for i, (segment_path, fileobj) in enumerate(generations):
+        offset = 0
+        if not _is_compressed(segment_path):
+            if i == 0:
+                offset = find_time_offset(fileobj, since, get_time, index if fileobj is logfile else None)
+            fileobj.seek(offset)
+        segments.append((segment_path, fileobj, offset))
+    return segments[:-1], segments[-1][2]
+
+
+def _open_rotated_files(path, state, closer, by_content=False):
+    """Open all rotated files which may contain unread data.
+
+    :param by_content: Whether uncompressed files with a different
+                       inode may be used if their content matches.
+    :return: A list of ``(path, fileobj, offset)`` tuples with the
+             oldest file first or ``None`` if no matching file was
+             found.  The file object of the oldest file is already
+             positioned at the stored offset.
+    """
+    generations = find_rotated_files(path)
+    index = _find_generation(generations, state, by_content)
+    if index is None:
+        return None
+    if index:
+        debug_echo('reading {} rotated generations', index + 1)
+    segments = []
+    for i, rotated_path in enumerate(reversed(generations[:index + 1])):
+        offset = state['offset'] if i == 0 else 0
+        try:
+            rotated_file = _open_logfile(rotated_path)
+            if _is_compressed(rotated_path):
+                _skip(rotated_file, offset)
+            else:
+                rotated_file.seek(offset)
+        except (OSError, EOFError) as exc:
+            warning_echo('Could not read rotated file: {} ({})'.format(rotated_path, exc))
+        else:
+            closer.enter_context(rotated_file)
+            segments.append((rotated_path, rotated_file, offset))
+    return segments
+
+
+def _open_logfile(path):
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(path)[1], open)
+    return opener(path, 'rb')
+
+
+def _is_compressed(path):
+    return os.path.splitext(path)[1] in COMPRESSED_OPENERS
+
+
+def _skip(fileobj, count):
+    """Skip `count` bytes in a possibly compressed file.
+
+    Compressed files are not seekable so the data is decompressed
+    chunk by chunk instead of reading it all into memory.
+    """
+    while count > 0:
+        chunk = fileobj.read(min(count, _SKIP_CHUNK_SIZE))
+        if not chunk:
+            raise EOFError('file ended {} bytes before the stored offset'.format(count))
+        count -= len(chunk)
+
+
+def _read_line(fileobj, max_length):
+    """Read a line, keeping at most `max_length` bytes of it.
+
+    :return: A ``(line, size)`` tuple like the one returned by
+             `_truncate_line`.  The line is empty at the end of the
+             file.
+    """
+    line = fileobj.readline(max_length + 1)
+    if len(line) > max_length and line[-1:] != b'\n':
+        return _truncate_line(fileobj, line, max_length)
+    return line, len(line)
+
+
+def _truncate_line(fileobj, head, max_length):
+    """Skip the rest of an overly long line.
+
+    The data is read chunk by chunk and discarded, so a huge line
+    without line breaks does not end up in memory.
+
+    :param fileobj: The file, positioned after `head`
+    :param head: The beginning of the line
+    :param max_length: The number of bytes of the line that are kept
+    :return: A ``(line, size)`` tuple containing the truncated line and
+             the number of bytes the full line occupies in the file.
+    """
+    size = len(head)
+    while True:
+        chunk = fileobj.readline(_SKIP_CHUNK_SIZE)
+        size += len(chunk)
+        if not chunk or chunk[-1:] == b'\n':
+            break
+    removed = size - max_length - (1 if chunk else 0)
+    return head[:max_length] + ' [{} bytes truncated]'.format(removed).encode(), size
+
+
+def _fingerprint(data):
+    return len(data), hashlib.sha1(data).hexdigest()
+
+
+def _file_fingerprint(path, size):
+    with _open_logfile(path) as f:
+        return _fingerprint(f.read(size))
+
+
+def _find_generation(generations, state, by_content=False):
+    """Find the rotated file matching the stored state.
+
+    Uncompressed files are identified by their inode, compressed ones
+    (and uncompressed ones when `by_content` is set, e.g. after a
+    copytruncate rotation) by a fingerprint of their content.
+
+    :param generations: A list of rotated files, newest first
+    :param state: The state from the offset file
+    :param by_content: Whether to allow uncompressed files with a
+                       different inode.
+    :return: The index of the matching file or ``None``
+    """
+    for i, rotated_path in enumerate(generations):
+        try:
+            if _is_compressed(rotated_path):
+                matches = _check_compressed_content(rotated_path, state)
+            else:
+                with open(rotated_path, 'rb') as f:
+                    same_inode = os.fstat(f.fileno()).st_ino == state['inode']
+                    if same_inode or (by_content and state['head'] is not None):
+                        matches = _check_content(f.fileno(), state)
+                    else:
+                        matches = False
+        except (OSError, EOFError) as exc:
+            debug_echo('could not check {}: {}', rotated_path, exc)
             continue
-        debug_echo('found rotated file candidate using {}: {}'.format(func.__name__, rotated_path))
-        if os.stat(rotated_path).st_ino == inode:
-            debug_echo('inodes match, using candidate')
-            return rotated_path
+        if matches:
+            debug_echo('using {}', rotated_path)
+            return i
+        debug_echo('discarding {}', rotated_path)
+    return None
+
+
+def _check_content(fd, state):
+    """Check whether a file contains the data we read before.
+
+    This compares the size and the fingerprints of the beginning of
+    the file and of the data right before the stored offset, which
+    only needs two small reads.
+    """
+    if os.fstat(fd).st_size < state['offset']:
+        debug_echo('file is smaller than the stored offset')
+        return False
+    if state['head'] is not None and _fingerprint(os.pread(fd, state['head'][0], 0)) != state['head']:
+        debug_echo('head fingerprints do not match')
+        return False
+    if state['tail'] is not None:
+        size = state['tail'][0]
+        if _fingerprint(os.pread(fd, size, state['offset'] - size)) != state['tail']:
+            debug_echo('tail fingerprints do not match')
+            return False
+    return True
+
+
+def _check_compressed_content(path, state):
+    if state['head'] is None:
+        debug_echo('no fingerprint available for compressed file')
+        return False
+    return _file_fingerprint(path, state['head'][0]) == state['head']
+
+
+def _make_state(path, fileobj, pos):
+    if _is_compressed(path):
+        return {'inode': os.stat(path).st_ino,
+                'offset': pos,
+                'head': _file_fingerprint(path, FINGERPRINT_SIZE),
+                'tail': None}
+    fd = fileobj.fileno()
+    tail_size = min(pos, FINGERPRINT_SIZE)
+    return {'inode': os.fstat(fd).st_ino,
+            'offset': pos,
+            'head': _fingerprint(os.pread(fd, FINGERPRINT_SIZE, 0)),
+            'tail': _fingerprint(os.pread(fd, tail_size, pos - tail_size))}
+
+
+def read_logfile(path, max_line_length=None):
+    """Yield all lines of a logfile, which may be compressed.
+
+    Unlike `logtail`, this neither uses nor updates the offset file.
+    Like there, only the line breaks are removed from the lines.
+
+    :param path: The path of the logfile
+    :param max_line_length: The maximum number of bytes of a line, see
+                            `logtail`.
+    """
+    with _open_logfile(path) as f:
+        if max_line_length is None:
+            lines = iter(f)
         else:
-            debug_echo('inodes do not match, discarding candidate')
+            lines = (line for line, __ in iter(partial(_read_line, f, max_line_length), (b'', 0)))
+        for line in lines:
+            yield line.decode('utf-8', 'replace').rstrip('\r\n')
+
 
+def find_rotated_files(path):
+    """Find all rotated generations of a logfile, newest first."""
+    generations = _find_rotated_numext(path) + _find_rotated_dateext(path)
+    debug_echo('found rotated files: {}', ', '.join(generations) or 'none')
+    return generations
 
-def _check_rotated_numext(path):
-    if os.path.isfile(path + '.1'):
-        return path + '.1'
 
+def _find_rotated_numext(path):
+    numext_re = re.compile(r'\.(\d+)(?:{})?$'.format('|'.join(map(re.escape, COMPRESSED_OPENERS))))
+    candidates = []
+    for candidate in glob(glob_escape(path) + '.*'):
+        match = numext_re.match(candidate[len(path):])
+        if match and os.path.isfile(candidate):
+            candidates.append((int(match.group(1)), candidate))
+    return [candidate for __, candidate in sorted(candidates)]
 
-def _check_rotated_dateext(path):
-    candidates = [x for x in glob(path + '-????????') if x[-8:].isdigit() and os.path.isfile(x)]
-    if candidates:
-        return sorted(candidates)[-1]
+
+def _find_rotated_dateext(path):
+    dateext_re = re.compile(r'-(\d{{8}})(?:{})?$'.format('|'.join(map(re.escape, COMPRESSED_OPENERS))))
+    candidates = []
+    for candidate in glob(glob_escape(path) + '-????????*'):
+        match = dateext_re.match(candidate[len(path):])
+        if match and os.path.isfile(candidate):
+            candidates.append((match.group(1), candidate))
+    return [candidate for __, candidate in sorted(candidates, reverse=True)]
 
 
 def _parse_offset_file(path):
@@ -99,21 +868,35 @@ def _parse_offset_file(path):
         with open(path) as f:
             inode = int(f.readline())
             offset = int(f.readline())  # pragma: no branch
+            extra = dict(line.rstrip('\n').split('=', 1) for line in f if '=' in line)
+            head = _parse_fingerprint(extra['head']) if 'head' in extra else None
+            tail = _parse_fingerprint(extra['tail']) if 'tail' in extra else None
+            checked = float(extra['checked']) if 'checked' in extra else None
     except FileNotFoundError as exc:
-        debug_echo('open() failed: {}'.format(exc))
-        return None, 0
+        debug_echo('open() failed: {}', exc)
+        return None
     except ValueError as exc:
-        debug_echo('could not parse: {}'.format(exc))
-        return None, 0
+        debug_echo('could not parse: {}', exc)
+        return None
     else:
-        debug_echo('inode={}, offset={}'.format(inode, offset))
-        return inode, offset
+        debug_echo('inode={}, offset={}', inode, offset)
+        return {'inode': inode, 'offset': offset, 'head': head, 'tail': tail, 'checked': checked}
+
+
+def _parse_fingerprint(value):
+    size, digest = value.split(':')
+    return int(size), digest
 
 
-def _write_offset_file(path, inode, offset):
+def _write_offset_file(path, state):
     try:
         with open(path, 'w') as offset_file:
             os.fchmod(offset_file.fileno(), 0o600)
-            offset_file.write('{}\n{}\n'.format(inode, offset))  # pragma: no branch
+            offset_file.write('{}\n{}\n'.format(state['inode'], state['offset']))
+            for key in ('head', 'tail'):
+                if state.get(key) is not None:
+                    offset_file.write('{}={}:{}\n'.format(key, *state[key]))
+            if state.get('checked') is not None:
+                offset_file.write('checked={}\n'.format(state['checked']))
     except OSError as exc:
         warning_echo('Could not write: {} ({})'.format(path, exc))
@@ -0,0 +1,247 @@
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from logstapo.backtracking import quarantine_scope
+from logstapo.logs import SpaceSaving, assemble_records
+from logstapo.logtail import find_rotated_files, read_logfile
+from logstapo.util import try_match
+
+
+class ReplayStats(object):
+    """Statistics about replaying the logfiles of a log."""
+
+    def __init__(self):
+        self.files = 0
+        self.lines = 0
+        self.garbage = 0
+        self.invalid = 0
+        self.ignored = 0
+        self.other = 0
+        #: The number of seconds spent processing the files
+        self.elapsed = 0
+        #: The number of entries matched by each garbage pattern
+        self.garbage_hits = Counter()
+        #: The number of entries matched by each ignore pattern, using
+        #: ``(source_pattern, pattern)`` keys
+        self.ignore_hits = Counter()
+        #: The number of unusual entries for each ``(source, template)``
+        self.templates = Counter()
+        #: An example line for each template
+        self.examples = {}
+        #: Error messages for files that could not be read
+        self.errors = []
+
+    def __repr__(self):
+        return '<ReplayStats(files={}, lines={})>'.format(self.files, self.lines)
+
+    @property
+    def lines_per_second(self):
+        return self.lines / self.elapsed if self.elapsed else 0
+
+    def merge(self, other):
+        """Add the statistics of another file."""
+        for attr in ('files', 'lines', 'garbage', 'invalid', 'ignored', 'other', 'elapsed'):
+            setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+        self.garbage_hits.update(other.garbage_hits)
+        self.ignore_hits.update(other.ignore_hits)
+        self.templates.update(other.templates)
+        for key, example in other.examples.items():
+            self.examples.setdefault(key, example)
+        self.errors += other.errors
+
+
+def _find_ignore_pattern(parsed, ignore):
+    for source_pattern, patterns in ignore.items():
+        if not source_pattern.test(parsed['source']):
+            continue
+        pattern = next((x for x in patterns if x.test(parsed['message'])), None)
+        if pattern is not None:
+            return source_pattern.pattern, pattern.pattern
+    return None
+
+
+def replay_file(path, data, regexps, capacity=1000, max_line_length=None):
+    """Apply the rules of a log to a logfile.
+
+    This runs in a worker process, so it must not use the current
+    config or print anything.
+
+    :param path: The path of the logfile, which may be compressed
+    :param data: The definition of the log from the config
+    :param regexps: The compiled regexps of the log
+    :param capacity: The number of templates tracked
+    :param max_line_length: The maximum number of bytes of a line
+    :return: A `ReplayStats` object
+    """
+    stats = ReplayStats()
+    stats.files = 1
+    garbage = data['garbage']
+    ignore = data['ignore']
+    summary = SpaceSaving(capacity)
+    start = time.perf_counter()
+    lines = read_logfile(path, max_line_length)
+    if data['multiline'] is not None:
+        records = assemble_records(lines, regexps, **data['multiline'])
+    else:
+        records = ((line.strip(), None, None) for line in lines)
+    try:
+        for head, match, continued in records:
+            stats.lines += 1 + len(continued) if continued else 1
+            pattern = next((x for x in garbage if x.test(head)), None) if garbage else None
+            if pattern is not None:
+                stats.garbage += 1
+                stats.garbage_hits[pattern.pattern] += 1
+                continue
+            if match is None:
+                match = try_match(regexps, head)
+            if match is None:
+                stats.invalid += 1
+                continue
+            parsed = match.groupdict()
+            pattern = _find_ignore_pattern(parsed, ignore)
+            if pattern is not None:
+                stats.ignored += 1
+                stats.ignore_hits[pattern] += 1
+                continue
+            stats.other += 1
+            line = head
+            if continued:
+                line = '\n'.join([head] + continued)
+                parsed['message'] = '\n'.join([parsed['message']] + continued)
+            summary.add(line, parsed)
+    except (OSError, EOFError) as exc:
+        stats.errors.append('Could not read {} ({})'.format(path, exc))
+    for line, parsed in summary.results():
+        key = (parsed['source'], parsed['template'])
+        stats.templates[key] = parsed['count']
+        stats.examples[key] = line
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+def find_replay_files(data):
+    """Get the configured files of a log and their rotated generations.
+
+    :param data: The definition of the log from the config
+    :return: A list of paths with the oldest files of each logfile first
+    """
+    paths = []
+    for path in data['files']:
+        paths += reversed(find_rotated_files(path))
+        if os.path.exists(path):
+            paths.append(path)
+    return paths
+
+
+def replay_logs(tasks, jobs=None, max_line_length=None):
+    """Replay logfiles using the rules of logs.
+
+    All files are processed in parallel.
+
+    :param tasks: A dict mapping keys to ``(data, regexps, paths)``
+                  tuples containing a log definition, its compiled
+                  regexps and the files to process
+    :param jobs: The number of processes to use.  Defaults to the
+                 number of CPUs.
+    :param max_line_length: The maximum number of bytes of a line
+    :return: A dict mapping the keys from `tasks` to `ReplayStats`
+    """
+    items = [(key, path, data, regexps) for key, (data, regexps, paths) in tasks.items() for path in paths]
+    func = partial(replay_file, max_line_length=max_line_length)
+    if jobs == 1 or len(items) <= 1:
+        with quarantine_scope():
+            results = [func(path, data, regexps) for __, path, data, regexps in items]
+    else:
+        # each replay uses new worker processes, so their quarantine is per run as well
+        with ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(func, *zip(*[item[1:] for item in items])))
+    rv = {key: ReplayStats() for key in tasks}
+    for (key, __, __, __), stats in zip(items, results):
+        rv[key].merge(stats)
+    return rv
+
+
+def _format_pattern(pattern):
+    if isinstance(pattern, tuple):
+        source, pattern = pattern
+        return '{}: {}'.format(source or '*', pattern)
+    return pattern
+
+
+def format_stats(name, stats, top=10):
+    """Format the results of replaying a log.
+
+    :param name: The name of the log
+    :param stats: A `ReplayStats` object
+    :param top: The number of templates to show
+    :return: A list of lines
+    """
+    lines = ["Log '{}': {} lines in {} files, {:.1f}s ({:.0f} lines/s)".format(
+        name, stats.lines, stats.files, stats.elapsed, stats.lines_per_second)]
+    lines += ['  ' + error for error in stats.errors]
+    lines.append('  {} garbage / {} invalid / {} ignored / {} other'.format(
+        stats.garbage, stats.invalid, stats.ignored, stats.other))
+    for title, hits in (('Garbage patterns', stats.garbage_hits), ('Ignore patterns', stats.ignore_hits)):
+        if hits:
+            lines.append('  {}:'.format(title))
+            lines += ['    {:>8}  {}'.format(count, _format_pattern(pattern)) for pattern, count in hits.most_common()]
+    if top and stats.templates:
+        lines.append('  Top unusual templates:')
+        lines += ['    {:>8}x {}: {}'.format(count, source, template)
+                  for (source, template), count in stats.templates.most_common(top)]
+    return lines
+
+
+def format_diff(name, old, new, top=10):
+    """Format the differences between replaying a log with two configs.
+
+    :param name: The name of the log
+    :param old: A `ReplayStats` object with the results of the config
+    :param new: A `ReplayStats` object with the results of the config
+                it is compared to
+    :param top: The maximum number of templates shown in each category
+    :return: A list of lines
+    """
+    lines = ["Log '{}': {} lines in {} files".format(name, old.lines, old.files)]
+    lines.append('  {:<10} {:>10} {:>10} {:>10}'.format('', 'old', 'new', 'change'))
+    for attr in ('garbage', 'invalid', 'ignored', 'other'):
+        old_value = getattr(old, attr)
+        new_value = getattr(new, attr)
+        lines.append('  {:<10} {:>10} {:>10} {:>+10}'.format(attr, old_value, new_value, new_value - old_value))
+    lines.append('  {:<10} {:>10.0f} {:>10.0f} {:>+9.0f}%'.format(
+        'lines/s', old.lines_per_second, new.lines_per_second,
+        (new.lines_per_second / old.lines_per_second - 1) * 100 if old.lines_per_second else 0))
+    for title, old_hits, new_hits in (('Garbage patterns', old.garbage_hits, new.garbage_hits),
+                                      ('Ignore patterns', old.ignore_hits, new.ignore_hits)):
+        changed = sorted(((pattern, old_hits[pattern], new_hits[pattern])
+                          for pattern in set(old_hits) | set(new_hits)
+                          if old_hits[pattern] != new_hits[pattern]), key=lambda x: str(x[0]))
+        if changed:
+            lines.append('  {} with different hits:'.format(title))
+            lines += ['    {:>8} -> {:<8} {}'.format(old_count, new_count, _format_pattern(pattern))
+                      for pattern, old_count, new_count in changed]
+    for title, first, second in (('New unusual templates', new, old), ('No longer reported', old, new)):
+        only = Counter({key: count for key, count in first.templates.items() if key not in second.templates})
+        if only and top:
+            lines.append('  {}:'.format(title))
+            lines += ['    {:>8}x {}: {}'.format(count, source, template)
+                      for (source, template), count in only.most_common(top)]
+    return lines
+
+
+def build_tasks(config, names, paths=None):
+    """Get the tasks for `replay_logs` for some logs.
+
+    :param config: The `Config` to use
+    :param names: The names of the logs to replay
+    :param paths: The files to replay instead of the configured ones
+    """
+    tasks = {}
+    for name in names:
+        data = config['logs'][name]
+        regexps = [config['regexps'][regex_name] for regex_name in data['regexps']]
+        tasks[name] = (data, regexps, list(paths) if paths is not None else find_replay_files(data))
+    return tasks
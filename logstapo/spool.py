@@ -0,0 +1,390 @@
+import fcntl
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+
+from logstapo.actions import dispatch_actions, group_results
+from logstapo.config import bind_config, current_config
+from logstapo.util import debug_echo, warning_echo, error_echo
+
+
+#: Header of records written by older versions: the size of the
+#: compressed record
+_LEGACY_HEADER = struct.Struct('>I')
+#: Header of a record: magic, size of the metadata, size of the data
+_HEADER = struct.Struct('>4sII')
+#: Since a legacy record cannot be larger than 4 GiB, this can never
+#: be the beginning of one
+_MAGIC = b'\xffLS2'
+
+
+class Spool(object):
+    """A file containing action results which have not been delivered.
+
+    Each record consists of a small JSON document with its metadata
+    (id, action and number of failed delivery attempts) followed by
+    the zlib-compressed JSON document with the data for the action,
+    both prefixed with their length.  This allows reading the
+    metadata of all records while skipping their data, which is only
+    loaded for one record at a time when delivering it.  New records
+    are appended to the file; removing records rewrites the file
+    atomically.
+
+    Records which still could not be delivered after `max_attempts`
+    attempts are moved to ``<path>.parked``, which uses the same
+    format, so they do not keep failing forever.
+
+    :param path: The path of the spool file
+    :param max_attempts: The number of delivery attempts (across all
+                         runs) after which a record is parked, or
+                         ``None`` to keep retrying forever
+    """
+
+    def __init__(self, path, max_attempts=None):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<Spool({!r})>'.format(self.path)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock, open(self.path + '.lock', 'a') as lockfile:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            yield
+
+    @contextmanager
+    def claim(self):
+        """Get exclusive permission to deliver records from the spool.
+
+        Only one process may deliver records at a time so the same
+        record is never delivered by two instances running at the same
+        time.  The permission is held until the context manager exits;
+        adding records to the spool is still possible in the meantime.
+
+        :return: A context manager yielding ``True`` if the permission
+                 has been acquired and ``False`` if another process is
+                 delivering records right now.
+        """
+        with open(self.path + '.deliver.lock', 'a') as lockfile:
+            try:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+            else:
+                yield True
+
+    def append(self, records):
+        """Append records to the spool.
+
+        :param records: A list of dicts containing the `id`, `action`,
+                        `data` and `attempts` of each record.  The data
+                        needs to be serializable as JSON.
+        """
+        with self._locked():
+            _append(self.path, (_pack(record) for record in records))
+
+    def read(self):
+        """Read all records from the spool, including their data."""
+        with self._locked():
+            return [dict(_public_meta(meta), data=_load_data(f, meta)) for f, meta in self._scan()]
+
+    def entries(self):
+        """Read the metadata of all records from the spool.
+
+        :return: A list of dicts containing the `id`, `action` and
+                 `attempts` of each record.  Use `load` to get the
+                 data of a record.
+        """
+        with self._locked():
+            return [dict(_public_meta(meta), pos=meta['pos']) for __, meta in self._scan()]
+
+    def load(self, entry):
+        """Load the data of a record.
+
+        :param entry: A dict returned by `entries`
+        :return: The data of the record or ``None`` if it has been
+                 removed from the spool in the meantime.
+        """
+        with self._locked():
+            try:
+                f = open(self.path, 'rb')
+            except FileNotFoundError:
+                return None
+            with f:
+                f.seek(entry['pos'])
+                meta = _read_meta(f, self.path)
+                if meta is None or meta['id'] != entry['id']:
+                    return None
+                return _load_data(f, meta)
+
+    def update(self, delivered, failed):
+        """Remove delivered records and count failed attempts.
+
+        Records which reach `max_attempts` failed attempts are moved to
+        the parked file.
+
+        :param delivered: A set containing the ids of the records which
+                          have been delivered successfully
+        :param failed: A set containing the ids of the records which
+                       could not be delivered
+        :return: A list containing the metadata of the records which
+                 have been parked.
+        """
+        if not delivered and not failed:
+            return []
+        with self._locked():
+            kept = []
+            parked = []
+            for f, meta in self._scan():
+                if meta['id'] in delivered:
+                    continue
+                elif meta['id'] in failed:
+                    meta['attempts'] += 1
+                # only the metadata changes, so the data is copied without decompressing it
+                packed = _pack_raw(meta, _read_raw_data(f, meta))
+                if self.max_attempts is not None and meta['attempts'] >= self.max_attempts:
+                    parked.append((meta, packed))
+                else:
+                    kept.append(packed)
+            if parked:
+                _append(self.path + '.parked', (packed for __, packed in parked))
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                os.fchmod(f.fileno(), 0o600)
+                f.writelines(kept)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        return [_public_meta(meta) for meta, __ in parked]
+
+    def _scan(self):
+        """Iterate over the records in the spool file.
+
+        The data of the records is skipped; it can be read from the
+        file object while handling a record.
+
+        :return: An iterator yielding ``(fileobj, meta)`` tuples
+        """
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            while True:
+                pos = f.tell()
+                meta = _read_meta(f, self.path)
+                if meta is None:
+                    break
+                elif meta is _CORRUPT:
+                    continue
+                meta['pos'] = pos
+                yield f, meta
+                f.seek(meta['data_pos'] + meta['data_size'])
+
+
+#: Returned by `_read_meta` for records which could not be read
+_CORRUPT = object()
+
+
+def _read_meta(f, path):
+    """Read the metadata of the record at the current position.
+
+    Records written by older versions only consist of a compressed
+    JSON document, which is decompressed completely.
+
+    :return: A dict with the metadata, `_CORRUPT` if the record could
+             not be read, or ``None`` at the end of the file.
+    """
+    magic = f.read(len(_MAGIC))
+    if not magic:
+        return None
+    legacy = magic != _MAGIC
+    header = magic + f.read(_LEGACY_HEADER.size - len(magic) if legacy else _HEADER.size - len(magic))
+    if len(header) < (_LEGACY_HEADER.size if legacy else _HEADER.size):
+        warning_echo('Spool file is truncated: {}'.format(path))
+        return None
+    if legacy:
+        meta_size = _LEGACY_HEADER.unpack(header)[0]
+        data_size = 0
+    else:
+        __, meta_size, data_size = _HEADER.unpack(header)
+    data = f.read(meta_size)
+    data_pos = f.tell()
+    if len(data) < meta_size or f.seek(data_size, 1) > os.fstat(f.fileno()).st_size:
+        warning_echo('Spool file is truncated: {}'.format(path))
+        return None
+    f.seek(data_pos)
+    try:
+        meta = json.loads((zlib.decompress(data) if legacy else data).decode('utf-8'))
+    except (zlib.error, ValueError) as exc:
+        warning_echo('Skipping corrupt spool record in {} ({})'.format(path, exc))
+        f.seek(data_size, 1)
+        return _CORRUPT
+    if legacy:
+        meta['legacy_data'] = meta.pop('data')
+    meta['data_pos'] = data_pos
+    meta['data_size'] = data_size
+    return meta
+
+
+def _public_meta(meta):
+    return {key: meta[key] for key in ('id', 'action', 'attempts')}
+
+
+def _read_raw_data(f, meta):
+    if 'legacy_data' in meta:
+        return _compress(meta['legacy_data'])
+    f.seek(meta['data_pos'])
+    return f.read(meta['data_size'])
+
+
+def _load_data(f, meta):
+    if 'legacy_data' in meta:
+        return meta['legacy_data']
+    f.seek(meta['data_pos'])
+    return json.loads(zlib.decompress(f.read(meta['data_size'])).decode('utf-8'))
+
+
+def _append(path, packed_records):
+    with open(path, 'ab') as f:
+        os.fchmod(f.fileno(), 0o600)
+        f.writelines(packed_records)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _compress(data):
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+
+def _pack(record):
+    meta = {'id': record['id'], 'action': record['action'], 'attempts': record['attempts']}
+    return _pack_raw(meta, _compress(record['data']))
+
+
+def _pack_raw(meta, data):
+    meta = json.dumps(_public_meta(meta), separators=(',', ':')).encode('utf-8')
+    return _HEADER.pack(_MAGIC, len(meta), len(data)) + meta + data
+
+
+def spool_results(spool, results):
+    """Store action results in the spool.
+
+    :param spool: A `Spool` instance
+    :param results: Result dict as returned by `process_logs`
+    :return: A set containing the names of all logs whose results
+             could not be stored.
+    """
+    grouped = group_results(results)
+    records = [{'id': uuid.uuid4().hex, 'action': action, 'data': data, 'attempts': 0}
+               for action, data in sorted(grouped.items())]
+    if not records:
+        return set()
+    try:
+        spool.append(records)
+    except OSError as exc:
+        error_echo('Could not write spool file: {} ({})'.format(spool.path, exc))
+        return set(results)
+    debug_echo('spooled {} records', len(records))
+    return set()
+
+
+class SpoolDelivery(threading.Thread):
+    """Deliver spooled action results in the background.
+
+    Each record is tried up to `attempts` times per run, waiting
+    ``backoff * 2**n`` seconds before the n-th retry.  Records which
+    could not be delivered stay in the spool for the next run unless
+    they reached the spool's `max_attempts` and have been parked.
+    """
+
+    def __init__(self, spool, attempts, backoff):
+        super().__init__(name='logstapo-delivery', daemon=True)
+        self.spool = spool
+        self.attempts = attempts
+        self.backoff = backoff
+        self.success = True
+        self._wakeup = threading.Event()
+        self._finishing = False
+        self._deliver = bind_config(self._deliver)
+
+    def wake(self):
+        """Notify the thread that new records have been spooled."""
+        self._wakeup.set()
+
+    def finish(self):
+        """Wait until all records have been delivered or given up.
+
+        :return: ``True`` if the spool is empty, ``False`` otherwise
+        """
+        self._finishing = True
+        self._wakeup.set()
+        self.join()
+        return self.success
+
+    def run(self):
+        try:
+            self._deliver()
+        except Exception as exc:
+            error_echo('Spool delivery failed: {}'.format(exc))
+            self.success = False
+
+    def _deliver(self):
+        tries = {}
+        retry_at = {}
+        parked_any = False
+        while True:
+            self._wakeup.clear()
+            finishing = self._finishing
+            with self.spool.claim() as claimed:
+                if not claimed:
+                    debug_echo('spool is being delivered by another process')
+                    if finishing:
+                        # the other process takes care of the remaining records
+                        return
+                    self._wakeup.wait(self.backoff)
+                    continue
+                entries = self.spool.entries()
+                delivered = set()
+                failed = set()
+                for entry in entries:
+                    id_ = entry['id']
+                    if tries.get(id_, 0) >= self.attempts or retry_at.get(id_, 0) > time.monotonic():
+                        continue
+                    elif entry['action'] not in current_config['actions']:
+                        warning_echo("Discarding spooled results for unknown action '{}'".format(entry['action']))
+                        delivered.add(id_)
+                        continue
+                    # only one record is loaded at a time since the data of a record may be large
+                    data = self.spool.load(entry)
+                    if data is None:
+                        continue
+                    tries[id_] = tries.get(id_, 0) + 1
+                    debug_echo("delivering spooled results for '{}' (attempt {})", entry['action'], tries[id_])
+                    if dispatch_actions([(entry['action'], data)])[0]:
+                        delivered.add(id_)
+                    else:
+                        failed.add(id_)
+                        retry_at[id_] = time.monotonic() + self.backoff * 2 ** (tries[id_] - 1)
+                parked = {entry['id'] for entry in self.spool.update(delivered, failed)}
+                parked_any = parked_any or bool(parked)
+                for id_ in parked:
+                    warning_echo('Parked spooled results after {} failed attempts: {}'.format(
+                        self.spool.max_attempts, id_))
+                remaining = [entry for entry in entries if entry['id'] not in delivered and entry['id'] not in parked]
+                waiting = [retry_at.get(entry['id'], 0) for entry in remaining
+                           if tries.get(entry['id'], 0) < self.attempts]
+                if finishing and not waiting:
+                    if remaining:
+                        error_echo('{} spooled results could not be delivered'.format(len(remaining)))
+                    self.success = not remaining and not parked_any
+                    return
+            timeout = max(0, min(waiting) - time.monotonic()) if waiting else None
+            self._wakeup.wait(timeout)
@@ -0,0 +1,110 @@
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+
+MONTHS = {name: i for i, name in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                            'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+_ISO_RE = re.compile(r'''
+    (?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})
+    (?:[T\ ](?P<hour>\d{2}):(?P<minute>\d{2})(?::(?P<second>\d{2})(?:[.,](?P<fraction>\d+))?)?)?
+    \s*(?P<tz>Z|[+-]\d{2}:?\d{2})?
+''', re.VERBOSE)
+_SYSLOG_RE = re.compile(r'''
+    (?P<month>[A-Z][a-z]{2})\s+(?P<day>\d{1,2})\s+
+    (?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})(?:[.,](?P<fraction>\d+))?
+''', re.VERBOSE)
+_TIME_RE = re.compile(r'(?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2}))?')
+_RELATIVE_RE = re.compile(r'(?P<value>\d+)(?P<unit>[smhd])')
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def _make_datetime(match, year=None, month=None):
+    """Create a datetime from the groups of a timestamp regex."""
+    fraction = match.group('fraction') or '0'
+    dt = datetime(year or int(match.group('year')), month or int(match.group('month')), int(match.group('day')),
+                  int(match.group('hour') or 0), int(match.group('minute') or 0), int(match.group('second') or 0),
+                  int(fraction[:6].ljust(6, '0')))
+    tz = match.groupdict().get('tz')
+    if tz == 'Z':
+        dt = dt.replace(tzinfo=timezone.utc)
+    elif tz:
+        tz = tz.replace(':', '')
+        offset = timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))
+        dt = dt.replace(tzinfo=timezone(-offset if tz[0] == '-' else offset))
+    return dt
+
+
+def parse_timestamp(value, now=None):
+    """Convert the timestamp of a log entry to a unix timestamp.
+
+    ISO 8601 style timestamps (``2017-01-02 03:04:05``, optionally
+    with fractional seconds and a timezone) and syslog timestamps
+    (``Jan  2 03:04:05``) are supported.  Timestamps without a
+    timezone are considered local time.  Since syslog timestamps do
+    not contain a year, the year is chosen so the timestamp is not
+    more than a day in the future.
+
+    :param value: The timestamp string
+    :param now: The current unix timestamp; used to determine the year
+                of syslog timestamps
+    :return: A unix timestamp or ``None`` if the timestamp could not
+             be parsed.
+    """
+    value = value.strip()
+    try:
+        match = _ISO_RE.fullmatch(value)
+        if match is not None:
+            return _make_datetime(match).timestamp()
+        match = _SYSLOG_RE.fullmatch(value)
+        if match is None or match.group('month') not in MONTHS:
+            return None
+        if now is None:
+            now = time.time()
+        year = datetime.fromtimestamp(now).year
+        month = MONTHS[match.group('month')]
+        for candidate in (year, year - 1):
+            try:
+                rv = _make_datetime(match, candidate, month).timestamp()
+            except ValueError:
+                # february 29th in a non-leap year
+                continue
+            if rv <= now + 86400:
+                return rv
+        return None
+    except ValueError:
+        return None
+
+
+def parse_time_arg(value, now=None):
+    """Convert a time specified on the command line to a unix timestamp.
+
+    Besides ISO 8601 style timestamps (e.g. ``2017-01-02``,
+    ``2017-01-02 03:04`` or ``2017-01-02T03:04:05``) a time of day
+    such as ``02:00``, which refers to its most recent occurrence, and
+    relative times such as ``30m``, ``2h`` or ``1d`` are accepted.
+
+    :param value: The string to parse
+    :param now: The current unix timestamp
+    :return: A unix timestamp
+    :raise ValueError: If the string cannot be parsed
+    """
+    if now is None:
+        now = time.time()
+    value = value.strip()
+    match = _RELATIVE_RE.fullmatch(value)
+    if match is not None:
+        return now - int(match.group('value')) * _UNITS[match.group('unit')]
+    match = _TIME_RE.fullmatch(value)
+    if match is not None:
+        today = datetime.fromtimestamp(now)
+        dt = today.replace(hour=int(match.group('hour')), minute=int(match.group('minute')),
+                           second=int(match.group('second') or 0), microsecond=0)
+        if dt > today:
+            dt -= timedelta(days=1)
+        return dt.timestamp()
+    match = _ISO_RE.fullmatch(value)
+    if match is None:
+        raise ValueError('invalid time: {}'.format(value))
+    return _make_datetime(match).timestamp()
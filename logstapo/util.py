@@ -1,5 +1,12 @@
+import ctypes
+import itertools
 import math
+import os
+import platform
 import re
+import threading
+from contextlib import contextmanager
+from operator import itemgetter
 
 import click
 
@@ -22,32 +29,108 @@ def try_match(regexps, string):
     return None
 
 
-def debug_echo(message):
+#: The maximum number of buffered messages before they are written
+OUTPUT_BUFFER_SIZE = 100
+_output_lock = threading.Lock()
+_output_buffer = None
+
+
+@contextmanager
+def buffered_output():
+    """Buffer messages instead of writing each of them immediately.
+
+    Error messages flush the buffer right away so they are never lost
+    or delayed.  The buffer is flushed when leaving the context.
+    """
+    global _output_buffer
+    with _output_lock:
+        if _output_buffer is not None:
+            nested = True
+        else:
+            nested = False
+            _output_buffer = []
+    try:
+        yield
+    finally:
+        if not nested:
+            with _output_lock:
+                _flush_output()
+                _output_buffer = None
+
+
+def flush_output():
+    """Write all buffered messages."""
+    with _output_lock:
+        _flush_output()
+
+
+def _flush_output():
+    if not _output_buffer:
+        return
+    for err, messages in itertools.groupby(_output_buffer, key=itemgetter(0)):
+        click.echo('\n'.join(message for __, message in messages), err=err)
+    del _output_buffer[:]
+
+
+def _echo(message, err=False, flush=False, **styles):
+    with _output_lock:
+        if _output_buffer is None:
+            click.secho(message, err=err, **styles)
+            return
+        _output_buffer.append((err, click.style(message, **styles)))
+        if flush or len(_output_buffer) >= OUTPUT_BUFFER_SIZE:
+            _flush_output()
+
+
+def debug_enabled():
+    """Check whether debug output is enabled.
+
+    Code calling `debug_echo` in a loop should check this once before
+    the loop to avoid even building the messages.
+    """
+    from logstapo.config import current_config
+    return current_config['debug']
+
+
+def verbose_enabled(level):
+    """Check whether verbose output of a given level is enabled.
+
+    :param level: The minimum verbosity level that is required
+    """
+    from logstapo.config import current_config
+    config = current_config.data
+    return config['debug'] or config['verbosity'] >= level
+
+
+def debug_echo(message, *args):
     """Display a debug message on stderr.
 
     The message is only displayed if debug output is enabled.
 
-    :param message: The message to display
+    :param message: The message to display.  If `args` are specified,
+                    it is formatted using `str.format` - but only if
+                    debug output is enabled.
+    :param args: Arguments to format the message with
     """
-    from logstapo.config import current_config
-    if current_config['debug']:
-        click.secho('[D] ' + message, fg='black', bold=True)
+    if debug_enabled():
+        _echo('[D] ' + (message.format(*args) if args else message), fg='black', bold=True)
 
 
-def verbose_echo(level, message):
+def verbose_echo(level, message, *args):
     """Display a verbose message on stderr.
 
     The message is only displayed if verbose output is enabled and the
     verbosity level is equal or higher to the specified one.
 
     :param level: The minimum verbosity level that is required
-    :param message: The message to display
+    :param message: The message to display.  If `args` are specified,
+                    it is formatted using `str.format` - but only if
+                    the message is displayed.
+    :param args: Arguments to format the message with
     """
-    from logstapo.config import current_config
-    config = current_config.data
-    if config['debug'] or config['verbosity'] >= level:
+    if verbose_enabled(level):
         color = 'magenta' if level > 1 else 'blue'
-        click.secho('[{}] {}'.format(level, message), fg=color, bold=True)
+        _echo('[{}] {}'.format(level, message.format(*args) if args else message), fg=color, bold=True)
 
 
 def warning_echo(message):
@@ -55,7 +138,7 @@ def warning_echo(message):
 
     :param message: The message to display
     """
-    click.secho('[W] ' + message, err=True, fg='yellow')
+    _echo('[W] ' + message, err=True, fg='yellow')
 
 
 def error_echo(message):
@@ -63,7 +146,7 @@ def error_echo(message):
 
     :param message: The message to display
     """
-    click.secho('[E] ' + message, err=True, fg='red', bold=True)
+    _echo('[E] ' + message, err=True, flush=True, fg='red', bold=True)
 
 
 def underlined(text, chars='=-'):
@@ -120,3 +203,30 @@ def combine_placeholders(string, placeholders, _placeholder_re=re.compile(r'%\((
         if not n:
             break
     return string
+
+
+#: ``ioprio_set`` syscall numbers for architectures that have one
+_IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'riscv64': 30, 'armv7l': 314,
+                        'ppc64le': 273, 's390x': 282}
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+
+
+def set_idle_io_priority():
+    """Use the idle I/O scheduling class for the current process.
+
+    This only works on Linux; on other systems a warning is displayed.
+
+    :return: ``True`` if the I/O priority has been changed
+    """
+    syscall = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall is None:
+        warning_echo('Cannot change the I/O priority on this system')
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(syscall, _IOPRIO_WHO_PROCESS, 0, _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT) < 0:
+        warning_echo('Could not change the I/O priority: {}'.format(os.strerror(ctypes.get_errno())))
+        return False
+    debug_echo('using idle I/O priority')
+    return True
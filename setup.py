@@ -32,8 +32,14 @@ setup(
         'console_scripts': [
             'logstapo = logstapo.cli:main',
         ],
+        'logstapo.actions': [
+            'smtp = logstapo.actions:SMTPAction',
+        ],
     },
     install_requires=requirements,
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Programming Language :: Python',
@@ -1,9 +1,16 @@
+import gzip
+import hashlib
+import smtplib
 import textwrap
+import threading
+import time
+from datetime import datetime
 from unittest.mock import MagicMock
 
 import pytest
 
-from logstapo.actions import run_actions, Action, SMTPAction
+from logstapo.actions import (run_actions, dispatch_actions, get_action_type, iter_records, Action, SMTPAction,
+                              SMTPPool, StreamingAction)
 from logstapo.config import ConfigError
 
 
@@ -16,9 +23,9 @@ def test_run_actions(mock_config):
         'nact': {'actions': []},
     }
     actions = {
-        'a': MagicMock(spec=Action),
-        'b': MagicMock(spec=Action),
-        'c': MagicMock(spec=Action)
+        'a': MagicMock(spec=Action, timeout=None),
+        'b': MagicMock(spec=Action, timeout=None),
+        'c': MagicMock(spec=Action, timeout=None)
     }
     mock_config({'logs': logs_config, 'actions': actions})
     res = {
@@ -28,7 +35,7 @@ def test_run_actions(mock_config):
         'none': ([], []),
         'nact': (['x', 'y'], ['z']),
     }
-    run_actions(res)
+    assert run_actions(res) == set()
     actions['a'].run.assert_called_once_with({'both': res['both'],
                                               'one1': res['one1']})
     actions['b'].run.assert_called_once_with({'one1': res['one1'],
@@ -36,14 +43,143 @@ def test_run_actions(mock_config):
     assert not actions['c'].run.called
 
 
+def test_run_actions_failed(mocker, mock_config):
+    logs_config = {
+        'x': {'actions': ['a', 'b']},
+        'y': {'actions': ['b']},
+        'z': {'actions': ['a']},
+    }
+    actions = {
+        'a': MagicMock(spec=Action, timeout=None),
+        'b': MagicMock(spec=Action, timeout=None),
+    }
+    actions['a'].run.side_effect = Exception('fail')
+    error_echo = mocker.patch('logstapo.actions.error_echo')
+    mock_config({'logs': logs_config, 'actions': actions})
+    res = {
+        'x': (['x'], []),
+        'y': (['y'], []),
+        'z': (['z'], []),
+    }
+    assert run_actions(res) == {'x', 'z'}
+    assert actions['b'].run.called
+    assert error_echo.called
+
+
+def test_dispatch_actions_concurrent(mock_config):
+    actions = {
+        'a': MagicMock(spec=Action, timeout=None),
+        'b': MagicMock(spec=Action, timeout=None),
+    }
+    actions['a'].run.side_effect = lambda data: time.sleep(0.2)
+    actions['b'].run.side_effect = lambda data: time.sleep(0.2)
+    mock_config({'actions': actions})
+    start = time.monotonic()
+    assert dispatch_actions([('a', {}), ('b', {})]) == [True, True]
+    assert time.monotonic() - start < 0.35
+
+
+def test_dispatch_actions_timeout(mocker, mock_config):
+    error_echo = mocker.patch('logstapo.actions.error_echo')
+    release = threading.Event()
+    actions = {
+        'slow': MagicMock(spec=Action, timeout=0.05),
+        'fast': MagicMock(spec=Action, timeout=0.05),
+    }
+    actions['slow'].run.side_effect = lambda data: release.wait()
+    mock_config({'actions': actions})
+    try:
+        assert dispatch_actions([('slow', {}), ('fast', {})]) == [False, True]
+    finally:
+        release.set()
+    assert error_echo.called
+
+
 def test_action_from_config(mocker):
-    actions = mocker.patch('logstapo.actions.ACTIONS', {'smtp': MagicMock(spec=Action)})
-    Action.from_config('smtp', {'foo': 'bar'})
+    actions = mocker.patch('logstapo.actions.ACTIONS', {'smtp': MagicMock(spec=Action, timeout=None)})
+    action = Action.from_config('smtp', {'foo': 'bar'}, 30)
     actions['smtp'].assert_called_once_with({'foo': 'bar'})
+    assert action.timeout == 30
     with pytest.raises(ConfigError):
         Action.from_config('test', {})
 
 
+def test_get_action_type_entry_point(mocker):
+    class DummyAction(Action):
+        pass
+
+    mocker.patch('logstapo.actions.debug_echo')
+    actions = mocker.patch('logstapo.actions.ACTIONS', {})
+    entry_point = MagicMock(value='dummy:DummyAction')
+    entry_point.load.return_value = DummyAction
+    find_entry_point = mocker.patch('logstapo.actions._find_entry_point', return_value=entry_point)
+    assert get_action_type('dummy') is DummyAction
+    assert get_action_type('dummy') is DummyAction
+    find_entry_point.assert_called_once_with('dummy')
+    assert actions == {'dummy': DummyAction}
+
+
+def test_get_action_type_invalid(mocker):
+    mocker.patch('logstapo.actions.debug_echo')
+    mocker.patch('logstapo.actions.ACTIONS', {})
+    find_entry_point = mocker.patch('logstapo.actions._find_entry_point', return_value=None)
+    with pytest.raises(ConfigError, match='type does not exist'):
+        get_action_type('dummy')
+    find_entry_point.return_value = entry_point = MagicMock(value='dummy:DummyAction')
+    entry_point.load.side_effect = ImportError('no module named dummy')
+    with pytest.raises(ConfigError, match='type could not be loaded'):
+        get_action_type('dummy')
+    entry_point.load.side_effect = None
+    entry_point.load.return_value = object
+    with pytest.raises(ConfigError, match='type is not an action'):
+        get_action_type('dummy')
+
+
+def test_get_action_type_builtin():
+    assert get_action_type('smtp') is SMTPAction
+
+
+def test_iter_records():
+    data = {'b': ([('b1', {'source': 'x'})], []),
+            'a': ([('a1', {'source': 'y'}), ('a2', {'source': 'z'})], ['bad'])}
+    assert list(iter_records(data)) == [('a', 'bad', None), ('a', 'a1', {'source': 'y'}),
+                                        ('a', 'a2', {'source': 'z'}), ('b', 'b1', {'source': 'x'})]
+
+
+class DummyStreamingAction(StreamingAction):
+    batch_size = 2
+
+    def __init__(self, data):
+        self.calls = []
+
+    def open(self):
+        self.calls.append('open')
+
+    def feed(self, batch):
+        self.calls.append([line for __, line, __ in batch])
+        if 'fail' in self.calls[-1]:
+            raise ValueError('failed')
+
+    def close(self):
+        self.calls.append('close')
+
+    def abort(self):
+        self.calls.append('abort')
+
+
+def test_streaming_action():
+    action = DummyStreamingAction({})
+    action.run({'a': ([('a1', {}), ('a2', {})], ['bad']), 'b': ([('b1', {}), ('b2', {})], [])})
+    assert action.calls == ['open', ['bad', 'a1'], ['a2', 'b1'], ['b2'], 'close']
+
+
+def test_streaming_action_failed():
+    action = DummyStreamingAction({})
+    with pytest.raises(ValueError):
+        action.run({'a': ([('a1', {}), ('fail', {}), ('a2', {})], [])})
+    assert action.calls == ['open', ['a1', 'fail'], 'abort']
+
+
 def test_smtpaction_invalid():
     with pytest.raises(ConfigError):
         SMTPAction({})
@@ -53,6 +189,12 @@ def test_smtpaction_invalid():
         SMTPAction({'to': 'foo@bar.com', 'username': 'test'})
     with pytest.raises(ConfigError):
         SMTPAction({'to': 'foo@bar.com', 'password': 'test'})
+    with pytest.raises(ConfigError):
+        SMTPAction({'to': 'foo@bar.com', 'max_lines': 0})
+    with pytest.raises(ConfigError):
+        SMTPAction({'to': 'foo@bar.com', 'max_bytes': 'big'})
+    with pytest.raises(ConfigError):
+        SMTPAction({'to': 'foo@bar.com', 'max_attachment_bytes': 0})
 
 
 @pytest.mark.parametrize(('recipients', 'expected'), (
@@ -86,7 +228,7 @@ def test_smtpaction_sender(mocker, from_, expected):
 def test_smtpaction_run(mocker, mock_config, dry_run, auth, ssl, starttls):
     mock_config({'debug': False, 'dry_run': dry_run})
     mocker.patch('logstapo.actions.debug_echo')
-    mocker.patch('logstapo.actions.SMTPAction._build_msg', return_value='...')
+    mocker.patch('logstapo.actions.SMTPAction._iter_report', return_value=['...'])
     smtplib = mocker.patch('logstapo.actions.smtplib', autospec=True)
     # XXX: why doesn't autospec handle this?
     smtplib.SMTP.__name__ = 'SMTP'
@@ -101,7 +243,7 @@ def test_smtpaction_run(mocker, mock_config, dry_run, auth, ssl, starttls):
     if dry_run:
         assert not cls.called
     else:
-        cls.assert_called_once_with('somehost', 12345)
+        cls.assert_called_once_with('somehost', 12345, timeout=None)
         smtp = cls()
         assert smtp.starttls.called == starttls
         if auth:
@@ -114,8 +256,57 @@ def test_smtpaction_run(mocker, mock_config, dry_run, auth, ssl, starttls):
         assert msg.get_payload() == '...'
 
 
+def test_smtp_pool(mocker, mock_config):
+    mock_config({'debug': False, 'dry_run': False})
+    mocker.patch('logstapo.actions.debug_echo')
+    mocker.patch('logstapo.actions.SMTPAction._iter_report', return_value=['...'])
+    smtp_cls = mocker.patch('logstapo.actions.smtplib.SMTP')
+    pool = mocker.patch('logstapo.actions.smtp_pool', SMTPPool())
+    a1 = SMTPAction({'host': 'relay', 'to': 'a@example.com', 'username': 'u', 'password': 'p'})
+    a2 = SMTPAction({'host': 'relay', 'to': 'b@example.com', 'username': 'u', 'password': 'p'})
+    other = SMTPAction({'host': 'other', 'to': 'c@example.com'})
+    with pool:
+        a1.run({})
+        a2.run({})
+        other.run({})
+        assert smtp_cls.call_count == 2
+        assert smtp_cls.return_value.login.call_count == 1
+        assert smtp_cls.return_value.send_message.call_count == 3
+        assert not smtp_cls.return_value.quit.called
+    assert smtp_cls.return_value.quit.call_count == 2
+
+
+def test_smtp_pool_reconnect(mocker, mock_config):
+    mock_config({'debug': False, 'dry_run': False})
+    mocker.patch('logstapo.actions.debug_echo')
+    mocker.patch('logstapo.actions.SMTPAction._iter_report', return_value=['...'])
+    smtp_cls = mocker.patch('logstapo.actions.smtplib.SMTP')
+    pool = mocker.patch('logstapo.actions.smtp_pool', SMTPPool())
+    action = SMTPAction({'host': 'relay', 'to': 'a@example.com'})
+    with pool:
+        action.run({})
+        smtp_cls.return_value.send_message.side_effect = [smtplib.SMTPServerDisconnected('gone'), None]
+        action.run({})
+    assert smtp_cls.call_count == 2
+    assert smtp_cls.return_value.send_message.call_count == 3
+
+
+def test_smtp_pool_localserver(mocker, mock_config, smtpserver):
+    mock_config({'debug': False, 'dry_run': False})
+    mocker.patch('logstapo.actions.SMTPAction._iter_report', return_value=['...'])
+    pool = mocker.patch('logstapo.actions.smtp_pool', SMTPPool())
+    connect = mocker.spy(SMTPAction, 'connect')
+    host, port = smtpserver.addr
+    actions = [SMTPAction({'host': host, 'port': port, 'to': '{}@example.com'.format(x)}) for x in 'abc']
+    with pool:
+        for action in actions:
+            action.run({})
+    assert connect.call_count == 1
+    assert sorted(mail['To'] for mail in smtpserver.outbox) == ['a@example.com', 'b@example.com', 'c@example.com']
+
+
 @pytest.mark.parametrize('group_by_source', (True, False))
-def test_smtpaction_build_msg(group_by_source):
+def test_smtpaction_iter_report(group_by_source):
     action = SMTPAction({'to': 'foo@bar.com', 'group': group_by_source})
     data = {
         'a': ([('a1', {'source': 'sa1'}),
@@ -126,7 +317,7 @@ def test_smtpaction_build_msg(group_by_source):
         'c': ([('c1', {'source': 'sc'})], []),
         'd': ([], [])
     }
-    msg = action._build_msg(data)
+    msg = '\n'.join(action._iter_report(data))
     if group_by_source:
         assert msg == textwrap.dedent('''
             Logstapo results for 'a'
@@ -193,3 +384,59 @@ def test_smtpaction_build_msg(group_by_source):
             -------------
             c1
         ''').strip()
+
+
+def test_smtpaction_build_email_small():
+    action = SMTPAction({'to': 'foo@bar.com'})
+    msg = action._build_email({'a': ([('a1', {'source': 'sa'})], [])})
+    assert not msg.is_multipart()
+    assert msg.get_payload().splitlines()[-1] == 'a1'
+
+
+@pytest.mark.parametrize('limit', ({'max_lines': 10}, {'max_bytes': 100}))
+def test_smtpaction_build_email_truncated(mocker, limit):
+    mocker.patch('logstapo.actions.debug_echo')
+    action = SMTPAction(dict({'to': 'foo@bar.com'}, **limit))
+    lines = [('line {}'.format(i), {'source': 'rare' if i % 10 == 0 else 'noisy'}) for i in range(1000)]
+    data = {'a': (lines, ['garbage'])}
+    msg = action._build_email(data)
+    assert msg.is_multipart()
+    body, attachment = msg.get_payload()
+    text = body.get_payload()
+    assert len(text.split('\n[...]')[0].split('Unparsable lines')[1]) < 100
+    assert '     900  noisy\n     100  rare\n       1  (unparsable)' in text
+    assert text.endswith('[...]')
+    assert attachment.get_filename() == 'logstapo-report.txt.gz'
+    report = gzip.decompress(attachment.get_payload(decode=True)).decode('utf-8')
+    assert report == '\n'.join(action._iter_report(data)) + '\n'
+
+
+def test_smtpaction_build_email_attachment_truncated(mocker):
+    mocker.patch('logstapo.actions.debug_echo')
+    action = SMTPAction({'to': 'foo@bar.com', 'max_lines': 10, 'max_attachment_bytes': 1000})
+    # random-looking lines so they do not compress well
+    lines = [('line ' + hashlib.sha1(str(i).encode()).hexdigest(), {'source': 'noisy'}) for i in range(5000)]
+    msg = action._build_email({'a': (lines, [])})
+    body, attachment = msg.get_payload()
+    assert 'lines of the report are attached' in body.get_payload()
+    payload = attachment.get_payload(decode=True)
+    assert len(payload) < 100000
+    report = gzip.decompress(payload).decode('utf-8').splitlines()
+    assert report[:-1] == list(action._iter_report({'a': (lines, [])}))[:len(report) - 1]
+    assert report[-1].startswith('[report truncated: ')
+    assert len(report) < 5000
+
+
+def test_smtpaction_iter_report_summary():
+    action = SMTPAction({'to': 'foo@bar.com'})
+    data = {'a': ([('x 1', {'source': 'sx', 'template': 'x <NUM>', 'count': 12, 'error': 0,
+                            'examples': ['x 1', 'x 2']}),
+                   ('y', {'source': 'sy', 'template': 'y', 'count': 3, 'error': 2, 'examples': ['y']})], [])}
+    assert list(action._iter_report(data))[-5:] == ['12x sx: x <NUM>', '    x 1', '    x 2', '~3x sy: y', '    y']
+
+
+def test_smtpaction_iter_report_repeat():
+    action = SMTPAction({'to': 'foo@bar.com'})
+    first_seen = datetime(2017, 1, 2, 3, 4).timestamp()
+    data = {'a': ([('x 1', {'source': 'sx', 'repeat': 5, 'first_seen': first_seen})], [])}
+    assert list(action._iter_report(data))[-2:] == ['x 1', '    (repeated, 5x since 2017-01-02 03:04)']
@@ -0,0 +1,99 @@
+import re
+
+import pytest
+
+from logstapo.backtracking import (GuardedRegex, find_backtracking_risks, guard_regex, quarantine_scope,
+                                   reset_quarantine)
+
+
+@pytest.mark.parametrize(('pattern', 'expected'), (
+    (r'(\w+\s?)+$', ['nested quantifier']),
+    (r'(a+)+b', ['nested quantifier']),
+    (r'(.*)*', ['nested quantifier']),
+    (r'(?:x(?:a+)+)+', ['nested quantifier']),
+    (r'(\d+|\w+)*x', ['ambiguous alternation']),
+    (r'(\d+\w+)*x', ['adjacent quantifiers']),
+    (r'(x+x+)+y', ['adjacent quantifiers']),
+    (r'(\s*\w+)+', ['nested quantifier']),
+    (r'(a|a)+b', ['ambiguous alternation']),
+    (r'(ab|ab|c)*d', ['ambiguous alternation']),
+    (r'(x|y?|z*)+', ['ambiguous alternation']),
+))
+def test_find_backtracking_risks(pattern, expected):
+    assert find_backtracking_risks(pattern) == expected
+
+
+@pytest.mark.parametrize('pattern', (
+    r'^(?P<source>\S+?)(?:\[\d+\])?:?\s+(?P<message>.*)$',
+    r'(?:\s+\S+)*',
+    r'(?:[^ ]+ )*',
+    r'(\s*,\s*\w+)*',
+    r'(a|b)*',
+    # only one alternative is empty after moving the common prefix out
+    r'(a|ab)*c',
+    r'(a+){3}',
+    r'(?>a+)+',
+    r'\d++x',
+    # invalid regexps are not checked
+    r'(?P<foo',
+))
+def test_find_backtracking_risks_safe(pattern):
+    assert find_backtracking_risks(pattern) == []
+
+
+def test_guard_regex_safe(mocker):
+    warning_echo = mocker.patch('logstapo.backtracking.warning_echo')
+    regex = re.compile(r'\S+ (.*)')
+    assert guard_regex(regex, 'test', 1) is regex
+    assert not warning_echo.called
+
+
+@pytest.mark.parametrize('slow_match', (None, 1))
+def test_guard_regex_risky(mocker, slow_match):
+    warning_echo = mocker.patch('logstapo.backtracking.warning_echo')
+    regex = re.compile(r'(a+)+b')
+    rv = guard_regex(regex, 'test', slow_match)
+    warning_echo.assert_called_once_with('test may cause catastrophic backtracking (nested quantifier)')
+    if slow_match is None:
+        assert rv is regex
+    else:
+        assert isinstance(rv, GuardedRegex)
+        assert rv.regex is regex
+
+
+def test_guarded_regex(mocker):
+    warning_echo = mocker.patch('logstapo.backtracking.warning_echo')
+    perf_counter = mocker.patch('logstapo.backtracking.time.perf_counter')
+    regex = GuardedRegex(re.compile(r'(?P<x>a+)+b'), 'test', 1)
+    assert regex.pattern == r'(?P<x>a+)+b'
+    assert regex.groupindex == {'x': 1}
+    perf_counter.side_effect = [0, 0.5]
+    assert regex.match('aab').group('x') == 'aa'
+    assert not regex.quarantined
+    perf_counter.side_effect = [10, 12]
+    assert regex.match('aab' + 'x' * 300) is not None
+    assert regex.quarantined
+    warning_echo.assert_called_once_with(
+        'test took 2.0s to match a line and is disabled for the rest of the run: aab' + 'x' * 197)
+    # quarantined regexps do not match anything
+    perf_counter.side_effect = AssertionError
+    assert regex.match('aab') is None
+
+
+def test_guarded_regex_quarantine_scope(mocker):
+    mocker.patch('logstapo.backtracking.warning_echo')
+    mocker.patch('logstapo.backtracking.time.perf_counter', side_effect=[0, 2, 0, 2, 0, 0])
+    regex = GuardedRegex(re.compile(r'(a+)+b'), 'test', 1)
+    with quarantine_scope():
+        regex.match('aab')
+        assert regex.quarantined
+        with quarantine_scope():
+            # e.g. another run using the same config
+            assert not regex.quarantined
+        assert regex.quarantined
+        reset_quarantine()
+        assert not regex.quarantined
+        regex.match('aab')
+        assert regex.quarantined
+    assert not regex.quarantined
+    assert regex.match('aab') is not None
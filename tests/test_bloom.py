@@ -0,0 +1,70 @@
+import pytest
+
+from logstapo.bloom import BloomFilter
+
+
+@pytest.fixture(autouse=True)
+def _mock_echo(mocker):
+    mocker.patch('logstapo.bloom.debug_echo')
+
+
+@pytest.fixture
+def filter_path(tmpdir):
+    return tmpdir.join('test.log.offset.seen').strpath
+
+
+def test_bloom_filter(filter_path):
+    bloom = BloomFilter(filter_path, 1024)
+    lines = [b'line %d\n' % i for i in range(500)]
+    for line in lines:
+        bloom.add(line)
+    assert bloom.count == 500
+    assert all(line in bloom for line in lines)
+    false_positives = sum(b'other %d\n' % i in bloom for i in range(1000))
+    assert false_positives < 50
+
+
+def test_bloom_filter_roundtrip(filter_path):
+    bloom = BloomFilter(filter_path, 1024)
+    bloom.add(b'foo\n')
+    bloom.save()
+    bloom = BloomFilter(filter_path, 1024)
+    assert bloom.count == 1
+    assert b'foo\n' in bloom
+    assert b'bar\n' not in bloom
+    # a different size cannot be used
+    bloom = BloomFilter(filter_path, 2048)
+    assert bloom.count == 0
+    assert b'foo\n' not in bloom
+
+
+def test_bloom_filter_invalid(filter_path):
+    with open(filter_path, 'wb') as f:
+        f.write(b'garbage')
+    bloom = BloomFilter(filter_path, 1024)
+    assert bloom.count == 0
+
+
+def test_bloom_filter_full(filter_path):
+    bloom = BloomFilter(filter_path, 16)
+    assert bloom.capacity == 12
+    for i in range(20):
+        bloom.add(b'line %d\n' % i)
+    assert bloom.full
+    assert bloom.count == 12
+
+
+def test_bloom_filter_clear(filter_path):
+    bloom = BloomFilter(filter_path, 1024)
+    bloom.add(b'foo\n')
+    bloom.clear()
+    assert bloom.count == 0
+    assert b'foo\n' not in bloom
+
+
+def test_bloom_filter_save_unchanged(filter_path):
+    bloom = BloomFilter(filter_path, 1024)
+    bloom.save()
+    assert not bloom._dirty
+    with pytest.raises(FileNotFoundError):
+        open(filter_path)
@@ -1,22 +1,30 @@
+from datetime import datetime
+
 import pytest
 from click.testing import CliRunner
-from logstapo.config import current_config
 
 from logstapo.cli import main
+from logstapo.config import Config, INITIAL_CONFIG
+
+
+def _process_config(data):
+    return dict(INITIAL_CONFIG, settings=data)
 
 
 @pytest.mark.parametrize('dry_run', (True, False))
 @pytest.mark.parametrize('debug', (True, False))
 @pytest.mark.parametrize('verbosity', (0, 1, 2))
 def test_cli(tmpdir, mocker, dry_run, debug, verbosity):
-    def _run(**kwargs):
-        assert current_config['foo'] == 'bar'
-        assert current_config['dry_run'] == dry_run
-        assert current_config['verbosity'] == verbosity
-        assert current_config['debug'] == debug
+    def _run(config):
+        assert isinstance(config, Config)
+        assert config.settings['foo'] == 'bar'
+        assert config.dry_run == dry_run
+        assert config.verbosity == verbosity
+        assert config.debug == debug
+        return True
 
     error_echo = mocker.patch('logstapo.cli.error_echo')
-    process_config = mocker.patch('logstapo.cli.process_config', side_effect=dict)
+    process_config = mocker.patch('logstapo.cli.process_config', side_effect=_process_config)
     run = mocker.patch('logstapo.cli.run', side_effect=_run)
     config = tmpdir.join('test.yml')
     config.write('foo: bar\n')
@@ -36,9 +44,110 @@ def test_cli(tmpdir, mocker, dry_run, debug, verbosity):
     assert not error_echo.called
 
 
+def test_cli_action_failed(tmpdir, mocker):
+    mocker.patch('logstapo.cli.process_config', side_effect=_process_config)
+    mocker.patch('logstapo.cli.run', return_value=False)
+    config = tmpdir.join('test.yml')
+    config.write('foo: bar\n')
+    rv = CliRunner().invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 1
+
+
 def test_cli_invalid_config(mocker):
     error_echo = mocker.patch('logstapo.cli.error_echo')
     runner = CliRunner()
     rv = runner.invoke(main, ['-c', '/dev/null'], catch_exceptions=False)
     assert rv.exit_code == 1
     assert error_echo.called
+
+
+def test_cli_follow(tmpdir, mocker):
+    mocker.patch('logstapo.cli.process_config', side_effect=_process_config)
+    run = mocker.patch('logstapo.cli.run')
+    follow = mocker.patch('logstapo.cli.follow', return_value=True)
+    config = tmpdir.join('test.yml')
+    config.write('foo: bar\n')
+    rv = CliRunner().invoke(main, ['-c', config.strpath, '--follow'], catch_exceptions=False)
+    assert rv.exit_code == 0
+    assert follow.called
+    assert not run.called
+
+
+def test_cli_time_range(tmpdir, mocker):
+    mocker.patch('logstapo.cli.process_config', side_effect=_process_config)
+    run = mocker.patch('logstapo.cli.run', return_value=True)
+    config = tmpdir.join('test.yml')
+    config.write('foo: bar\n')
+    rv = CliRunner().invoke(main, ['-c', config.strpath, '--since', '2017-01-02', '--until', '2017-01-03 12:00'],
+                            catch_exceptions=False)
+    assert rv.exit_code == 0
+    config = run.call_args[0][0]
+    assert config.since == datetime(2017, 1, 2).timestamp()
+    assert config.until == datetime(2017, 1, 3, 12, 0).timestamp()
+
+
+@pytest.mark.parametrize('args', (
+    ['--since', 'yesterday'],
+    ['--since', '2h', '--follow'],
+))
+def test_cli_time_range_invalid(tmpdir, mocker, args):
+    mocker.patch('logstapo.cli.process_config', side_effect=_process_config)
+    run = mocker.patch('logstapo.cli.run')
+    follow = mocker.patch('logstapo.cli.follow')
+    config = tmpdir.join('test.yml')
+    config.write('foo: bar\n')
+    rv = CliRunner().invoke(main, ['-c', config.strpath] + args, catch_exceptions=False)
+    assert rv.exit_code == 2
+    assert not run.called
+    assert not follow.called
+
+
+REPLAY_CONFIG = '''
+regexps:
+  test: '^(?P<source>[^/]+)/(?P<message>.+)$'
+logs:
+  test:
+    file: {log}
+    ignore: {ignore}
+'''
+
+
+@pytest.mark.parametrize('compare', (False, True))
+def test_cli_replay(tmpdir, mocker, compare):
+    mocker.patch('logstapo.config.warning_echo')
+    run = mocker.patch('logstapo.cli.run')
+    log = tmpdir.join('test.log')
+    log.write('foo/boring\nfoo/error 1\n')
+    config = tmpdir.join('test.yml')
+    config.write(REPLAY_CONFIG.format(log=log.strpath, ignore='boring'))
+    other = tmpdir.join('other.yml')
+    other.write(REPLAY_CONFIG.format(log='/dev/null', ignore='error *'))
+    args = ['-c', config.strpath, 'replay', '-j', '1']
+    if compare:
+        args += ['--compare', other.strpath]
+    rv = CliRunner().invoke(main, args, catch_exceptions=False)
+    assert rv.exit_code == 0
+    assert not run.called
+    if compare:
+        assert '  ignored             1          1         +0' in rv.output
+        assert 'No longer reported' in rv.output
+    else:
+        assert '0 garbage / 0 invalid / 1 ignored / 1 other' in rv.output
+        assert '1x foo: error <NUM>' in rv.output
+    assert not tmpdir.join('test.log.offset').check()
+
+
+@pytest.mark.parametrize(('args', 'message'), (
+    (['-l', 'nope'], 'Invalid log'),
+    (['{log}'], 'exactly one --log'),
+))
+def test_cli_replay_invalid(tmpdir, mocker, args, message):
+    mocker.patch('logstapo.config.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('')
+    config = tmpdir.join('test.yml')
+    config.write(REPLAY_CONFIG.format(log=log.strpath, ignore='boring'))
+    args = ['-c', config.strpath, 'replay'] + [arg.format(log=log.strpath) for arg in args]
+    rv = CliRunner().invoke(main, args, catch_exceptions=False)
+    assert rv.exit_code == 2
+    assert message in rv.output
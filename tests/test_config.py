@@ -1,12 +1,16 @@
+import pickle
 import re
+import threading
 from io import StringIO
 
 import click
 import pytest
 
 from logstapo.actions import Action
+from logstapo.backtracking import GuardedRegex, quarantine_scope
 from logstapo.cli import main
 from logstapo import config
+from logstapo.defaults import DEFAULT_SETTINGS
 
 
 @pytest.mark.parametrize(('pattern', 'regex'), (
@@ -96,6 +100,43 @@ def test_process_regexps():
     assert rv == {'test': re.compile('(?P<source>.)(?P<message>.)')}
 
 
+def test_process_regexps_backtracking(mocker):
+    warning_echo = mocker.patch('logstapo.backtracking.warning_echo')
+    rv = config._process_regexps({'safe': '(?P<source>\\S+) (?P<message>.*)',
+                                  'risky': '(?P<source>\\S+) (?P<message>(\\w+\\s?)+)$'}, 5)
+    warning_echo.assert_called_once_with("regex 'risky' may cause catastrophic backtracking (nested quantifier)")
+    assert isinstance(rv['safe'], re.Pattern)
+    assert isinstance(rv['risky'], GuardedRegex)
+    assert rv['risky'].slow_match == 5
+
+
+def test_pattern_backtracking(mocker):
+    warning_echo = mocker.patch('logstapo.backtracking.warning_echo')
+    assert isinstance(config._Pattern('(a+)+', 1).regex, re.Pattern)
+    assert not warning_echo.called
+    patternobj = config._Pattern('/(a+)+b/', 1)
+    warning_echo.assert_called_once_with("pattern '/(a+)+b/' may cause catastrophic backtracking (nested quantifier)")
+    assert isinstance(patternobj.regex, GuardedRegex)
+    assert patternobj.test('aab')
+
+
+@pytest.mark.parametrize('negate', (True, False))
+def test_pattern_quarantined(mocker, negate):
+    mocker.patch('logstapo.backtracking.warning_echo')
+    mocker.patch('logstapo.backtracking.time.perf_counter', side_effect=[0, 0, 0, 5, 0, 0])
+    patternobj = config._Pattern('{}/(a+)+b/'.format('^' if negate else ''), 1)
+    with quarantine_scope():
+        assert patternobj.test('critical disk failure') == negate
+        patternobj.test('aab')
+        assert patternobj.regex.quarantined
+        # a disabled pattern does not apply to any line
+        assert not patternobj.test('critical disk failure')
+        assert not patternobj.test('aab')
+    # the quarantine ends with the run
+    assert not patternobj.regex.quarantined
+    assert patternobj.test('critical disk failure') == negate
+
+
 def test_process_actions(mocker):
     class DummyAction(Action):
         def __init__(self, data, type_):
@@ -105,7 +146,7 @@ def test_process_actions(mocker):
         def __eq__(self, other):
             return self.type == other.type and self.data == other.data
 
-    mocker.patch('logstapo.actions.Action.from_config', lambda type_, data: DummyAction(data, type_))
+    mocker.patch('logstapo.actions.Action.from_config', lambda type_, data, timeout: DummyAction(data, type_))
     actions, auto_actions = config._process_actions({'foo': {'type': 'FOO', 'hello': 'world'},
                                                      'bar': {'type': 'BAR', 'auto': False}})
     assert actions == {'foo': DummyAction({'hello': 'world'}, 'FOO'),
@@ -113,6 +154,16 @@ def test_process_actions(mocker):
     assert auto_actions == {'foo'}
 
 
+def test_process_actions_timeout(mocker):
+    from_config = mocker.patch('logstapo.actions.Action.from_config')
+    config._process_actions({'foo': {'type': 'FOO', 'timeout': 10},
+                             'bar': {'type': 'BAR'}}, 60)
+    from_config.assert_any_call('FOO', {}, 10)
+    from_config.assert_any_call('BAR', {}, 60)
+    with pytest.raises(config.ConfigError):
+        config._process_actions({'foo': {'type': 'FOO', 'timeout': 0}})
+
+
 def test_process_actions_invalid(mocker):
     # no type
     with pytest.raises(config.ConfigError):
@@ -195,7 +246,7 @@ def test_process_log_actions_invalid():
 ))
 def test_unify_patterns(mocker, data, expected):
     class DummyPattern(object):
-        def __init__(self, pattern):
+        def __init__(self, pattern, slow_match=None):
             self.pattern = pattern
 
         def __eq__(self, other):
@@ -214,7 +265,7 @@ def test_unify_patterns(mocker, data, expected):
 ))
 def test_unify_nested_patterns(mocker, data, expected):
     class DummyPattern(object):
-        def __init__(self, pattern=None):
+        def __init__(self, pattern=None, slow_match=None):
             self.pattern = pattern
 
         def __eq__(self, other):
@@ -231,7 +282,7 @@ def test_unify_nested_patterns(mocker, data, expected):
 @pytest.mark.parametrize('has_actions', (True, False))
 def test_process_config(mocker, has_actions):
     class DummyPattern(object):
-        def __init__(self, pattern=None):
+        def __init__(self, pattern=None, slow_match=None):
             self.pattern = pattern
 
         def __eq__(self, other):
@@ -252,6 +303,8 @@ def test_process_config(mocker, has_actions):
             'actions': {'spam': {'type': 'smtp', 'to': 'test@example.com'}} if has_actions else {}}
     rv = config.process_config(data)
     assert warning_echo.called == (not has_actions)
+    # settings
+    assert rv['settings'] == DEFAULT_SETTINGS
     # regexps
     assert rv['regexps'] == {'rex': re.compile('(?P<source>.)(?P<message>.)')}
     # logs
@@ -259,16 +312,99 @@ def test_process_config(mocker, has_actions):
                                    'regexps': ('rex',),
                                    'actions': ('spam',) if has_actions else (),
                                    'ignore': {DummyPattern(): [DummyPattern('boring')]},
-                                   'garbage': [DummyPattern('crap*')]}}
+                                   'garbage': [DummyPattern('crap*')],
+                                   'max_bytes': None,
+                                   'max_seconds': None,
+                                   'interval': None,
+                                   'summarize': None,
+                                   'multiline': None}}
     # actions
     if has_actions:
         assert rv['actions'].keys() == {'spam'}
-        action_from_config.assert_called_once_with('smtp', {'to': 'test@example.com'})
+        action_from_config.assert_called_once_with('smtp', {'to': 'test@example.com'}, 300)
     else:
         assert not rv['actions']
         assert not action_from_config.called
 
 
+@pytest.mark.parametrize(('data', 'expected'), (
+    ({}, None),
+    ({'max_bytes': None}, None),
+    ({'max_bytes': 1024}, 1024),
+))
+def test_process_limit(data, expected):
+    assert config._process_limit(data, 'max_bytes') == expected
+
+
+@pytest.mark.parametrize('value', (0, -1, 'foo', 1.5, True))
+def test_process_limit_invalid(value):
+    with pytest.raises(config.ConfigError):
+        config._process_limit({'max_bytes': value}, 'max_bytes')
+
+
+@pytest.mark.parametrize(('data', 'expected'), (
+    ({}, None),
+    ({'summarize': False}, None),
+    ({'summarize': True}, 100),
+    ({'summarize': 10}, 10),
+))
+def test_process_summarize(data, expected):
+    assert config._process_summarize(data) == expected
+
+
+@pytest.mark.parametrize('value', (0, 'foo'))
+def test_process_summarize_invalid(value):
+    with pytest.raises(config.ConfigError):
+        config._process_summarize({'summarize': value})
+
+
+@pytest.mark.parametrize(('data', 'expected'), (
+    ({}, None),
+    ({'multiline': False}, None),
+    ({'multiline': 'indent'}, {'continuation': 'indent', 'max_lines': 500, 'max_chars': 65536}),
+    ({'multiline': {'continuation': 'unmatched', 'max_lines': 10}},
+     {'continuation': 'unmatched', 'max_lines': 10, 'max_chars': 65536}),
+    ({'multiline': r'\s+at '}, {'continuation': re.compile(r'\s+at '), 'max_lines': 500, 'max_chars': 65536}),
+))
+def test_process_multiline(data, expected):
+    assert config._process_multiline(data) == expected
+
+
+@pytest.mark.parametrize('value', (
+    '',
+    '(',
+    123,
+    {'max_lines': 10},
+    {'continuation': 'indent', 'max_lines': 0},
+    {'continuation': 'indent', 'foo': 'bar'},
+))
+def test_process_multiline_invalid(value):
+    with pytest.raises(config.ConfigError):
+        config._process_multiline({'multiline': value})
+
+
+def test_process_settings():
+    assert config._process_settings({}) == DEFAULT_SETTINGS
+    assert config._process_settings({'checkpoint_bytes': None})['checkpoint_bytes'] is None
+    assert config._process_settings({'checkpoint_bytes': 123})['checkpoint_bytes'] == 123
+
+
+@pytest.mark.parametrize('data', (
+    [],
+    {'foo': 'bar'},
+    {'checkpoint_bytes': 0},
+    {'spool': ''},
+    {'spool': 123},
+    {'spool_attempts': None},
+    {'spool_backoff': 0},
+    {'spool_backoff': 'foo'},
+    {'spool_max_attempts': 0},
+))
+def test_process_settings_invalid(data):
+    with pytest.raises(config.ConfigError):
+        config._process_settings(data)
+
+
 def test_process_config_invalid():
     with pytest.raises(config.ConfigError):
         config.process_config(None)
@@ -280,3 +416,66 @@ def test_process_config_invalid():
             'logs': {'test': {}}}
     with pytest.raises(config.ConfigError):
         config.process_config(data)
+
+
+def _config(**kwargs):
+    return config.Config(regexps={}, logs={'test': {}}, actions={}, settings={'foo': 'bar'}, **kwargs)
+
+
+def test_config_object():
+    cfg = _config(debug=True)
+    assert cfg.debug
+    assert cfg['debug']
+    assert not cfg['dry_run']
+    assert cfg.get('settings')['foo'] == 'bar'
+    assert 'logs' in cfg
+    assert 'foo' not in cfg
+    with pytest.raises(KeyError):
+        cfg['foo']
+    with pytest.raises(AttributeError):
+        cfg.debug = False
+    with pytest.raises(TypeError):
+        cfg.settings['foo'] = 'baz'
+    other = cfg.replace(dry_run=True)
+    assert other.dry_run
+    assert other.debug
+    assert not cfg.dry_run
+
+
+def test_config_object_nested():
+    cfg = config.Config(regexps={}, logs={'test': {'files': ['a.log'], 'multiline': {'max_lines': 10}}},
+                        actions={}, settings={})
+    data = cfg.logs['test']
+    assert data['files'] == ('a.log',)
+    with pytest.raises(TypeError):
+        data['files'] = ('b.log',)
+    with pytest.raises(TypeError):
+        data['multiline']['max_lines'] = 20
+    with pytest.raises(TypeError):
+        data['multiline'].update(max_lines=20)
+    # log definitions are pickled when replaying logs in multiple processes
+    assert pickle.loads(pickle.dumps(data)) == data
+    assert cfg.replace(dry_run=True).logs == cfg.logs
+
+
+def test_use_config():
+    cfg = _config(verbosity=2)
+    with config.use_config(cfg):
+        assert config.current_config['verbosity'] == 2
+        rv = []
+        thread = threading.Thread(target=config.bind_config(lambda: rv.append(config.current_config.data)))
+        thread.start()
+        thread.join()
+        assert rv == [cfg]
+    with pytest.raises(RuntimeError):
+        config.current_config.data
+
+
+def test_load_config(tmpdir):
+    path = tmpdir.join('logstapo.yml')
+    path.write('regexps:\n  rex: "(?P<source>.)(?P<message>.)"\nlogs:\n  test:\n    file: test.log\n    regex: rex\n')
+    cfg = config.load_config(path.strpath, verbosity=1)
+    assert isinstance(cfg, config.Config)
+    assert cfg.verbosity == 1
+    assert not cfg.dry_run
+    assert cfg.logs['test']['files'] == ('test.log',)
@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+from logstapo.dedup import DedupCache, fingerprint
+
+
+def _parsed(source, message, **kwargs):
+    return dict({'source': source, 'message': message}, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def config(mock_config):
+    mock_config({'debug': False, 'verbosity': 0})
+
+
+@pytest.fixture
+def cache_path(tmpdir):
+    return tmpdir.join('dedup.json')
+
+
+def _cache(path, now, window=100, max_entries=10):
+    cache = DedupCache(path.strpath, window, max_entries)
+    cache.now = now
+    return cache
+
+
+def test_fingerprint():
+    assert fingerprint('a', _parsed('s', 'error 1')) == fingerprint('a', _parsed('s', 'error 2'))
+    assert fingerprint('a', _parsed('s', 'error 1')) != fingerprint('b', _parsed('s', 'error 1'))
+    assert fingerprint('a', _parsed('s', 'error 1')) != fingerprint('a', _parsed('t', 'error 1'))
+    assert fingerprint('a', _parsed('s', 'x', template='error <NUM>')) == fingerprint('a', _parsed('s', 'error 1'))
+
+
+def test_dedup_cache(cache_path):
+    lines = [('l1', _parsed('s', 'error 1')), ('l2', _parsed('s', 'error 2')), ('l3', _parsed('s', 'other'))]
+    cache = _cache(cache_path, 1000)
+    assert cache.filter('log', lines) == [lines[0], lines[2]]
+    cache.commit({'log'})
+    cache.save()
+    # within the window
+    cache = _cache(cache_path, 1050)
+    assert cache.filter('log', lines[:1]) == []
+    cache.commit({'log'})
+    cache.save()
+    # window has passed
+    cache = _cache(cache_path, 1101)
+    assert cache.filter('log', lines) == [('l1', _parsed('s', 'error 1', repeat=4, first_seen=1000)),
+                                          ('l3', _parsed('s', 'other', repeat=2, first_seen=1000))]
+    cache.commit({'log'})
+    cache.save()
+    # reported again, so the window starts again
+    cache = _cache(cache_path, 1150)
+    assert cache.filter('log', lines[:1]) == []
+
+
+def test_dedup_cache_summary_count(cache_path):
+    cache = _cache(cache_path, 1000)
+    cache.filter('log', [('l1', _parsed('s', 'error 1', template='error <NUM>', count=10))])
+    cache.now = 2000
+    assert cache.filter('log', [('l1', _parsed('s', 'error 1', template='error <NUM>', count=5))])[0][1]['repeat'] == 15
+
+
+def test_dedup_cache_commit(cache_path):
+    cache = _cache(cache_path, 1000)
+    cache.filter('a', [('l1', _parsed('s', 'x'))])
+    cache.filter('b', [('l1', _parsed('s', 'x'))])
+    cache.commit({'a'})
+    # entries of logs whose actions failed are not remembered
+    assert cache.filter('a', [('l1', _parsed('s', 'x'))]) == []
+    assert cache.filter('b', [('l1', _parsed('s', 'x'))]) == [('l1', _parsed('s', 'x'))]
+
+
+def test_dedup_cache_eviction(cache_path):
+    cache = _cache(cache_path, 1000, max_entries=2)
+    for now, line, message in [(1000, 'l1', 'expired'), (1100, 'l2', 'a'), (1120, 'l3', 'b'), (1150, 'l4', 'c')]:
+        cache.now = now
+        cache.filter('log', [(line, _parsed('s', message))])
+    cache.commit({'log'})
+    cache.save()
+    assert len(json.loads(cache_path.read())) == 2
+    cache = _cache(cache_path, 1160, max_entries=2)
+    # the first entry expired and the second one was evicted
+    lines = [('l1', _parsed('s', 'expired')), ('l2', _parsed('s', 'a')), ('l4', _parsed('s', 'c'))]
+    assert [line for line, __ in cache.filter('log', lines)] == ['l1', 'l2']
+
+
+def test_dedup_cache_concurrent(cache_path):
+    first = _cache(cache_path, 1000)
+    second = _cache(cache_path, 1010)
+    assert first.filter('a', [('l1', _parsed('s', 'x'))]) == [('l1', _parsed('s', 'x'))]
+    second.filter('b', [('l1', _parsed('s', 'x'))])
+    second.filter('a', [('l1', _parsed('s', 'x'))])
+    first.commit({'a'})
+    second.commit({'a', 'b'})
+    first.save()
+    second.save()
+    # the entries of the first instance were not lost when the second one saved the cache
+    cache = _cache(cache_path, 1050)
+    assert cache.filter('a', [('l1', _parsed('s', 'x'))]) == []
+    assert cache.filter('b', [('l1', _parsed('s', 'x'))]) == []
+    assert len(json.loads(cache_path.read())) == 2
+
+
+def test_dedup_cache_invalid(mocker, cache_path):
+    warning_echo = mocker.patch('logstapo.dedup.warning_echo')
+    cache_path.write('garbage')
+    cache = _cache(cache_path, 1000)
+    assert warning_echo.called
+    assert cache.filter('log', [('l1', _parsed('s', 'x'))])
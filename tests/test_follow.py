@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from logstapo.follow import InotifyWatcher, PollingWatcher, create_watcher
+
+
+@pytest.fixture(params=('inotify', 'polling'))
+def make_watcher(request):
+    watchers = []
+
+    def _make_watcher(paths):
+        if request.param == 'inotify':
+            watcher = InotifyWatcher(paths)
+        else:
+            watcher = PollingWatcher(paths, 0.01)
+        watchers.append(watcher)
+        return watcher
+
+    yield _make_watcher
+    for watcher in watchers:
+        watcher.close()
+
+
+def test_watcher_timeout(tmpdir, make_watcher):
+    log = tmpdir.join('test.log')
+    log.write('')
+    watcher = make_watcher([log.strpath])
+    assert not watcher.wait(0.05)
+
+
+def test_watcher_append(tmpdir, make_watcher):
+    log = tmpdir.join('test.log')
+    log.write('')
+    watcher = make_watcher([log.strpath])
+    timer = threading.Timer(0.05, lambda: log.write('foo\n', 'a'))
+    timer.start()
+    assert watcher.wait(5)
+    timer.join()
+
+
+def test_watcher_rotate(tmpdir, make_watcher):
+    log = tmpdir.join('test.log')
+    log.write('foo\n')
+    watcher = make_watcher([log.strpath])
+    log.rename(tmpdir.join('test.log.1'))
+    log.write('')
+    assert watcher.wait(5)
+
+
+def test_inotify_watcher_ignores_other_files(tmpdir):
+    log = tmpdir.join('test.log')
+    log.write('')
+    watcher = InotifyWatcher([log.strpath])
+    tmpdir.join('test.log.offset').write('123\n0\n')
+    assert not watcher.wait(0.05)
+    watcher.close()
+
+
+def test_create_watcher_fallback(mocker, tmpdir):
+    mocker.patch('logstapo.follow.debug_echo')
+    mocker.patch('logstapo.follow.InotifyWatcher', side_effect=OSError('not supported'))
+    watcher = create_watcher([tmpdir.join('test.log').strpath], 5)
+    assert isinstance(watcher, PollingWatcher)
+    assert watcher.interval == 5
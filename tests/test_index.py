@@ -0,0 +1,57 @@
+import math
+
+import pytest
+
+from logstapo.index import LogIndex
+
+
+@pytest.fixture(autouse=True)
+def _mock_echo(mocker):
+    mocker.patch('logstapo.index.debug_echo')
+
+
+@pytest.fixture
+def index_path(tmpdir):
+    return tmpdir.join('test.log.offset.index').strpath
+
+
+def test_index_roundtrip(index_path):
+    index = LogIndex(index_path, 100)
+    assert index.inode is None
+    index.reset(123, (10, 'a' * 40))
+    index.add(0, 0, 1000)
+    index.add(150, 10)
+    index.advance(200, 12)
+    index.save()
+    index = LogIndex(index_path, 100)
+    assert index.matches(123, (10, 'a' * 40))
+    assert not index.matches(124, (10, 'a' * 40))
+    assert list(index.offsets) == [0, 150]
+    assert list(index.lines) == [0, 10]
+    assert index.times[0] == 1000
+    assert math.isnan(index.times[1])
+    assert (index.end, index.end_line) == (200, 12)
+    assert index.next_offset == 250
+
+
+def test_index_invalid(index_path):
+    with open(index_path, 'wb') as f:
+        f.write(b'garbage')
+    index = LogIndex(index_path, 100)
+    assert index.inode is None
+    assert not index.offsets
+
+
+def test_index_find(index_path):
+    index = LogIndex(index_path, 100)
+    index.reset(123, (10, 'a' * 40))
+    for i, timestamp in enumerate([100, None, 200, 300]):
+        index.add(i * 100, i * 10, timestamp)
+    assert index.find_time(50) == (0, 0)
+    assert index.find_time(150) == (0, 200)
+    assert index.find_time(200) == (0, 200)
+    assert index.find_time(250) == (200, 300)
+    assert index.find_time(1000) == (300, None)
+    assert index.find_line(0) == (0, 0)
+    assert index.find_line(25) == (200, 20)
+    assert index.find_line(1000) == (300, 30)
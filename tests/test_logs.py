@@ -1,12 +1,14 @@
 import re
 import textwrap
-from collections import OrderedDict
-from unittest.mock import call
+from collections import Counter, OrderedDict
+from datetime import datetime
+from unittest.mock import ANY, call
 
 import pytest
 
 from logstapo.config import _Pattern
-from logstapo.logs import process_logs, process_log
+from logstapo.logs import (process_logs, process_log, make_template, SpaceSaving, get_due_logs, LogLocks,
+                           ParseWarnings, assemble_records)
 
 
 @pytest.mark.parametrize(('names', 'expected'), (
@@ -21,17 +23,58 @@ def test_process_logs(mocker, mock_config, names, expected):
     process_log.assert_has_calls([call(x) for x in expected])
 
 
+def test_process_logs_pending(mocker, mock_config):
+    mock_config({'logs': {'a': object(), 'b': object()}})
+    process_log = mocker.patch('logstapo.logs.process_log')
+    pending = {'a': {'foo': 'bar'}}
+    process_logs(pending=pending)
+    assert pending == {'a': {'foo': 'bar'}, 'b': {}}
+    process_log.assert_has_calls([call('a', pending={'foo': 'bar'}), call('b', pending={})])
+    warnings = {}
+    process_logs(['a'], warnings=warnings)
+    process_log.assert_called_with('a', warnings=warnings)
+
+
+def test_process_logs_locked(mocker, mock_config, tmpdir):
+    mock_config({'debug': False, 'verbosity': 0,
+                 'logs': {'a': {'files': [tmpdir.join('a.log').strpath]},
+                          'b': {'files': [tmpdir.join('b.log').strpath, tmpdir.join('shared.log').strpath]},
+                          'c': {'files': [tmpdir.join('shared.log').strpath]}}})
+    process_log = mocker.patch('logstapo.logs.process_log')
+    with LogLocks() as other, LogLocks() as locks:
+        assert other.acquire('a')
+        process_logs(locks=locks)
+        process_log.assert_has_calls([call('b'), call('c')])
+        assert process_log.call_count == 2
+    with LogLocks() as locks:
+        # all locks have been released
+        assert locks.acquire('a')
+        assert locks.acquire('b')
+        # the file is shared with 'b'
+        assert not LogLocks().acquire('c')
+    assert tmpdir.join('shared.log.offset.lock').check()
+
+
 @pytest.mark.parametrize('dry_run', (True, False))
 def test_process_log(mocker, mock_config, dry_run):
     test_log_def = {'garbage': [_Pattern('crap')],
                     'ignore': {_Pattern('foo'): [_Pattern('boring')],
                                _Pattern('bar'): [_Pattern('zzz')]},
                     'regexps': ['test'],
-                    'files': ['foo']}
+                    'files': ['foo'],
+                    'max_bytes': None,
+                    'max_seconds': None,
+                    'interval': None,
+                    'summarize': None,
+                    'multiline': None}
     config = {'verbosity': 0,
               'debug': False,
               'dry_run': dry_run,
+              'since': None,
+              'until': None,
               'regexps': {'test': re.compile('^(?P<source>[^/]+)/(?P<message>.+)$')},
+              'settings': {'checkpoint_bytes': 123, 'io_rate': None, 'drop_cache': False, 'parse_warnings': None,
+                           'index_interval': None, 'max_line_length': None, 'seen_filter': None},
               'logs': {'test': test_log_def}}
     dummy_logs = textwrap.dedent('''
         crap
@@ -53,4 +96,289 @@ def test_process_log(mocker, mock_config, dry_run):
                 for x in ['foo/zzz', 'foo/123', 'bar/boring', 'bar/456']]
     assert other == expected
     assert invalid == ['wtf']
-    logtail.assert_called_once_with('foo', dry_run=dry_run)
+    logtail.assert_called_once_with('foo', dry_run=dry_run, max_bytes=None, max_seconds=None, throttle=ANY,
+                                    index_interval=None, max_line_length=None, stats=ANY,
+                                    seen_filter_size=None)
+    logtail.reset_mock()
+    pending = {}
+    process_log('test', pending=pending)
+    logtail.assert_called_once_with('foo', dry_run=dry_run, max_bytes=None, max_seconds=None, throttle=ANY,
+                                    index_interval=None, max_line_length=None, stats=ANY,
+                                    seen_filter_size=None, chunk_bytes=123, pending=pending)
+
+
+@pytest.mark.parametrize('debug', (True, False))
+def test_process_log_debug_disabled(mocker, mock_config, debug):
+    mock_config({'verbosity': 0, 'debug': debug, 'dry_run': False, 'since': None, 'until': None,
+                 'regexps': {},
+                 'settings': {'io_rate': None, 'drop_cache': False, 'parse_warnings': None, 'index_interval': None,
+                              'max_line_length': None, 'seen_filter': None},
+                 'logs': {'test': {'garbage': [_Pattern('*')], 'ignore': {}, 'regexps': [], 'files': ['foo'],
+                                   'max_bytes': None, 'max_seconds': None, 'interval': None, 'summarize': None,
+                                   'multiline': None}}})
+    mocker.patch('logstapo.logs.logtail', return_value=['a', 'b'])
+    mocker.patch('logstapo.logs.verbose_echo')
+    debug_echo = mocker.patch('logstapo.logs.debug_echo')
+    process_log('test')
+    # no per-line overhead if debug output is disabled
+    assert debug_echo.call_count == (2 if debug else 0)
+
+
+def test_process_log_warnings(mocker, mock_config):
+    mock_config({'verbosity': 0, 'debug': False, 'dry_run': False, 'since': None, 'until': None,
+                 'regexps': {'test': re.compile('^(?P<source>[^/]+)/(?P<message>.+)$')},
+                 'settings': {'io_rate': None, 'drop_cache': False, 'parse_warnings': 1, 'index_interval': None,
+                              'max_line_length': None, 'seen_filter': None},
+                 'logs': {'test': {'garbage': [], 'ignore': {}, 'regexps': ['test'], 'files': ['foo'],
+                                   'max_bytes': None, 'max_seconds': None, 'interval': None, 'summarize': None,
+                                   'multiline': None}}})
+    mocker.patch('logstapo.logs.logtail', side_effect=[['bad 1', 'bad 2'], ['bad 3']])
+    mocker.patch('logstapo.logs.verbose_echo')
+    warning_echo = mocker.patch('logstapo.logs.warning_echo')
+    warnings = {}
+    assert process_log('test', warnings=warnings)[1] == ['bad 1', 'bad 2']
+    # the limit applies to both calls and the summary is left to the caller
+    assert process_log('test', warnings=warnings)[1] == ['bad 3']
+    assert [x[0][0] for x in warning_echo.call_args_list] == ['[test] Could not parse: bad 1']
+    warnings['test'].finish()
+    assert warning_echo.call_args[0][0] == '[test] 2 more unparsable lines (1 distinct shapes)'
+
+
+def test_process_log_summarize(mocker, mock_config):
+    mock_config({'verbosity': 0,
+                 'debug': False,
+                 'dry_run': False,
+                 'since': None,
+                 'until': None,
+                 'regexps': {'test': re.compile('^(?P<source>[^/]+)/(?P<message>.+)$')},
+                 'settings': {'io_rate': None, 'drop_cache': False, 'parse_warnings': None, 'index_interval': None,
+                              'max_line_length': None, 'seen_filter': None},
+                 'logs': {'test': {'garbage': [], 'ignore': {}, 'regexps': ['test'], 'files': ['foo'],
+                                   'max_bytes': None, 'max_seconds': None, 'interval': None, 'summarize': 10,
+                                   'multiline': None}}})
+    mocker.patch('logstapo.logs.verbose_echo')
+    lines = ['foo/error {}'.format(i) for i in range(5)] + ['bar/something', 'foo/other']
+    mocker.patch('logstapo.logs.logtail', return_value=lines)
+    other, invalid = process_log('test')
+    assert not invalid
+    assert [(line, parsed['source'], parsed['template'], parsed['count']) for line, parsed in other] == [
+        ('foo/error 0', 'foo', 'error <NUM>', 5),
+        ('bar/something', 'bar', 'something', 1),
+        ('foo/other', 'foo', 'other', 1),
+    ]
+    assert other[0][1]['examples'] == ['foo/error 0', 'foo/error 1', 'foo/error 2']
+    assert other[0][1]['message'] == 'error 0'
+
+
+@pytest.mark.parametrize(('continuation', 'lines', 'expected'), (
+    ('indent', ['a', ' b', '\tc', 'd'], [('a', [' b', '\tc']), ('d', [])]),
+    ('indent', [' a', 'b'], [('a', []), ('b', [])]),
+    ('unmatched', ['x/a', 'b', 'c', 'x/d'], [('x/a', ['b', 'c']), ('x/d', [])]),
+    (re.compile(r'(Caused by:|\s+at) '), ['x/a', 'Caused by: y', '  at z', 'x/b'],
+     [('x/a', ['Caused by: y', '  at z']), ('x/b', [])]),
+))
+def test_assemble_records(continuation, lines, expected):
+    regex = re.compile('^(?P<source>[^/]+)/(?P<message>.+)$')
+    records = list(assemble_records(lines, [regex], continuation, 10, 100))
+    assert [(head, continued) for head, __, continued in records] == expected
+    # the match is only reused if it has been determined anyway
+    assert all((match is not None) == (continuation == 'unmatched') for head, match, __ in records)
+
+
+def test_assemble_records_limits():
+    lines = ['a'] + [' {}'.format(i) for i in range(5)] + ['b', ' ' + 'x' * 20]
+    records = list(assemble_records(lines, [], 'indent', 3, 20))
+    assert [(head, continued) for head, __, continued in records] == [
+        ('a', [' 0', ' 1', ' 2', '[2 more lines dropped]']),
+        ('b', ['[1 more lines dropped]']),
+    ]
+
+
+def test_process_log_multiline(mocker, mock_config):
+    mock_config({'verbosity': 0,
+                 'debug': False,
+                 'dry_run': False,
+                 'since': None,
+                 'until': None,
+                 'regexps': {'test': re.compile('^(?P<source>[^/]+)/(?P<message>.+)$')},
+                 'settings': {'io_rate': None, 'drop_cache': False, 'parse_warnings': None, 'index_interval': None,
+                              'max_line_length': None, 'seen_filter': None},
+                 'logs': {'test': {'garbage': [_Pattern('crap*')], 'ignore': {_Pattern(): [_Pattern('boring')]},
+                                   'regexps': ['test'], 'files': ['foo'],
+                                   'max_bytes': None, 'max_seconds': None, 'interval': None, 'summarize': None,
+                                   'multiline': {'continuation': 'indent', 'max_lines': 10, 'max_chars': 100}}}})
+    mocker.patch('logstapo.logs.verbose_echo')
+    mocker.patch('logstapo.logs.warning_echo')
+    lines = ['app/error', '  at foo', '  at bar', 'app/boring', '  at foo', 'crap', '  at foo', 'wtf', '  at foo']
+    mocker.patch('logstapo.logs.logtail', return_value=lines)
+    other, invalid = process_log('test')
+    assert other == [('app/error\n  at foo\n  at bar', {'source': 'app', 'message': 'error\n  at foo\n  at bar'})]
+    assert invalid == ['wtf\n  at foo']
+
+
+@pytest.mark.parametrize('continuation', ('indent', 'unmatched', r'\s+at '))
+def test_process_log_multiline_logtail(mocker, mock_config, tmpdir, continuation):
+    log = tmpdir.join('test.log')
+    log.write('app/failed: Exception  \n    at foo\n    at bar\n  app/indented  \n')
+    mock_config({'verbosity': 0, 'debug': False, 'dry_run': True, 'since': None, 'until': None,
+                 'regexps': {'test': re.compile('^(?P<source>[^/]+)/(?P<message>.+)$')},
+                 'settings': {'io_rate': None, 'drop_cache': False, 'parse_warnings': None, 'index_interval': None,
+                              'max_line_length': None, 'seen_filter': None},
+                 'logs': {'test': {'garbage': [], 'ignore': {}, 'regexps': ['test'], 'files': [log.strpath],
+                                   'max_bytes': None, 'max_seconds': None, 'interval': None, 'summarize': None,
+                                   'multiline': {'continuation': continuation if continuation != r'\s+at ' else
+                                                 re.compile(continuation), 'max_lines': 10, 'max_chars': 100}}}})
+    mocker.patch('logstapo.logs.verbose_echo')
+    mocker.patch('logstapo.logtail.debug_echo')
+    other, invalid = process_log('test')
+    assert not invalid
+    expected = [('app/failed: Exception\n    at foo\n    at bar',
+                 {'source': 'app', 'message': 'failed: Exception\n    at foo\n    at bar'})]
+    if continuation == 'indent':
+        # indented lines are always continuation lines
+        expected[0] = (expected[0][0] + '\n  app/indented', {
+            'source': 'app', 'message': 'failed: Exception\n    at foo\n    at bar\n  app/indented'})
+    else:
+        expected.append(('app/indented', {'source': 'app', 'message': 'indented'}))
+    assert other == expected
+
+
+def test_process_log_multiline_files(mocker, mock_config, tmpdir):
+    first = tmpdir.join('first.log')
+    first.write('app/error\n  at foo\n')
+    second = tmpdir.join('second.log')
+    second.write('  at bar\napp/other\n')
+    mock_config({'verbosity': 0, 'debug': False, 'dry_run': True, 'since': None, 'until': None,
+                 'regexps': {'test': re.compile('^(?P<source>[^/]+)/(?P<message>.+)$')},
+                 'settings': {'io_rate': None, 'drop_cache': False, 'parse_warnings': None, 'index_interval': None,
+                              'max_line_length': None, 'seen_filter': None},
+                 'logs': {'test': {'garbage': [], 'ignore': {}, 'regexps': ['test'],
+                                   'files': [first.strpath, second.strpath],
+                                   'max_bytes': None, 'max_seconds': None, 'interval': None, 'summarize': None,
+                                   'multiline': {'continuation': 'indent', 'max_lines': 10, 'max_chars': 100}}}})
+    mocker.patch('logstapo.logs.verbose_echo')
+    mocker.patch('logstapo.logs.warning_echo')
+    mocker.patch('logstapo.logtail.debug_echo')
+    other, invalid = process_log('test')
+    # an entry does not continue in the next file
+    assert [line for line, __ in other] == ['app/error\n  at foo', 'app/other']
+    assert invalid == ['at bar']
+
+
+@pytest.mark.parametrize('has_timestamp', (True, False))
+def test_process_log_time_range(mocker, mock_config, has_timestamp):
+    regex = '^(?P<timestamp>\\S+ \\S+) (?P<source>[^/]+)/(?P<message>.+)$'
+    if not has_timestamp:
+        regex = regex.replace('?P<timestamp>', '')
+    mock_config({'verbosity': 0, 'debug': False, 'dry_run': False, 'since': 100, 'until': 200,
+                 'regexps': {'test': re.compile(regex)},
+                 'settings': {'io_rate': None, 'drop_cache': False, 'parse_warnings': None, 'index_interval': None,
+                              'max_line_length': None, 'seen_filter': None},
+                 'logs': {'test': {'garbage': [], 'ignore': {}, 'regexps': ['test'], 'files': ['foo'],
+                                   'max_bytes': None, 'max_seconds': None, 'interval': None, 'summarize': None,
+                                   'multiline': None}}})
+    mocker.patch('logstapo.logs.verbose_echo')
+    warning_echo = mocker.patch('logstapo.logs.warning_echo')
+    logtail = mocker.patch('logstapo.logs.logtail', return_value=[])
+    process_log('test')
+    kwargs = logtail.call_args[1]
+    assert warning_echo.called == (not has_timestamp)
+    if has_timestamp:
+        assert (kwargs['since'], kwargs['until']) == (100, 200)
+        assert kwargs['get_time']('2017-01-02 03:04:05 foo/bar') == datetime(2017, 1, 2, 3, 4, 5).timestamp()
+        assert kwargs['get_time']('garbage') is None
+    else:
+        assert 'since' not in kwargs
+
+
+@pytest.mark.parametrize(('message', 'expected'), (
+    ('login from 192.168.1.12 port 51234 ssh2', 'login from <IP> port <NUM> ssh2'),
+    ('connection from fe80::1 closed', 'connection from <IP> closed'),
+    ('I/O error on /dev/sda1, sector 12345', 'I/O error on <PATH>, sector <NUM>'),
+    ('request 3f2a9c1bde00 took 0.53s', 'request <HEX> took <NUM>s'),
+    ('segfault at 0x7f12 in libfoo', 'segfault at <HEX> in libfoo'),
+    ('eth0: link up', 'eth0: link up'),
+    ('device 00:11:22:aa:bb:cc added', 'device <MAC> added'),
+    ('job 123e4567-e89b-12d3-a456-426614174000 started', 'job <UUID> started'),
+))
+def test_make_template(message, expected):
+    assert make_template(message) == expected
+
+
+def test_space_saving():
+    summary = SpaceSaving(2)
+    for message in ['a 1', 'a 2', 'a 3', 'b', 'c', 'c', 'c']:
+        summary.add(message, {'source': 's', 'message': message})
+    assert summary.total == 7
+    # 'b' was replaced by 'c', which inherited its count
+    assert [(x['template'], x['count'], x['error']) for __, x in summary.results()] == [('c', 4, 1), ('a <NUM>', 3, 0)]
+
+
+def test_space_saving_many_templates():
+    summary = SpaceSaving(10)
+    true_counts = Counter()
+    for i in range(2000):
+        # a few frequent sources among many rare ones
+        source = 'frequent{}'.format(i % 3) if i % 2 else 'rare{}'.format(i * 7 % 500)
+        true_counts[source] += 1
+        summary.add(source, {'source': source, 'message': 'x'})
+    results = summary.results()
+    assert len(results) == 10
+    assert sum(x['count'] for __, x in results) == 2000
+    for __, x in results:
+        assert x['count'] - x['error'] <= true_counts[x['source']] <= x['count']
+    assert {x['source'] for __, x in results[:3]} == {'frequent0', 'frequent1', 'frequent2'}
+
+
+def test_get_due_logs(mocker, mock_config):
+    mocker.patch('logstapo.logs.time').time.return_value = 1000
+    states = {'a.log': None,
+              'b.log': {'checked': None},
+              'c.log': {'checked': 950},
+              'd.log': {'checked': 900},
+              'e1.log': {'checked': 990},
+              'e2.log': {'checked': 800}}
+    mocker.patch('logstapo.logs.load_state', side_effect=states.get)
+    mock_config({'logs': {'always': {'files': ['c.log'], 'interval': None},
+                          'missing': {'files': ['a.log'], 'interval': 100},
+                          'unchecked': {'files': ['b.log'], 'interval': 100},
+                          'recent': {'files': ['c.log'], 'interval': 100},
+                          'old': {'files': ['d.log'], 'interval': 100},
+                          'partial': {'files': ['e1.log', 'e2.log'], 'interval': 100}}})
+    assert get_due_logs() == ['always', 'missing', 'old', 'partial', 'unchecked']
+
+
+def test_process_log_interval(mocker, mock_config):
+    mock_config({'verbosity': 0, 'debug': False, 'dry_run': False, 'since': None, 'until': None,
+                 'regexps': {},
+                 'settings': {'checkpoint_bytes': None, 'io_rate': None, 'drop_cache': False,
+                              'parse_warnings': None, 'index_interval': None, 'max_line_length': None,
+                              'seen_filter': None},
+                 'logs': {'test': {'garbage': [], 'ignore': {}, 'regexps': [], 'files': ['foo', 'bar'],
+                                   'max_bytes': None, 'max_seconds': None, 'interval': 60, 'summarize': None,
+                                   'multiline': None}}})
+    mocker.patch('logstapo.logs.verbose_echo')
+    time = mocker.patch('logstapo.logs.time')
+    time.time.return_value = 1000
+    time.monotonic.return_value = 0
+    mocker.patch('logstapo.logs.logtail', return_value=[])
+    pending = {'foo.offset': {'backlog': False}, 'bar.offset': {'backlog': True}}
+    process_log('test', pending=pending)
+    assert pending == {'foo.offset': {'backlog': False, 'checked': 1000}, 'bar.offset': {'backlog': True}}
+
+
+def test_parse_warnings(mocker):
+    warning_echo = mocker.patch('logstapo.logs.warning_echo')
+    mocker.patch('logstapo.logs.ParseWarnings.summary_interval', 5)
+    warnings = ParseWarnings('test', 2)
+    for i in range(9):
+        warnings.add('garbage {}'.format(i) if i % 2 else 'junk')
+    warnings.finish()
+    warnings.finish()
+    assert [x[0][0] for x in warning_echo.call_args_list] == [
+        '[test] Could not parse: junk',
+        '[test] Could not parse: garbage 1',
+        '[test] 5 more unparsable lines (2 distinct shapes)',
+        '[test] 2 more unparsable lines (2 distinct shapes)',
+    ]
+    assert warnings.count == 9
@@ -1,8 +1,11 @@
 import os
+import socket
+import time
 
 import py
 from click.testing import CliRunner
 
+import logstapo
 from logstapo.cli import main
 
 
@@ -43,18 +46,38 @@ Jan 17 00:25:01 hydra kernel: [1220306.643383] e1000e: lan0 NIC Link is Up 1000
 '''.strip()
 
 
-def test_logstapo(tmpdir, smtpserver):
+def _prepare(tmpdir, smtp_addr, extra_yaml=''):
     testdir = py.path.local(os.path.dirname(__file__))
     logdir = tmpdir.join('logs')
     logdir.mkdir()
     for file in testdir.join('logs').visit():
         file.copy(logdir)
     config = tmpdir.join('logstapo.yml')
+    _write_config(config, logdir, smtp_addr, extra_yaml)
+    return config, logdir
+
+
+def _write_config(config, logdir, smtp_addr, extra_yaml=''):
+    testdir = py.path.local(os.path.dirname(__file__))
     config_yaml = (testdir.join('logstapo_test.yml').read_text('ascii')
                    .replace('$LOGDIR', logdir.strpath)
-                   .replace('$SMTP_HOST', smtpserver.addr[0])
-                   .replace('$SMTP_PORT', str(smtpserver.addr[1])))
-    config.write(config_yaml)
+                   .replace('$SMTP_HOST', smtp_addr[0])
+                   .replace('$SMTP_PORT', str(smtp_addr[1])))
+    config.write(config_yaml + extra_yaml)
+
+
+def _unused_addr():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()
+
+
+def _unusual_lines(mail):
+    return mail.get_payload().splitlines()[5:]
+
+
+def test_logstapo(tmpdir, smtpserver):
+    config, logdir = _prepare(tmpdir, smtpserver.addr)
     runner = CliRunner()
     rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
     assert not rv.output
@@ -79,3 +102,143 @@ def test_logstapo(tmpdir, smtpserver):
     assert not rv.output
     assert rv.exit_code == 0
     assert len(smtpserver.outbox) == 0
+
+
+def test_logstapo_action_failed(tmpdir, smtpserver):
+    config, logdir = _prepare(tmpdir, _unused_addr())
+    runner = CliRunner()
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 1
+    # the offsets were not updated so the lines are sent once the
+    # smtp server is reachable again
+    _write_config(config, logdir, smtpserver.addr)
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 0
+    assert len(smtpserver.outbox) == 1
+    assert _unusual_lines(smtpserver.outbox[0]) == TEST_MAIL_BODY.splitlines()[5:]
+
+
+def test_logstapo_checkpoints(tmpdir, smtpserver):
+    config, logdir = _prepare(tmpdir, smtpserver.addr, 'settings:\n  checkpoint_bytes: 300\n')
+    runner = CliRunner()
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 0
+    assert len(smtpserver.outbox) > 1
+    lines = [line for mail in smtpserver.outbox for line in _unusual_lines(mail)]
+    assert sorted(lines) == sorted(TEST_MAIL_BODY.splitlines()[5:])
+
+
+def test_logstapo_checkpoints_action_failed(tmpdir, smtpserver):
+    broken_yaml = ('  broken:\n    type: smtp\n    host: {}\n    port: {}\n    auto: false\n    to: root@example.com\n'
+                   'settings:\n  checkpoint_bytes: 300\n')
+    config, logdir = _prepare(tmpdir, smtpserver.addr, broken_yaml.format(*_unused_addr()))
+    config.write(config.read().replace('/kernel.log\n', '/kernel.log\n    action: broken\n'))
+    logdir.join('kernel.log').write(TEST_LOG_APPEND + '\n', 'a')
+    runner = CliRunner()
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 1
+    # the other log needed multiple chunks, but the failed log's offset
+    # must not be committed along with them
+    assert len(smtpserver.outbox) > 1
+    assert not logdir.join('kernel.log.offset').check()
+    assert logdir.join('syslog.log.offset').check()
+    smtpserver.outbox.clear()
+    config.write(config.read().replace('    action: broken\n', '    action: test\n'))
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 0
+    assert len(smtpserver.outbox) == 1
+    assert _unusual_lines(smtpserver.outbox[0]) == TEST_MAIL_BODY_2.splitlines()[5:]
+
+
+def test_logstapo_time_range(tmpdir, smtpserver):
+    config, logdir = _prepare(tmpdir, smtpserver.addr)
+    config.write(config.read().replace("__timestamp: '[A-Za-z]{3}\\s+\\d{1,2} %(time)'",
+                                       "__timestamp: '(?P<timestamp>[A-Za-z]{3}\\s+\\d{1,2} %(time))'"))
+    assert '?P<timestamp>' in config.read()
+    runner = CliRunner()
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 0
+    smtpserver.outbox.clear()
+    logdir.join('kernel.log').write(TEST_LOG_APPEND + '\n', 'a')
+    # a time range before all entries does not move the offsets back to its end
+    rv = runner.invoke(main, ['-c', config.strpath, '--since', '10000d', '--until', '1000d'], catch_exceptions=False)
+    assert rv.exit_code == 0
+    assert not smtpserver.outbox
+    # and a time range covering the new entries does not skip them
+    rv = runner.invoke(main, ['-c', config.strpath, '--since', '10000d'], catch_exceptions=False)
+    assert rv.exit_code == 0
+    smtpserver.outbox.clear()
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 0
+    assert len(smtpserver.outbox) == 1
+    assert _unusual_lines(smtpserver.outbox[0]) == TEST_MAIL_BODY_2.splitlines()[5:]
+
+
+def test_logstapo_spool(tmpdir, smtpserver):
+    spool = tmpdir.join('logstapo.spool')
+    extra_yaml = 'settings:\n  spool: {}\n  spool_attempts: 2\n  spool_backoff: 0.01\n'.format(spool.strpath)
+    config, logdir = _prepare(tmpdir, _unused_addr(), extra_yaml)
+    runner = CliRunner()
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 1
+    assert spool.size()
+    # the lines have been spooled so the offsets were updated and the
+    # email is sent from the spool once the smtp server is reachable
+    _write_config(config, logdir, smtpserver.addr, extra_yaml)
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 0
+    assert len(smtpserver.outbox) == 1
+    assert _unusual_lines(smtpserver.outbox[0]) == TEST_MAIL_BODY.splitlines()[5:]
+    assert not spool.size()
+
+
+def test_logstapo_dedup(tmpdir, smtpserver):
+    extra_yaml = 'settings:\n  dedup: {}\n'.format(tmpdir.join('dedup.json').strpath)
+    config, logdir = _prepare(tmpdir, smtpserver.addr, extra_yaml)
+    runner = CliRunner()
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 0
+    # the ipv6 variant only differs in the address
+    expected = [line for line in TEST_MAIL_BODY.splitlines()[5:] if 'listening on ::' not in line]
+    assert _unusual_lines(smtpserver.outbox.pop()) == expected
+    logdir.join('kernel.log').write(TEST_LOG_APPEND + '\n', 'a')
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 0
+    assert _unusual_lines(smtpserver.outbox.pop()) == TEST_MAIL_BODY_2.splitlines()[5:]
+    # the same messages again (just with different numbers)
+    logdir.join('kernel.log').write(TEST_LOG_APPEND.replace('00:25', '00:26') + '\n', 'a')
+    rv = runner.invoke(main, ['-c', config.strpath], catch_exceptions=False)
+    assert rv.exit_code == 0
+    assert not smtpserver.outbox
+
+
+def test_logstapo_follow(mocker, tmpdir, smtpserver):
+    config, logdir = _prepare(tmpdir, smtpserver.addr, 'settings:\n  flush_interval: 0.01\n')
+    timeouts = []
+
+    def _wait(timeout):
+        timeouts.append(timeout)
+        if timeout is not None:
+            time.sleep(timeout)
+            return False
+        elif len(smtpserver.outbox) == 1:
+            logdir.join('kernel.log').write(TEST_LOG_APPEND + '\n', 'a')
+            return True
+        raise KeyboardInterrupt
+
+    watcher = mocker.patch('logstapo.core.create_watcher').return_value
+    watcher.wait.side_effect = _wait
+    rv = CliRunner().invoke(main, ['-c', config.strpath, '--follow'], catch_exceptions=False)
+    assert rv.exit_code == 0
+    assert len(smtpserver.outbox) == 2
+    assert _unusual_lines(smtpserver.outbox[0]) == TEST_MAIL_BODY.splitlines()[5:]
+    assert _unusual_lines(smtpserver.outbox[1]) == TEST_MAIL_BODY_2.splitlines()[5:]
+    assert [x is None for x in timeouts] == [False, True, False, True]
+    assert watcher.close.called
+
+
+def test_logstapo_library(tmpdir, smtpserver):
+    config, logdir = _prepare(tmpdir, smtpserver.addr)
+    assert logstapo.run(logstapo.load_config(config.strpath))
+    assert len(smtpserver.outbox) == 1
+    assert _unusual_lines(smtpserver.outbox[0]) == TEST_MAIL_BODY.splitlines()[5:]
@@ -1,8 +1,39 @@
+import bz2
+import gzip
+import itertools
+import lzma
+import os
+from collections import Counter
 from functools import partial
 
 import pytest
 
-from logstapo.logtail import logtail
+import logstapo.logtail
+from logstapo.index import LogIndex
+from logstapo.logtail import Throttle, logtail, commit_offsets, load_state, find_time_offset
+
+
+def _zstd_compress(data):
+    # zstandard is optional, so only the tests using it are skipped without it
+    zstandard = pytest.importorskip('zstandard')
+    return zstandard.ZstdCompressor().compress(data)
+
+
+COMPRESSORS = {'.gz': gzip.compress,
+               '.bz2': bz2.compress,
+               '.xz': lzma.compress,
+               '.zst': _zstd_compress}
+
+
+def _rotate_compressed(log, target):
+    # like logrotate: rename, create the new logfile, then compress
+    rotated = log.new(basename=log.basename + '.rotating')
+    log.rename(rotated)
+    log.write('')
+    target.write(COMPRESSORS[target.ext](rotated.read_binary()), 'wb')
+    # keep the uncompressed file around under a different name, otherwise
+    # its inode may be reused immediately by the filesystem
+    rotated.rename(target.new(basename=target.basename + '.orig'))
 
 
 def test_logtail_invalid(mocker, tmpdir):
@@ -42,6 +73,374 @@ def test_logtail(mocker, tmpdir, rotated_suffix, custom_offset_path):
     assert list(logtail_fn(log.strpath)) == ['foo', 'new']
 
 
+@pytest.mark.parametrize('rotated_suffix', ('.1.gz', '.1.bz2', '.1.xz', '.1.zst', '-20150101.gz', '-20150101.zst'))
+def test_logtail_compressed(mocker, tmpdir, rotated_suffix):
+    mocker.patch('logstapo.logtail.debug_echo')
+    warning_echo = mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    rotated = tmpdir.join('test.log' + rotated_suffix)
+    log.write('hello\nworld\n')
+    assert list(logtail(log.strpath)) == ['hello', 'world']
+    # append, rotate and compress without delaycompress
+    log.write('foo\nbar\n', 'a')
+    _rotate_compressed(log, rotated)
+    log.write('new\n')
+    assert list(logtail(log.strpath)) == ['foo', 'bar', 'new']
+    assert not warning_echo.called
+    assert list(logtail(log.strpath)) == []
+
+
+def test_logtail_compressed_newest_dateext(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    tmpdir.join('test.log-20150101.gz').write(gzip.compress(b'old\n'), 'wb')
+    log.write('hello\n')
+    assert list(logtail(log.strpath)) == ['hello']
+    log.write('foo\n', 'a')
+    _rotate_compressed(log, tmpdir.join('test.log-20150102.gz'))
+    log.write('new\n')
+    assert list(logtail(log.strpath)) == ['foo', 'new']
+
+
+def test_logtail_compressed_wrong_fingerprint(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('hello\nworld\n')
+    assert list(logtail(log.strpath)) == ['hello', 'world']
+    tmpdir.join('test.log.1.gz').write(gzip.compress(b'something\nelse\n'), 'wb')
+    log.remove()
+    log.write('foo\n')
+    assert list(logtail(log.strpath)) == ['foo']
+
+
+def test_logtail_multiple_generations(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    warning_echo = mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('hello\n')
+    assert list(logtail(log.strpath)) == ['hello']
+    log.write('a\n', 'a')
+    _rotate_compressed(log, tmpdir.join('test.log.3.gz'))
+    log.write('b\n', 'a')
+    _rotate_compressed(log, tmpdir.join('test.log.2.xz'))
+    log.write('c\n', 'a')
+    log.rename(tmpdir.join('test.log.1'))
+    log.write('d\n')
+    assert list(logtail(log.strpath)) == ['a', 'b', 'c', 'd']
+    assert not warning_echo.called
+
+
+def test_logtail_multiple_generations_dateext(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('hello\n')
+    assert list(logtail(log.strpath)) == ['hello']
+    log.write('a\n', 'a')
+    _rotate_compressed(log, tmpdir.join('test.log-20150101.gz'))
+    log.write('b\n', 'a')
+    _rotate_compressed(log, tmpdir.join('test.log-20150102.gz'))
+    log.write('c\n', 'a')
+    assert list(logtail(log.strpath)) == ['a', 'b', 'c']
+
+
+def test_logtail_missing_generation(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    warning_echo = mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('hello\n')
+    assert list(logtail(log.strpath)) == ['hello']
+    tmpdir.join('test.log.1.gz').write(gzip.compress(b'unrelated\n'), 'wb')
+    log.remove()
+    log.write('new\n')
+    assert list(logtail(log.strpath)) == ['new']
+    assert warning_echo.called
+
+
+def test_logtail_max_bytes(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('hello\n')
+    assert list(logtail(log.strpath)) == ['hello']
+    log.write('a1\na2\na3\n', 'a')
+    _rotate_compressed(log, tmpdir.join('test.log.2.gz'))
+    log.write('b1\nb2\n', 'a')
+    log.rename(tmpdir.join('test.log.1'))
+    log.write('c1\nc2\n')
+    assert list(logtail(log.strpath, max_bytes=4)) == ['a1', 'a2']
+    assert list(logtail(log.strpath, max_bytes=5)) == ['a3', 'b1']
+    assert list(logtail(log.strpath, max_bytes=1)) == ['b2']
+    assert list(logtail(log.strpath, max_bytes=1)) == ['c1']
+    assert list(logtail(log.strpath, max_bytes=100)) == ['c2']
+    assert list(logtail(log.strpath, max_bytes=100)) == []
+
+
+@pytest.mark.parametrize('compress', (False, True))
+def test_logtail_max_line_length(mocker, tmpdir, compress):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    mocker.patch('logstapo.logtail._SKIP_CHUNK_SIZE', 7)
+    log = tmpdir.join('test.log')
+    log.write('hello\n')
+    assert list(logtail(log.strpath)) == ['hello']
+    log.write('1234567890\n' + 'x' * 100 + '\n12345678901\n', 'a')
+    if compress:
+        _rotate_compressed(log, tmpdir.join('test.log.1.gz'))
+    log.write('end\n' + 'y' * 50, 'a')
+    stats = Counter()
+    assert list(logtail(log.strpath, max_line_length=10, stats=stats)) == [
+        '1234567890', 'xxxxxxxxxx [90 bytes truncated]', '1234567890 [1 bytes truncated]', 'end',
+        'yyyyyyyyyy [40 bytes truncated]'
+    ]
+    assert stats == {'truncated': 3}
+    # the offset points after the truncated line
+    log.write('z\n', 'a')
+    assert list(logtail(log.strpath, max_line_length=10, stats=stats)) == ['z']
+
+
+def test_logtail_pending(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    offset = tmpdir.join('test.log.offset')
+    log.write('hello\nworld\n')
+    pending = {}
+    assert list(logtail(log.strpath, pending=pending)) == ['hello', 'world']
+    assert not offset.check()
+    assert pending[offset.strpath]['offset'] == 12
+    assert not pending[offset.strpath]['more']
+    # the staged offset is used when reading again
+    log.write('foo\n', 'a')
+    assert list(logtail(log.strpath, pending=pending)) == ['foo']
+    assert not offset.check()
+    commit_offsets(pending)
+    assert offset.check()
+    assert list(logtail(log.strpath)) == []
+
+
+def test_logtail_chunks_compressed(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    skip = mocker.spy(logstapo.logtail, '_skip')
+    log = tmpdir.join('test.log')
+    log.write('a1\n')
+    assert list(logtail(log.strpath)) == ['a1']
+    log.write('a2\na3\na4\n', 'a')
+    _rotate_compressed(log, tmpdir.join('test.log.1.gz'))
+    log.write('b1\nb2\n')
+    pending = {}
+    logtail_fn = partial(logtail, log.strpath, chunk_bytes=4, pending=pending)
+    # the compressed file is read in one chunk
+    assert list(logtail_fn()) == ['a2', 'a3', 'a4', 'b1']
+    assert pending[log.strpath + '.offset']['more']
+    assert list(logtail_fn()) == ['b2']
+    assert [call[0][1] for call in skip.call_args_list] == [3]
+    # but the limit for the run still applies
+    commit_offsets(pending)
+    log.write('b3\nb4\n', 'a')
+    _rotate_compressed(log, tmpdir.join('test.log.1.gz'))
+    log.write('c1\n')
+    assert list(logtail(log.strpath, chunk_bytes=3, max_bytes=3)) == ['b3']
+    assert list(logtail(log.strpath)) == ['b4', 'c1']
+
+
+def _is_indented(line):
+    return line[:1].isspace()
+
+
+def test_logtail_continuation(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    log = tmpdir.join('test.log')
+    log.write('a\n x\nb\n y\n y\nc\n z\n')
+    pending = {}
+    logtail_fn = partial(logtail, log.strpath, chunk_bytes=7, pending=pending, continuation=_is_indented)
+    # the limit is reached within the entry starting with 'b', so it is kept back
+    assert list(logtail_fn()) == ['a', ' x']
+    state = pending[log.strpath + '.offset']
+    assert state['offset'] == 5
+    assert state['read'] == 5
+    assert state['more']
+    assert list(logtail_fn()) == ['b', ' y', ' y']
+    assert list(logtail_fn()) == ['c', ' z']
+    assert not pending[log.strpath + '.offset']['more']
+    # an entry larger than the limit cannot be kept back
+    log.write('d\n' + ' w\n' * 10, 'a')
+    assert list(logtail_fn()) == ['d', ' w', ' w']
+
+
+def test_logtail_hold_open(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    monotonic = mocker.patch('logstapo.logtail.time.monotonic', return_value=100)
+    log = tmpdir.join('test.log')
+    log.write('a\n x\nb\n y\n')
+    pending = {}
+    logtail_fn = partial(logtail, log.strpath, pending=pending, continuation=_is_indented, hold_open=10)
+    # the last entry may still be continued
+    assert list(logtail_fn()) == ['a', ' x']
+    state = pending[log.strpath + '.offset']
+    assert state['offset'] == 5
+    assert state['held'] == (5, 100)
+    assert not state['more']
+    log.write(' y\n', 'a')
+    monotonic.return_value = 105
+    assert list(logtail_fn()) == []
+    assert pending[log.strpath + '.offset']['held'] == (5, 100)
+    # until a new entry starts
+    log.write('c\n', 'a')
+    assert list(logtail_fn()) == ['b', ' y', ' y']
+    assert pending[log.strpath + '.offset']['held'] == (13, 105)
+    # or it has been kept back long enough
+    monotonic.return_value = 115
+    assert list(logtail_fn()) == ['c']
+    assert 'held' not in pending[log.strpath + '.offset']
+
+
+def test_logtail_seen_filter(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.bloom.debug_echo')
+    warning_echo = mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    offset = tmpdir.join('test.log.offset')
+    log.write('hello\nworld\n')
+    assert list(logtail(log.strpath, seen_filter_size=1024)) == ['hello', 'world']
+    assert tmpdir.join('test.log.offset.seen').check()
+    log.write('foo\nhello\n', 'a')
+    offset.remove()
+    # lines at the beginning which have already been read are skipped
+    assert list(logtail(log.strpath, seen_filter_size=1024)) == ['foo', 'hello']
+    warning_echo.assert_called_once_with('Offset lost, skipped 2 lines which have already been read: ' + log.strpath)
+    assert list(logtail(log.strpath, seen_filter_size=1024)) == []
+    # a new file clears the filter
+    log.remove()
+    log.write('hello\nbar\n')
+    assert list(logtail(log.strpath, seen_filter_size=1024)) == ['hello', 'bar']
+    offset.remove()
+    assert list(logtail(log.strpath, seen_filter_size=1024)) == []
+
+
+def test_logtail_seen_filter_pending(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.bloom.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    seen = tmpdir.join('test.log.offset.seen')
+    log.write('hello\nworld\n')
+    pending = {}
+    assert list(logtail(log.strpath, pending=pending, seen_filter_size=1024, chunk_bytes=6)) == ['hello']
+    assert list(logtail(log.strpath, pending=pending, seen_filter_size=1024, chunk_bytes=6)) == ['world']
+    assert not seen.check()
+    commit_offsets(pending)
+    assert seen.check()
+    tmpdir.join('test.log.offset').remove()
+    assert list(logtail(log.strpath, seen_filter_size=1024)) == []
+
+
+def test_logtail_chunks(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('a1\na2\na3\na4\na5\n')
+    pending = {}
+    logtail_fn = partial(logtail, log.strpath, chunk_bytes=4, max_bytes=9, pending=pending)
+    assert list(logtail_fn()) == ['a1', 'a2']
+    state = pending[log.strpath + '.offset']
+    assert state['more']
+    assert state['read'] == 6
+    assert list(logtail_fn()) == ['a3']
+    # max_bytes reached
+    assert not pending[log.strpath + '.offset']['more']
+    assert list(logtail_fn()) == []
+    commit_offsets(pending)
+    assert list(logtail(log.strpath)) == ['a4', 'a5']
+
+
+def test_logtail_chunk_at_eof(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('a1\na2\n')
+    pending = {}
+    assert list(logtail(log.strpath, chunk_bytes=6, pending=pending)) == ['a1', 'a2']
+    assert not pending[log.strpath + '.offset']['more']
+
+
+def test_logtail_max_seconds(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    monotonic = mocker.patch('logstapo.logtail.time').monotonic
+    monotonic.side_effect = itertools.count()
+    log = tmpdir.join('test.log')
+    log.write('a1\na2\na3\na4\n')
+    pending = {}
+    assert list(logtail(log.strpath, max_seconds=2, pending=pending)) == ['a1', 'a2']
+    state = pending[log.strpath + '.offset']
+    assert state['backlog']
+    assert not state['more']
+    assert list(logtail(log.strpath, max_seconds=2, pending=pending)) == []
+    commit_offsets(pending)
+    monotonic.side_effect = itertools.count()
+    assert list(logtail(log.strpath, max_seconds=10)) == ['a3', 'a4']
+
+
+def test_logtail_stage_at_eof(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('a1\n')
+    assert list(logtail(log.strpath)) == ['a1']
+    pending = {}
+    assert list(logtail(log.strpath, pending=pending)) == []
+    state = pending[log.strpath + '.offset']
+    assert state['offset'] == 3
+    assert not state['backlog']
+    state['checked'] = 123.5
+    commit_offsets(pending)
+    assert load_state(log.strpath)['checked'] == 123.5
+    # the check time is kept when reading new data
+    log.write('a2\n', 'a')
+    pending = {}
+    assert list(logtail(log.strpath, pending=pending)) == ['a2']
+    commit_offsets(pending)
+    assert load_state(log.strpath)['checked'] == 123.5
+
+
+@pytest.mark.parametrize('drop_cache', (True, False))
+def test_logtail_throttle(mocker, tmpdir, drop_cache):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.THROTTLE_CHUNK_SIZE', 10)
+    fadvise = mocker.spy(os, 'posix_fadvise')
+    log = tmpdir.join('test.log')
+    log.write('aaaa\n' * 5)
+    throttle = Throttle(drop_cache=drop_cache)
+    assert len(list(logtail(log.strpath, throttle=throttle))) == 5
+    assert throttle.bytes_read == 25
+    assert throttle.bytes_dropped == (25 if drop_cache else 0)
+    advice = [(x[0][1], x[0][2], x[0][3]) for x in fadvise.call_args_list]
+    if drop_cache:
+        assert advice == [(0, 0, os.POSIX_FADV_SEQUENTIAL), (0, 10, os.POSIX_FADV_DONTNEED),
+                          (10, 10, os.POSIX_FADV_DONTNEED), (20, 5, os.POSIX_FADV_DONTNEED)]
+    else:
+        assert advice == [(0, 0, os.POSIX_FADV_SEQUENTIAL)]
+
+
+def test_throttle_rate(mocker):
+    time = mocker.patch('logstapo.logtail.time')
+    time.monotonic.return_value = 0
+    throttle = Throttle(100)
+    throttle.consume(None, 0, 80)
+    assert not time.sleep.called
+    throttle.consume(None, 0, 70)
+    time.sleep.assert_called_once_with(0.5)
+    time.monotonic.return_value = 1.5
+    throttle.consume(None, 0, 100)
+    time.sleep.assert_called_once_with(0.5)
+    assert throttle.throttled == 0.5
+    assert throttle.bytes_read == 250
+
+
 def test_logtail_bad_charset(mocker, tmpdir):
     mocker.patch('logstapo.logtail.debug_echo')
     mocker.patch('logstapo.logtail.warning_echo')
@@ -104,14 +503,71 @@ def test_logtail_rotated_wrong_inode(mocker, tmpdir):
     rotated = tmpdir.join('test.log.1')
     log.write('hello\nworld\n')
     assert list(logtail(log.strpath)) == ['hello', 'world']
-    # copy it so the rotated file has a different inode
+    # copy it so the rotated file has a different inode and content
     log.copy(rotated)
-    rotated.write('bar\n', 'a')
+    rotated.write('other\nstuff\n')
     log.remove()
     log.write('foo\n')
     assert list(logtail(log.strpath)) == ['foo']
 
 
+@pytest.mark.parametrize('compress', (False, True))
+def test_logtail_copytruncate(mocker, tmpdir, compress):
+    mocker.patch('logstapo.logtail.debug_echo')
+    warning_echo = mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('hello\nworld\n')
+    assert list(logtail(log.strpath)) == ['hello', 'world']
+    log.write('foo\n', 'a')
+    if compress:
+        tmpdir.join('test.log.1.gz').write(gzip.compress(log.read_binary()), 'wb')
+    else:
+        log.copy(tmpdir.join('test.log.1'))
+    # truncate and grow past the old offset before the next run
+    inode = log.stat().ino
+    log.write('something completely different\n')
+    assert log.stat().ino == inode
+    assert list(logtail(log.strpath)) == ['foo', 'something completely different']
+    assert not warning_echo.called
+    assert list(logtail(log.strpath)) == []
+
+
+def test_logtail_inode_reused(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    warning_echo = mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('hello\nworld\n')
+    assert list(logtail(log.strpath)) == ['hello', 'world']
+    # same inode and bigger than the old offset, but unrelated content
+    log.write('a completely new file\n')
+    assert list(logtail(log.strpath)) == ['a completely new file']
+    assert warning_echo.called
+
+
+def test_logtail_changed_before_offset(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    log.write('hello\nworld\n')
+    assert list(logtail(log.strpath)) == ['hello', 'world']
+    # same head but different data before the offset
+    log.write('hello\nthere\nfoo\n')
+    assert list(logtail(log.strpath)) == ['hello', 'there', 'foo']
+
+
+def test_logtail_old_offset_file(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.logtail.warning_echo')
+    log = tmpdir.join('test.log')
+    offset = tmpdir.join('test.log.offset')
+    log.write('hello\nworld\nfoo\n')
+    # offset files without fingerprints are still supported
+    offset.write('{}\n{}\n'.format(log.stat().ino, 12))
+    assert list(logtail(log.strpath)) == ['foo']
+    assert 'head=' in offset.read()
+    assert 'tail=' in offset.read()
+
+
 def test_logtail_bad_offset_file(mocker, tmpdir):
     mocker.patch('logstapo.logtail.debug_echo')
     warning_echo = mocker.patch('logstapo.logtail.warning_echo')
@@ -127,3 +583,113 @@ def test_logtail_bad_offset_file(mocker, tmpdir):
     assert list(logtail(log.strpath)) == ['foo']
     assert warning_echo.called
     assert list(logtail(log.strpath)) == ['foo']
+
+
+def _get_time(line):
+    return int(line.split()[0]) if line[:1].isdigit() else None
+
+
+def _timed_lines(start, stop):
+    # every entry is followed by a line without a timestamp
+    return ''.join('{:06d} entry\n  details\n'.format(i) for i in range(start, stop))
+
+
+@pytest.mark.parametrize('since', (0, 1, 4321, 9999, 10000))
+def test_find_time_offset(mocker, tmpdir, since):
+    mocker.patch('logstapo.logtail.debug_echo')
+    log = tmpdir.join('test.log')
+    log.write(_timed_lines(0, 10000))
+    with open(log.strpath, 'rb') as f:
+        offset = find_time_offset(f, since, _get_time)
+    target = 23 * since
+    assert offset <= target
+    assert target - offset <= 65536 + 23
+    # the offset is always a line boundary
+    assert offset == 0 or log.read_binary()[offset - 1:offset] == b'\n'
+
+
+def test_find_time_offset_long_lines(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    truncate_line = mocker.spy(logstapo.logtail, '_truncate_line')
+    log = tmpdir.join('test.log')
+    # huge lines without line breaks are only read chunk by chunk
+    log.write(''.join('{:06d} entry {}\n'.format(i, 'x' * 100000) for i in range(10)))
+    with open(log.strpath, 'rb') as f:
+        offset = find_time_offset(f, 5, _get_time)
+    assert offset == 4 * 100014
+    assert truncate_line.called
+    assert all(len(call[0][1]) <= 65537 for call in truncate_line.call_args_list)
+    lines = list(logtail(log.strpath, since=8, get_time=_get_time, max_line_length=10, dry_run=True))
+    assert lines == ['000008 ent [100003 bytes truncated]', '000009 ent [100003 bytes truncated]']
+
+
+def test_logtail_since_until(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    log = tmpdir.join('test.log')
+    log.write(_timed_lines(0, 10000))
+    lines = list(logtail(log.strpath, since=5000, until=5001, get_time=_get_time))
+    assert lines == ['005000 entry', '  details', '005001 entry', '  details']
+    # the offset points to the end of the time range
+    assert load_state(log.strpath)['offset'] == 23 * 5002
+    assert list(logtail(log.strpath, get_time=_get_time, until=5002)) == ['005002 entry', '  details']
+
+
+def test_logtail_until_pending(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    log = tmpdir.join('test.log')
+    log.write(_timed_lines(0, 10))
+    pending = {}
+    assert len(list(logtail(log.strpath, pending=pending, until=4, get_time=_get_time))) == 10
+    state = pending[log.strpath + '.offset']
+    assert state['backlog']
+    assert not state['more']
+
+
+@pytest.mark.parametrize('compress', (None, '.gz'))
+def test_logtail_since_rotated(mocker, tmpdir, compress):
+    mocker.patch('logstapo.logtail.debug_echo')
+    log = tmpdir.join('test.log')
+    log.write(_timed_lines(0, 100))
+    if compress:
+        _rotate_compressed(log, tmpdir.join('test.log.2' + compress))
+    else:
+        log.rename(tmpdir.join('test.log.2'))
+    log.write(_timed_lines(100, 200))
+    log.rename(tmpdir.join('test.log.1'))
+    log.write(_timed_lines(200, 300))
+    lines = list(logtail(log.strpath, since=95, get_time=_get_time))
+    assert lines[0] == '000095 entry'
+    assert lines[-1] == '  details'
+    assert len(lines) == 2 * 205
+    # the offset points to the current logfile
+    assert load_state(log.strpath)['offset'] == log.size()
+    lines = list(logtail(log.strpath, since=150, get_time=_get_time, dry_run=True))
+    assert lines[0] == '000150 entry'
+    assert len(lines) == 2 * 150
+
+
+def test_logtail_index(mocker, tmpdir):
+    mocker.patch('logstapo.logtail.debug_echo')
+    mocker.patch('logstapo.index.debug_echo')
+    log = tmpdir.join('test.log')
+    log.write(_timed_lines(0, 10))
+    assert len(list(logtail(log.strpath, get_time=_get_time, index_interval=100))) == 20
+    log.write(_timed_lines(10, 20), 'a')
+    assert len(list(logtail(log.strpath, get_time=_get_time, index_interval=100))) == 20
+    index = LogIndex(log.strpath + '.offset.index', 100)
+    # entries are added at the first line starting after the interval
+    assert list(index.offsets) == [0, 105, 207, 312, 414]
+    assert list(index.lines) == [0, 9, 18, 27, 36]
+    # the timestamp is the one of the first entry starting at or after the position
+    assert list(index.times) == [0, 5, 9, 14, 18]
+    assert (index.end, index.end_line) == (log.size(), 40)
+    # the index is used to narrow down the search
+    lines = list(logtail(log.strpath, get_time=_get_time, index_interval=100, since=12, dry_run=True))
+    assert lines[0] == '000012 entry'
+    # a new file resets the index
+    log.remove()
+    log.write(_timed_lines(100, 101))
+    assert len(list(logtail(log.strpath, get_time=_get_time, index_interval=100))) == 2
+    index = LogIndex(log.strpath + '.offset.index', 100)
+    assert list(index.times) == [100]
+    assert (index.end, index.end_line) == (log.size(), 2)
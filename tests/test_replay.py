@@ -0,0 +1,102 @@
+import gzip
+import re
+
+import pytest
+
+from logstapo.config import _Pattern
+from logstapo.replay import ReplayStats, find_replay_files, format_diff, format_stats, replay_file, replay_logs
+
+
+REGEX = re.compile('^(?P<source>[^/]+)/(?P<message>.+)$')
+
+
+def _log_def(files=(), multiline=None, **kwargs):
+    data = {'files': files, 'garbage': [_Pattern('crap*')], 'ignore': {_Pattern('foo'): [_Pattern('boring *')]},
+            'multiline': multiline}
+    data.update(kwargs)
+    return data
+
+
+@pytest.fixture
+def logfile(tmpdir):
+    log = tmpdir.join('test.log')
+    log.write('crap\nfoo/boring 1\nfoo/boring 2\nfoo/error 1\nbar/error 2\nwtf\nfoo/error 3\n')
+    return log
+
+
+def test_replay_file(logfile):
+    stats = replay_file(logfile.strpath, _log_def(), [REGEX])
+    assert (stats.files, stats.lines) == (1, 7)
+    assert (stats.garbage, stats.invalid, stats.ignored, stats.other) == (1, 1, 2, 3)
+    assert stats.garbage_hits == {'crap*': 1}
+    assert stats.ignore_hits == {('foo', 'boring *'): 2}
+    assert stats.templates == {('foo', 'error <NUM>'): 2, ('bar', 'error <NUM>'): 1}
+    assert stats.examples[('foo', 'error <NUM>')] == 'foo/error 1'
+
+
+def test_replay_file_multiline(tmpdir):
+    log = tmpdir.join('test.log')
+    log.write('foo/error 1\n  at x\n  at y\nfoo/boring 1\n  at z\n')
+    multiline = {'continuation': 'indent', 'max_lines': 10, 'max_chars': 1000}
+    stats = replay_file(log.strpath, _log_def(multiline=multiline), [REGEX])
+    assert (stats.lines, stats.ignored, stats.other) == (5, 1, 1)
+
+
+def test_replay_file_max_line_length(tmpdir):
+    log = tmpdir.join('test.log')
+    log.write('foo/error {}\nfoo/error 2\n'.format('x' * 100))
+    stats = replay_file(log.strpath, _log_def(), [REGEX], max_line_length=12)
+    assert (stats.lines, stats.other) == (2, 2)
+    assert stats.examples[('foo', 'error xx [<NUM> bytes truncated]')] == 'foo/error xx [98 bytes truncated]'
+
+
+def test_replay_file_unreadable(tmpdir):
+    stats = replay_file(tmpdir.join('missing.log').strpath, _log_def(), [REGEX])
+    assert stats.lines == 0
+    assert len(stats.errors) == 1
+
+
+def test_find_replay_files(mocker, tmpdir, logfile):
+    mocker.patch('logstapo.logtail.debug_echo')
+    tmpdir.join('test.log.1').write('')
+    tmpdir.join('test.log.2.gz').write(gzip.compress(b''), 'wb')
+    paths = find_replay_files(_log_def(files=(logfile.strpath, tmpdir.join('missing.log').strpath)))
+    assert paths == [tmpdir.join(name).strpath for name in ('test.log.2.gz', 'test.log.1', 'test.log')]
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_replay_logs(tmpdir, logfile, jobs):
+    rotated = tmpdir.join('test.log.1.gz')
+    rotated.write(gzip.compress(b'foo/error 4\n'), 'wb')
+    paths = [rotated.strpath, logfile.strpath]
+    other = _log_def(ignore={})
+    results = replay_logs({'a': (_log_def(), [REGEX], paths), 'b': (other, [REGEX], paths)}, jobs)
+    assert (results['a'].files, results['a'].lines, results['a'].other) == (2, 8, 4)
+    assert results['a'].templates[('foo', 'error <NUM>')] == 3
+    assert (results['b'].ignored, results['b'].other) == (0, 6)
+
+
+def test_format(logfile):
+    old = replay_file(logfile.strpath, _log_def(), [REGEX])
+    new = replay_file(logfile.strpath, _log_def(ignore={}), [REGEX])
+    lines = format_stats('test', old, top=1)
+    assert lines[0].startswith("Log 'test': 7 lines in 1 files")
+    assert '  1 garbage / 1 invalid / 2 ignored / 3 other' in lines
+    assert '           2  foo: boring *' in lines
+    assert lines[-1] == '           2x foo: error <NUM>'
+    lines = format_diff('test', old, new)
+    assert '  ignored             2          0         -2' in lines
+    assert '           2 -> 0        foo: boring *' in lines
+    assert lines[-2:] == ['  New unusual templates:', '           2x foo: boring <NUM>']
+
+
+def test_replay_stats_merge():
+    stats = ReplayStats()
+    other = ReplayStats()
+    other.lines = 10
+    other.elapsed = 2
+    other.templates[('a', 'b')] = 3
+    stats.merge(other)
+    stats.merge(other)
+    assert stats.lines_per_second == 5
+    assert stats.templates == {('a', 'b'): 6}
@@ -0,0 +1,193 @@
+import json
+import struct
+import zlib
+from unittest.mock import MagicMock
+
+import pytest
+
+from logstapo.actions import Action
+from logstapo.spool import Spool, SpoolDelivery, spool_results
+
+
+@pytest.fixture
+def spool(tmpdir):
+    return Spool(tmpdir.join('logstapo.spool').strpath)
+
+
+def _record(id_, action='a', data=None):
+    return {'id': id_, 'action': action, 'data': data or {'log': [[], ['x']]}, 'attempts': 0}
+
+
+def test_spool_empty(spool):
+    assert spool.read() == []
+
+
+def test_spool_append_update(spool):
+    spool.append([_record('1'), _record('2')])
+    spool.append([_record('3')])
+    assert [r['id'] for r in spool.read()] == ['1', '2', '3']
+    spool.update({'2'}, {'3'})
+    records = spool.read()
+    assert [r['id'] for r in records] == ['1', '3']
+    assert [r['attempts'] for r in records] == [0, 1]
+
+
+def test_spool_truncated(mocker, spool):
+    warning_echo = mocker.patch('logstapo.spool.warning_echo')
+    spool.append([_record('1'), _record('2')])
+    with open(spool.path, 'rb+') as f:
+        f.truncate(f.seek(0, 2) - 3)
+    assert [r['id'] for r in spool.read()] == ['1']
+    assert warning_echo.called
+
+
+def test_spool_corrupt(mocker, spool):
+    warning_echo = mocker.patch('logstapo.spool.warning_echo')
+    spool.append([_record('1')])
+    with open(spool.path, 'ab') as f:
+        f.write(b'\x00\x00\x00\x03foo')
+    spool.append([_record('2')])
+    assert [r['id'] for r in spool.read()] == ['1', '2']
+    assert warning_echo.called
+
+
+def test_spool_legacy_format(spool):
+    with open(spool.path, 'wb') as f:
+        data = zlib.compress(json.dumps(_record('1')).encode('utf-8'))
+        f.write(struct.pack('>I', len(data)) + data)
+    spool.append([_record('2')])
+    assert spool.read() == [_record('1'), _record('2')]
+    spool.update(set(), {'1'})
+    assert [r['attempts'] for r in spool.read()] == [1, 0]
+    with open(spool.path, 'rb') as f:
+        assert f.read(4) == b'\xffLS2'
+
+
+def test_spool_entries_load(spool):
+    spool.append([_record('1', data={'x': [['big'], []]}), _record('2')])
+    entries = spool.entries()
+    assert [(e['id'], e['action'], e['attempts']) for e in entries] == [('1', 'a', 0), ('2', 'a', 0)]
+    assert 'data' not in entries[0]
+    assert spool.load(entries[0]) == {'x': [['big'], []]}
+    spool.update({'1'}, set())
+    # the records have been moved
+    assert spool.load(entries[1]) is None
+    assert spool.load(spool.entries()[0]) == _record('2')['data']
+
+
+def test_spool_park(tmpdir):
+    spool = Spool(tmpdir.join('logstapo.spool').strpath, 2)
+    spool.append([_record('1'), _record('2')])
+    assert spool.update(set(), {'1'}) == []
+    parked = spool.update(set(), {'1', '2'})
+    assert [(e['id'], e['attempts']) for e in parked] == [('1', 2)]
+    assert [r['id'] for r in spool.read()] == ['2']
+    assert [(r['id'], r['attempts']) for r in Spool(spool.path + '.parked').read()] == [('1', 2)]
+
+
+def test_spool_results(mock_config, spool):
+    mock_config({'debug': False, 'logs': {'x': {'actions': ['a', 'b']}, 'y': {'actions': ['b']}}})
+    assert spool_results(spool, {'x': (['x1'], []), 'y': ([], [])}) == set()
+    records = spool.read()
+    assert [(r['action'], r['data']) for r in records] == [('a', {'x': [['x1'], []]}),
+                                                           ('b', {'x': [['x1'], []]})]
+    assert spool_results(spool, {'y': ([], [])}) == set()
+    assert len(spool.read()) == 2
+
+
+def test_spool_results_failed(mocker, mock_config, tmpdir):
+    error_echo = mocker.patch('logstapo.spool.error_echo')
+    mock_config({'debug': False, 'logs': {'x': {'actions': ['a']}}})
+    spool = Spool(tmpdir.join('missing', 'logstapo.spool').strpath)
+    assert spool_results(spool, {'x': (['x1'], [])}) == {'x'}
+    assert error_echo.called
+
+
+@pytest.mark.parametrize('fail_count', (0, 1, 2, 3))
+def test_spool_delivery(mocker, mock_config, spool, fail_count):
+    mocker.patch('logstapo.spool.error_echo')
+    mocker.patch('logstapo.actions.error_echo')
+    action = MagicMock(spec=Action, timeout=None)
+    action.run.side_effect = [Exception('fail')] * fail_count + [None]
+    mock_config({'debug': False, 'actions': {'a': action}})
+    spool.append([_record('1')])
+    delivery = SpoolDelivery(spool, 3, 0.001)
+    delivery.start()
+    assert delivery.finish() == (fail_count < 3)
+    assert action.run.call_count == min(fail_count + 1, 3)
+    records = spool.read()
+    if fail_count < 3:
+        assert not records
+    else:
+        assert records[0]['attempts'] == 3
+
+
+def test_spool_delivery_wake(mock_config, spool):
+    action = MagicMock(spec=Action, timeout=None)
+    mock_config({'debug': False, 'actions': {'a': action}})
+    delivery = SpoolDelivery(spool, 3, 0.001)
+    delivery.start()
+    spool.append([_record('1')])
+    delivery.wake()
+    spool.append([_record('2')])
+    assert delivery.finish()
+    assert action.run.call_count == 2
+    assert not spool.read()
+
+
+def test_spool_delivery_unknown_action(mocker, mock_config, spool):
+    warning_echo = mocker.patch('logstapo.spool.warning_echo')
+    mock_config({'debug': False, 'actions': {}})
+    spool.append([_record('1')])
+    delivery = SpoolDelivery(spool, 3, 0.001)
+    delivery.start()
+    assert delivery.finish()
+    assert warning_echo.called
+    assert not spool.read()
+
+
+def test_spool_delivery_park(mocker, mock_config, tmpdir):
+    mocker.patch('logstapo.spool.error_echo')
+    mocker.patch('logstapo.actions.error_echo')
+    warning_echo = mocker.patch('logstapo.spool.warning_echo')
+    action = MagicMock(spec=Action, timeout=None)
+    action.run.side_effect = Exception('fail')
+    mock_config({'debug': False, 'actions': {'a': action}})
+    spool = Spool(tmpdir.join('logstapo.spool').strpath, 4)
+    spool.append([_record('1')])
+    delivery = SpoolDelivery(spool, 3, 0.001)
+    delivery.start()
+    assert not delivery.finish()
+    assert spool.read()[0]['attempts'] == 3
+    delivery = SpoolDelivery(spool, 3, 0.001)
+    delivery.start()
+    assert not delivery.finish()
+    assert action.run.call_count == 4
+    assert not spool.read()
+    assert [r['id'] for r in Spool(spool.path + '.parked').read()] == ['1']
+    warning_echo.assert_called_once_with('Parked spooled results after 4 failed attempts: 1')
+
+
+def test_spool_claim(spool):
+    with spool.claim() as claimed:
+        assert claimed
+        # e.g. another instance
+        with Spool(spool.path).claim() as other_claimed:
+            assert not other_claimed
+        # adding records is still possible
+        spool.append([_record('1')])
+    with Spool(spool.path).claim() as claimed:
+        assert claimed
+
+
+def test_spool_delivery_claimed(mock_config, spool):
+    action = MagicMock(spec=Action, timeout=None)
+    mock_config({'debug': False, 'actions': {'a': action}})
+    spool.append([_record('1')])
+    delivery = SpoolDelivery(spool, 3, 0.001)
+    with Spool(spool.path).claim():
+        delivery.start()
+        assert delivery.finish()
+    # the records are left for the process which is delivering them
+    assert not action.run.called
+    assert len(spool.read()) == 1
@@ -0,0 +1,50 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from logstapo.timestamps import parse_time_arg, parse_timestamp
+
+
+NOW = datetime(2017, 1, 2, 12, 0).timestamp()
+
+
+@pytest.mark.parametrize(('value', 'expected'), (
+    ('2017-01-02 03:04:05', datetime(2017, 1, 2, 3, 4, 5)),
+    ('2017-01-02T03:04:05,123', datetime(2017, 1, 2, 3, 4, 5, 123000)),
+    ('2017-01-02 03:04:05.123456789', datetime(2017, 1, 2, 3, 4, 5, 123456)),
+    ('2017-01-02T03:04:05Z', datetime(2017, 1, 2, 3, 4, 5, tzinfo=timezone.utc)),
+    ('Jan  2 03:04:05', datetime(2017, 1, 2, 3, 4, 5)),
+    ('Jan 3 03:04:05', datetime(2017, 1, 3, 3, 4, 5)),
+    # more than a day in the future -> last year
+    ('Dec 31 23:59:59', datetime(2016, 12, 31, 23, 59, 59)),
+))
+def test_parse_timestamp(value, expected):
+    assert parse_timestamp(value, NOW) == expected.timestamp()
+
+
+def test_parse_timestamp_offset():
+    assert parse_timestamp('2017-01-02T03:04:05+01:00') == parse_timestamp('2017-01-02T02:04:05Z')
+
+
+@pytest.mark.parametrize('value', ('', 'foo', 'Foo  2 03:04:05', '2017-13-02 03:04:05', '12345.678'))
+def test_parse_timestamp_invalid(value):
+    assert parse_timestamp(value, NOW) is None
+
+
+@pytest.mark.parametrize(('value', 'expected'), (
+    ('2h', NOW - 7200),
+    ('30m', NOW - 1800),
+    ('1d', NOW - 86400),
+    ('02:00', datetime(2017, 1, 2, 2, 0).timestamp()),
+    ('13:00:30', datetime(2017, 1, 1, 13, 0, 30).timestamp()),
+    ('2016-12-31', datetime(2016, 12, 31).timestamp()),
+    ('2016-12-31 02:00', datetime(2016, 12, 31, 2, 0).timestamp()),
+))
+def test_parse_time_arg(value, expected):
+    assert parse_time_arg(value, NOW) == expected
+
+
+@pytest.mark.parametrize('value', ('', 'yesterday', '25:00', '2h ago'))
+def test_parse_time_arg_invalid(value):
+    with pytest.raises(ValueError):
+        parse_time_arg(value, NOW)
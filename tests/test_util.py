@@ -1,5 +1,6 @@
 import itertools
 import re
+from unittest.mock import call
 
 import pytest
 
@@ -40,6 +41,48 @@ def test_verbose_echo(mocker, mock_config, level, verbosity, debug):
     assert secho.called == (debug or (level <= verbosity))
 
 
+def test_debug_echo_lazy(mocker, mock_config):
+    class Unformattable(object):
+        def __format__(self, spec):
+            raise AssertionError('formatted')
+
+    mock_config({'debug': False, 'verbosity': 0})
+    secho = mocker.patch('logstapo.util.click.secho')
+    util.debug_echo('test {}', Unformattable())
+    util.verbose_echo(1, 'test {}', Unformattable())
+    assert not secho.called
+    mock_config({'debug': True, 'verbosity': 0})
+    util.debug_echo('test {}', 123)
+    secho.assert_called_once_with('[D] test 123', err=False, fg='black', bold=True)
+
+
+def test_buffered_output(mocker, mock_config):
+    mock_config({'debug': True, 'verbosity': 0})
+    mocker.patch('logstapo.util.OUTPUT_BUFFER_SIZE', 4)
+    echo = mocker.patch('logstapo.util.click.echo')
+    mocker.patch('logstapo.util.click.style', side_effect=lambda message, **kwargs: message)
+    with util.buffered_output():
+        util.debug_echo('a')
+        util.warning_echo('b')
+        with util.buffered_output():
+            util.debug_echo('c')
+        assert not echo.called
+        util.debug_echo('d')
+        assert echo.call_args_list == [call('[D] a', err=False), call('[W] b', err=True),
+                                       call('[D] c\n[D] d', err=False)]
+        echo.reset_mock()
+        util.debug_echo('e')
+        util.error_echo('f')
+        assert echo.call_args_list == [call('[D] e', err=False), call('[E] f', err=True)]
+        echo.reset_mock()
+        util.debug_echo('g')
+        util.flush_output()
+        echo.assert_called_once_with('[D] g', err=False)
+        echo.reset_mock()
+        util.debug_echo('h')
+    echo.assert_called_once_with('[D] h', err=False)
+
+
 def test_warning_echo(mocker):
     secho = mocker.patch('logstapo.util.click.secho')
     util.warning_echo('test')
@@ -84,3 +127,19 @@ def test_combine_placeholders_cycle():
         util.combine_placeholders('test%(a)', {'a': '%(a)'})
     with pytest.raises(ValueError):
         util.combine_placeholders('test%(a)', {'a': '%(b)', 'b': '%(a)'})
+
+
+def test_set_idle_io_priority_unsupported(mocker):
+    warning_echo = mocker.patch('logstapo.util.warning_echo')
+    mocker.patch('logstapo.util.platform.machine', return_value='pdp11')
+    assert not util.set_idle_io_priority()
+    assert warning_echo.called
+
+
+def test_set_idle_io_priority(mocker, mock_config):
+    mock_config({'debug': False})
+    mocker.patch('logstapo.util.platform.machine', return_value='x86_64')
+    cdll = mocker.patch('logstapo.util.ctypes.CDLL')
+    cdll.return_value.syscall.return_value = 0
+    assert util.set_idle_io_priority()
+    cdll.return_value.syscall.assert_called_once_with(251, 1, 0, 3 << 13)